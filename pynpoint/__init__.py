@@ -50,6 +50,8 @@ from pynpoint.processing.psfpreparation import PSFpreparationModule, \
                                                SDIpreparationModule
 
 from pynpoint.processing.psfsubtraction import PcaPsfSubtractionModule, \
+                                               AnnulusPcaPsfSubtractionModule, \
+                                               FrameRejectionPcaModule, \
                                                ClassicalADIModule
 
 from pynpoint.processing.resizing import CropImagesModule, \
@@ -24,6 +24,22 @@ def get_attributes():
                    'config':'settings',
                    'value':1,
                    'type':'int'},
+            'CHUNKS':{'attribute':'static',
+                      'config':'settings',
+                      'value':0,
+                      'type':'int'},
+            'COMPRESSION':{'attribute':'static',
+                           'config':'settings',
+                           'value':'None',
+                           'type':'str'},
+            'SHUFFLE':{'attribute':'static',
+                       'config':'settings',
+                       'value':0,
+                       'type':'int'},
+            'CHUNK_CACHE':{'attribute':'static',
+                           'config':'settings',
+                           'value':0,
+                           'type':'int'},
             'INSTRUMENT':{'attribute':'non-static',
                           'config':'header',
                           'value':'INSTRUME',
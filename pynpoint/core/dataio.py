@@ -4,8 +4,10 @@ Modules for accessing data and attributes in the central database.
 
 from __future__ import absolute_import
 
+import math
 import warnings
 import os
+import threading
 
 from abc import ABCMeta, abstractmethod
 
@@ -47,9 +49,30 @@ class DataStorage(object):
         self.m_data_bank = None
         self.m_open = False
 
+        # size (MB) of the HDF5 chunk cache, the h5py default is used if set to 0
+        self.m_chunk_cache = 0
+
+        # storage layout of specific tags, see Pypeline.set_storage_layout
+        self.m_layout = {}
+
+        # output ports with pending write operations on their tag
+        self.m_pending = {}
+
+        # number of modifications of each tag and number of (re)connections to the HDF5 file,
+        # which are used by the input ports to validate their cached metadata
+        self.m_version = {}
+        self.m_session = 0
+
+        # number of read and write operations on the datasets and the number of bytes transferred
+        self.m_statistics = {"read_calls": 0,
+                             "read_bytes": 0,
+                             "write_calls": 0,
+                             "write_bytes": 0}
+
     def open_connection(self):
         """
-        Opens the connection to the HDF5 file by opening an old file or creating a new one.
+        Opens the connection to the HDF5 file by opening an old file or creating a new one. The
+        size of the chunk cache is set by the CHUNK_CACHE value (MB) of the central configuration.
 
         Returns
         -------
@@ -58,8 +81,16 @@ class DataStorage(object):
         """
 
         if not self.m_open:
-            self.m_data_bank = h5py.File(self._m_location, mode='a')
+            if self.m_chunk_cache > 0:
+                self.m_data_bank = h5py.File(self._m_location,
+                                             mode='a',
+                                             rdcc_nbytes=self.m_chunk_cache*1024**2)
+
+            else:
+                self.m_data_bank = h5py.File(self._m_location, mode='a')
+
             self.m_open = True
+            self.m_session += 1
 
     def close_connection(self):
         """
@@ -73,8 +104,81 @@ class DataStorage(object):
         """
 
         if self.m_open:
+            self.synchronize()
             self.m_data_bank.close()
             self.m_open = False
+            self.m_session += 1
+
+    def update_version(self,
+                       tag):
+        """
+        Increases the version number of a database tag after the data or attributes have been
+        modified, such that the metadata that is cached by the input ports is invalidated.
+
+        Parameters
+        ----------
+        tag : str
+            Database tag.
+
+        Returns
+        -------
+        NoneType
+            None
+        """
+
+        self.m_version[tag] = self.m_version.get(tag, 0) + 1
+
+    def record_io(self,
+                  mode,
+                  nbytes):
+        """
+        Adds a read or write operation to the I/O statistics of the data storage, which are used
+        by :func:`~pynpoint.core.pypeline.Pypeline.get_profile`.
+
+        Parameters
+        ----------
+        mode : str
+            Type of operation ("read" or "write").
+        nbytes : int
+            Number of bytes that have been read or written.
+
+        Returns
+        -------
+        NoneType
+            None
+        """
+
+        self.m_statistics[mode+"_calls"] += 1
+        self.m_statistics[mode+"_bytes"] += int(nbytes)
+
+    def synchronize(self,
+                    tag=None):
+        """
+        Completes the pending write operations of the output ports such that the datasets in the
+        HDF5 file have their actual size (see :func:`~pynpoint.core.dataio.OutputPort.set_growth`).
+
+        Parameters
+        ----------
+        tag : str
+            Database tag. All pending write operations are completed if set to None.
+
+        Returns
+        -------
+        NoneType
+            None
+        """
+
+        if tag is None:
+            tags = list(self.m_pending.keys())
+
+        elif tag in self.m_pending:
+            tags = [tag]
+
+        else:
+            tags = []
+
+        for item in tags:
+            self.m_pending.pop(item)._finalize()
 
 
 class Port(six.with_metaclass(ABCMeta)):
@@ -362,6 +466,31 @@ class InputPort(Port):
             raise ValueError("The tag name 'fits_header' is reserved for storage of the FITS "
                              "headers.")
 
+        self._m_cache = {}
+        self._m_cache_version = None
+
+    def _get_cache(self):
+        """
+        Internal function which returns the cached metadata (shape and attributes) of the dataset.
+        The cache is cleared if the tag has been modified through an OutputPort or if the
+        database has been reopened since the metadata was cached.
+
+        Returns
+        -------
+        dict
+            Cached metadata.
+        """
+
+        version = (id(self._m_data_storage),
+                   self._m_data_storage.m_session,
+                   self._m_data_storage.m_version.get(self._m_tag, 0))
+
+        if version != self._m_cache_version:
+            self._m_cache = {}
+            self._m_cache_version = version
+
+        return self._m_cache
+
     def _check_status_and_activate(self):
         """
         Internal function which checks if the InputPort is ready to use and open it.
@@ -401,12 +530,21 @@ class InputPort(Port):
         if not self._check_status_and_activate():
             status = False
 
-        elif self._check_if_data_exists() is False:
-            warnings.warn("No data under the tag which is linked by the InputPort.")
-            status = False
-
         else:
-            status = True
+            # complete pending write operations of output ports with the same tag
+            self._m_data_storage.synchronize(self._m_tag)
+
+            cache = self._get_cache()
+
+            if "shape" not in cache and self._check_if_data_exists():
+                cache["shape"] = self._m_data_storage.m_data_bank[self._m_tag].shape
+
+            if "shape" in cache:
+                status = True
+
+            else:
+                warnings.warn("No data under the tag which is linked by the InputPort.")
+                status = False
 
         return status
 
@@ -432,6 +570,7 @@ class InputPort(Port):
 
         else:
             data = self._m_data_storage.m_data_bank[self._m_tag][item]
+            self._m_data_storage.record_io("read", np.asarray(data).nbytes)
 
         return data
 
@@ -450,8 +589,7 @@ class InputPort(Port):
             data_shape = None
 
         else:
-            self.open_port()
-            data_shape = self._m_data_storage.m_data_bank[self._m_tag].shape
+            data_shape = self._get_cache()["shape"]
 
         return data_shape
 
@@ -469,11 +607,136 @@ class InputPort(Port):
             ndim = None
 
         else:
-            self.open_port()
-            ndim = self._m_data_storage.m_data_bank[self._m_tag].ndim
+            ndim = len(self._get_cache()["shape"])
 
         return ndim
 
+    def iter_blocks(self,
+                    block_size,
+                    prefetch=1):
+        """
+        Iterates over the dataset in blocks along the first dimension (e.g. subsets of images). A
+        background thread reads the next blocks from the database while the current block is
+        processed, such that the HDF5 read operations overlap with the processing.
+
+        Parameters
+        ----------
+        block_size : int
+            Number of elements (e.g. images) per block. The full dataset is read as a single
+            block if set to 0, similar to the MEMORY setting.
+        prefetch : int
+            Number of blocks that is read ahead by the background thread. The blocks are read
+            without background thread if set to 0.
+
+        Yields
+        ------
+        numpy.ndarray
+            Block of the dataset.
+        """
+
+        if not self._check_error_cases():
+            return
+
+        nimages = self._get_cache()["shape"][0]
+
+        if block_size == 0 or block_size >= nimages:
+            frames = [0, nimages]
+        else:
+            frames = list(six.moves.range(0, nimages, block_size)) + [nimages]
+
+        dataset = self._m_data_storage.m_data_bank[self._m_tag]
+
+        if prefetch == 0:
+            for i in six.moves.range(len(frames)-1):
+                block = dataset[frames[i]:frames[i+1], ]
+                self._m_data_storage.record_io("read", block.nbytes)
+
+                yield block
+
+            return
+
+        queue = six.moves.queue.Queue(maxsize=prefetch)
+        stop = threading.Event()
+
+        def _put(item):
+            while not stop.is_set():
+                try:
+                    queue.put(item, timeout=0.1)
+                    return True
+
+                except six.moves.queue.Full:
+                    continue
+
+            return False
+
+        def _read_blocks():
+            try:
+                for i in six.moves.range(len(frames)-1):
+                    # h5py serializes the access to the HDF5 file so the reads are thread-safe
+                    if not _put((dataset[frames[i]:frames[i+1], ], None)):
+                        break
+
+            except Exception as error:
+                _put((None, error))
+
+        thread = threading.Thread(target=_read_blocks)
+        thread.daemon = True
+        thread.start()
+
+        try:
+            for _ in six.moves.range(len(frames)-1):
+                block, error = queue.get()
+
+                if error is not None:
+                    raise error
+
+                self._m_data_storage.record_io("read", block.nbytes)
+
+                yield block
+
+        finally:
+            stop.set()
+            thread.join()
+
+    def get_memmap(self):
+        """
+        Returns a read-only memory map of the dataset instead of loading the data into the memory.
+        This is only possible for datasets with a contiguous layout (see
+        :func:`~pynpoint.core.pypeline.Pypeline.set_storage_layout`) since the data is then stored
+        as a single uncompressed block in the HDF5 file. The pages of the memory map are loaded
+        when accessed and are shared by processes through the page cache of the operating system.
+        A copy of the full dataset is returned (see :func:`~pynpoint.core.dataio.InputPort.get_all`)
+        for chunked or compressed datasets. The memory map should not be used after the dataset
+        has been modified or deleted.
+
+        Returns
+        -------
+        numpy.ndarray
+            Memory map or copy of the full dataset. Returns None if the data does not exist.
+        """
+
+        if not self._check_error_cases():
+            return None
+
+        dataset = self._m_data_storage.m_data_bank[self._m_tag]
+
+        if dataset.chunks is None and dataset.compression is None and \
+                dataset.dtype.kind in "biuf" and dataset.id.get_offset() is not None:
+
+            # write the data that is cached by HDF5 to the file
+            self._m_data_storage.m_data_bank.flush()
+
+            data = np.memmap(self._m_data_storage.m_data_bank.filename,
+                             dtype=dataset.dtype,
+                             mode="r",
+                             offset=dataset.id.get_offset(),
+                             shape=dataset.shape)
+
+        else:
+            data = self.get_all()
+
+        return data
+
     def get_all(self):
         """
         Returns the whole dataset stored in the data bank under the tag of the Port. Be careful
@@ -492,6 +755,7 @@ class InputPort(Port):
 
         else:
             data = np.asarray(self._m_data_storage.m_data_bank[self._m_tag][...])
+            self._m_data_storage.record_io("read", data.nbytes)
 
         return data
 
@@ -518,19 +782,37 @@ class InputPort(Port):
             attr_val = None
 
         else:
-            if name in self._m_data_storage.m_data_bank[self._m_tag].attrs:
+            cache = self._get_cache()
+
+            if "static" not in cache:
+                cache["static"] = dict(self._m_data_storage.m_data_bank[self._m_tag].attrs)
+                cache["non-static"] = {}
+
+            attribute = "header_" + self._m_tag + "/" + name
+
+            if name in cache["static"]:
                 # static attribute
-                attr_val = self._m_data_storage.m_data_bank[self._m_tag].attrs[name]
+                attr_val = cache["static"][name]
+
+            elif name in cache["non-static"]:
+                # non-static attribute
+                attr_val = cache["non-static"][name]
 
-            elif "header_" + self._m_tag + "/" + name in self._m_data_storage.m_data_bank:
+            elif attribute in self._m_data_storage.m_data_bank:
                 # non-static attribute
-                attribute = "header_" + self._m_tag + "/" + name
                 attr_val = np.asarray(self._m_data_storage.m_data_bank[attribute][...])
+                cache["non-static"][name] = attr_val
+
+                self._m_data_storage.record_io("read", attr_val.nbytes)
 
             else:
                 warnings.warn("The attribute '%s' was not found." % name)
                 attr_val = None
 
+            # the cached arrays should not be changed by the module
+            if isinstance(attr_val, np.ndarray):
+                attr_val = np.copy(attr_val)
+
         return attr_val
 
     def get_all_static_attributes(self):
@@ -642,6 +924,12 @@ class OutputPort(Port):
 
         self.m_activate = activate_init
 
+        self.m_growth = None
+        self.m_size = None
+
+        self.m_buffer_size = None
+        self.m_buffer = []
+
         if tag == "config":
             raise ValueError("The tag name 'config' is reserved for the central configuration "
                              "of PynPoint.")
@@ -652,7 +940,9 @@ class OutputPort(Port):
 
     def _check_status_and_activate(self):
         """
-        Internal function which checks if the OutputPort is ready to use and open it.
+        Internal function which checks if the OutputPort is ready to use and open it. The
+        metadata that is cached by the input ports with the same tag is invalidated since the
+        port is about to write data or attributes.
 
         Returns
         -------
@@ -671,6 +961,8 @@ class OutputPort(Port):
             if not self._m_data_base_active:
                 self.open_port()
 
+            self._m_data_storage.update_version(self._m_tag)
+
             status = True
 
         return status
@@ -745,9 +1037,81 @@ class OutputPort(Port):
         except IndexError:
             warnings.warn("The dataset that is stored under the tag name '"+tag+"' is empty.")
 
-        self._m_data_storage.m_data_bank.create_dataset(tag,
-                                                        data=first_data,
-                                                        maxshape=data_shape)
+        layout = self._get_layout(tag, first_data)
+
+        if "maxshape" not in layout:
+            layout["maxshape"] = data_shape
+
+        self._m_data_storage.m_data_bank.create_dataset(tag, data=first_data, **layout)
+        self._m_data_storage.record_io("write", np.asarray(first_data).nbytes)
+
+    def _get_layout(self,
+                    tag,
+                    first_data):
+        """
+        Internal function which determines the HDF5 storage layout (chunk shape and filters) of a
+        new dataset. The CHUNKS, COMPRESSION, and SHUFFLE values of the central configuration are
+        used, unless they are overridden for the tag with
+        :func:`~pynpoint.core.pypeline.Pypeline.set_storage_layout`, which can also select a
+        contiguous layout. Only stacks of images are affected, all other datasets use the
+        automatic layout of h5py.
+
+        Parameters
+        ----------
+        tag : str
+            Database tag.
+        first_data : numpy.ndarray
+            The initial data.
+
+        Returns
+        -------
+        dict
+            Keyword arguments for the creation of the HDF5 dataset.
+        """
+
+        layout = {}
+
+        if tag[0:7] == "header_" or first_data.ndim != 3 or first_data.dtype.kind not in "biuf" \
+                or first_data.shape[1] == 0 or first_data.shape[2] == 0:
+            return layout
+
+        settings = {"CHUNKS": 0, "COMPRESSION": "None", "SHUFFLE": 0}
+
+        if "config" in self._m_data_storage.m_data_bank:
+            config = self._m_data_storage.m_data_bank["config"].attrs
+
+            for key in settings:
+                if key in config:
+                    settings[key] = config[key]
+
+        if tag in self._m_data_storage.m_layout:
+            settings.update(self._m_data_storage.m_layout[tag])
+
+        if settings.get("CONTIGUOUS", 0):
+            # a contiguous dataset can not be resized, chunked, or compressed
+            layout["maxshape"] = None
+            return layout
+
+        if settings["CHUNKS"] > 0:
+            # chunks are limited to 4 GB by HDF5 so the number of images per chunk is capped at 1 GB
+            frame_size = first_data.shape[1]*first_data.shape[2]*first_data.dtype.itemsize
+            nframes = min(int(settings["CHUNKS"]), max(1, 1024**3 // frame_size))
+
+            layout["chunks"] = (nframes, first_data.shape[1], first_data.shape[2])
+
+        compression = str(settings["COMPRESSION"])
+
+        if compression in ("gzip", "lzf"):
+            layout["compression"] = compression
+
+        elif compression != "None":
+            raise ValueError("Compression filter '%s' is not supported. Please use 'gzip', 'lzf', "
+                             "or 'None'." % compression)
+
+        if settings["SHUFFLE"]:
+            layout["shuffle"] = True
+
+        return layout
 
     def _set_all_key(self,
                      tag,
@@ -779,6 +1143,8 @@ class OutputPort(Port):
 
         tmp_attributes = {}
 
+        self._m_data_storage.synchronize(tag)
+
         # check if database entry is new...
         if tag in self._m_data_storage.m_data_bank:
             # NO -> database entry exists
@@ -823,6 +1189,10 @@ class OutputPort(Port):
             None
         """
 
+        # complete pending write operations of another port with the same tag
+        if self._m_data_storage.m_pending.get(tag, self) is not self:
+            self._m_data_storage.synchronize(tag)
+
         # check if database entry is new...
         if tag not in self._m_data_storage.m_data_bank:
             # YES -> database entry is new
@@ -875,8 +1245,18 @@ class OutputPort(Port):
             except IndexError:
                 warnings.warn("The dataset that is stored under the tag name '"+tag+"' is empty.")
 
-            self._m_data_storage.m_data_bank[tag].resize(tmp_shape[0] + data.shape[0], axis=0)
-            self._m_data_storage.m_data_bank[tag][tmp_shape[0]::] = data
+            if self._m_data_storage.m_data_bank[tag].chunks is None:
+                # contiguous datasets can not be resized so the dataset is created again
+                data = np.concatenate((self._m_data_storage.m_data_bank[tag][...], data), axis=0)
+                self._set_all_key(tag, data=data, keep_attributes=True)
+
+            elif self.m_growth is not None and tag == self._m_tag:
+                self._append_capacity(data)
+
+            else:
+                self._m_data_storage.m_data_bank[tag].resize(tmp_shape[0] + data.shape[0], axis=0)
+                self._m_data_storage.m_data_bank[tag][tmp_shape[0]::] = data
+                self._m_data_storage.record_io("write", data.nbytes)
 
             return None
 
@@ -891,6 +1271,154 @@ class OutputPort(Port):
         raise ValueError("The port tag '%s' is already used with a different data type. The "
                          "'force' parameter can be used to replace the tag." % self._m_tag)
 
+    def _append_capacity(self,
+                         data):
+        """
+        Internal function for appending data to an over-allocated dataset. The capacity of the
+        dataset is increased with the growth strategy of the port if the data does not fit and
+        the actual size of the data is stored by the port until the dataset is trimmed by
+        :func:`~pynpoint.core.dataio.OutputPort._finalize`.
+
+        Parameters
+        ----------
+        data : numpy.ndarray
+            The data that will be appended, with the same number of dimensions as the dataset.
+
+        Returns
+        -------
+        NoneType
+            None
+        """
+
+        dataset = self._m_data_storage.m_data_bank[self._m_tag]
+
+        if self.m_size is None:
+            size = dataset.shape[0]
+        else:
+            size = self.m_size
+
+        new_size = size + data.shape[0]
+
+        if new_size > dataset.shape[0]:
+            if self.m_growth == "double":
+                capacity = max(new_size, 2*dataset.shape[0])
+
+            else:
+                capacity = self.m_growth*int(math.ceil(float(new_size)/float(self.m_growth)))
+
+            # chunks beyond the actual size are not allocated in the HDF5 file
+            dataset.resize(capacity, axis=0)
+
+        dataset[size:new_size] = data
+        self._m_data_storage.record_io("write", data.nbytes)
+
+        self.m_size = new_size
+        self._m_data_storage.m_pending[self._m_tag] = self
+
+    def _append_buffer(self,
+                       data,
+                       data_dim,
+                       force):
+        """
+        Internal function which adds data to the write buffer of the port. Only numerical data
+        with the same shape as the existing dataset (apart from the first dimension) is buffered.
+        The buffer is written to the database when the number of buffered elements along the
+        first dimension reaches the size of the buffer.
+
+        Parameters
+        ----------
+        data : numpy.ndarray
+            The data which will be appended.
+        data_dim : int
+            Number of data dimensions.
+        force : bool
+            The existing data will be overwritten if shape or type does not match if set to True.
+
+        Returns
+        -------
+        bool
+            True if the data is buffered and False if the data should be written directly.
+        """
+
+        data = np.asarray(data)
+
+        if self.m_buffer:
+            shape = self.m_buffer[0].shape
+
+        elif self._m_tag in self._m_data_storage.m_data_bank:
+            shape = self._m_data_storage.m_data_bank[self._m_tag].shape
+
+        else:
+            # the dataset is created directly such that attributes can be added
+            return False
+
+        if data_dim is None:
+            data_dim = len(shape)
+
+        if data.ndim + 1 == data_dim and data_dim in (2, 3):
+            data = data[np.newaxis, ]
+
+        if force or data.dtype.kind not in "biuf" or data.ndim != len(shape) or \
+                data.shape[1:] != shape[1:]:
+            self._write_buffer()
+            return False
+
+        self.m_buffer.append(data)
+        self._m_data_storage.m_pending[self._m_tag] = self
+
+        budget = self.m_buffer_size
+
+        if budget == "MEMORY":
+            if "config" in self._m_data_storage.m_data_bank:
+                budget = self._m_data_storage.m_data_bank["config"].attrs["MEMORY"]
+            else:
+                budget = 0
+
+        if budget > 0 and sum(item.shape[0] for item in self.m_buffer) >= budget:
+            self._write_buffer()
+
+        return True
+
+    def _write_buffer(self):
+        """
+        Internal function which writes the buffered data to the database with a single append.
+
+        Returns
+        -------
+        NoneType
+            None
+        """
+
+        if self.m_buffer:
+            data = np.concatenate(self.m_buffer, axis=0)
+            self.m_buffer = []
+
+            self._append_key(self._m_tag, data=data, data_dim=data.ndim)
+
+    def _finalize(self):
+        """
+        Internal function which writes the buffered data and trims an over-allocated dataset to
+        its actual size. The function is called by
+        :func:`~pynpoint.core.dataio.DataStorage.synchronize`.
+
+        Returns
+        -------
+        NoneType
+            None
+        """
+
+        self._write_buffer()
+
+        # appending the buffer can register the port again
+        if self._m_data_storage.m_pending.get(self._m_tag) is self:
+            del self._m_data_storage.m_pending[self._m_tag]
+
+        if self.m_size is not None:
+            self._m_data_storage.m_data_bank[self._m_tag].resize(self.m_size, axis=0)
+            self.m_size = None
+
+        self._m_data_storage.update_version(self._m_tag)
+
     def __setitem__(self,
                     key,
                     value):
@@ -912,7 +1440,9 @@ class OutputPort(Port):
         """
 
         if self._check_status_and_activate():
+            self._m_data_storage.synchronize(self._m_tag)
             self._m_data_storage.m_data_bank[self._m_tag][key] = value
+            self._m_data_storage.record_io("write", np.asarray(value).nbytes)
 
     def del_all_data(self):
         """
@@ -920,6 +1450,9 @@ class OutputPort(Port):
         """
 
         if self._check_status_and_activate():
+            # buffered data is discarded
+            self.m_buffer = []
+            self._m_data_storage.synchronize(self._m_tag)
 
             if self._m_tag in self._m_data_storage.m_data_bank:
                 del self._m_data_storage.m_data_bank[self._m_tag]
@@ -1024,10 +1557,77 @@ class OutputPort(Port):
 
         if self._check_status_and_activate():
 
-            self._append_key(self._m_tag,
-                             data=data,
-                             data_dim=data_dim,
-                             force=force)
+            if self.m_buffer_size is None or not self._append_buffer(data, data_dim, force):
+                self._append_key(self._m_tag,
+                                 data=data,
+                                 data_dim=data_dim,
+                                 force=force)
+
+    def set_growth(self,
+                   growth="double"):
+        """
+        Sets the capacity-based append mode of the port. Instead of resizing the HDF5 dataset for
+        each call of :func:`~pynpoint.core.dataio.OutputPort.append`, the dataset is
+        over-allocated along the first dimension and the actual size is tracked by the port.
+        Appending images one at a time therefore requires an amortized constant number of
+        resize operations. The dataset is trimmed to its actual size when the port is closed or
+        flushed, when the data is read with an InputPort, and after each pipeline module.
+
+        Parameters
+        ----------
+        growth : str, int, or None
+            Growth strategy of the capacity. The capacity is doubled with "double" or grows in
+            blocks of the given number of elements with an integer value. The capacity-based
+            append mode is switched off if set to None.
+
+        Returns
+        -------
+        NoneType
+            None
+        """
+
+        if growth is not None and growth != "double" and \
+                (not isinstance(growth, six.integer_types) or growth < 1):
+            raise ValueError("The growth of the capacity should be 'double', a positive integer, "
+                             "or None.")
+
+        if self._m_data_storage is not None and self._m_data_storage.m_open:
+            self._m_data_storage.synchronize(self._m_tag)
+
+        self.m_growth = growth
+
+    def set_buffer(self,
+                   buffer_size="MEMORY"):
+        """
+        Sets the write buffer of the port. Data that is appended with
+        :func:`~pynpoint.core.dataio.OutputPort.append` is collected in memory and written to the
+        database with a single append when the buffer is full, such that many small appends (e.g.
+        single images or fit results) do not each require an HDF5 write. The buffer is written
+        when the port is closed or flushed, when the data is read with an InputPort, and after
+        each pipeline module.
+
+        Parameters
+        ----------
+        buffer_size : str, int, or None
+            Number of elements along the first dimension (e.g. images) that is buffered. The
+            MEMORY value of the central configuration is used with "MEMORY", in which case all
+            data is buffered if MEMORY is set to None. The buffer is switched off if set to None.
+
+        Returns
+        -------
+        NoneType
+            None
+        """
+
+        if buffer_size is not None and buffer_size != "MEMORY" and \
+                (not isinstance(buffer_size, six.integer_types) or buffer_size < 1):
+            raise ValueError("The size of the buffer should be 'MEMORY', a positive integer, or "
+                             "None.")
+
+        if self._m_data_storage is not None and self._m_data_storage.m_open:
+            self._m_data_storage.synchronize(self._m_tag)
+
+        self.m_buffer_size = buffer_size
 
     def activate(self):
         """
@@ -1310,7 +1910,7 @@ class OutputPort(Port):
     def flush(self):
         """
         Forces the DataStorage to save all data from the memory to the hard drive without closing
-        it.
+        it. Pending write operations of the port are completed first.
 
         Returns
         -------
@@ -1318,4 +1918,5 @@ class OutputPort(Port):
             None
         """
 
+        self._m_data_storage.synchronize(self._m_tag)
         self._m_data_storage.m_data_bank.flush()
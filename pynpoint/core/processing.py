@@ -14,7 +14,8 @@ import six
 import numpy as np
 
 from pynpoint.core.dataio import ConfigPort, InputPort, OutputPort
-from pynpoint.util.multiproc import LineProcessingCapsule, apply_function
+from pynpoint.util.multiproc import LineProcessingCapsule, apply_function, frame_pool, \
+                                    apply_function_pool
 from pynpoint.util.module import progress, memory_frames
 
 
@@ -386,12 +387,16 @@ class ProcessingModule(six.with_metaclass(ABCMeta, PypelineModule)):
                                  image_in_port,
                                  image_out_port,
                                  message,
-                                 func_args=None):
+                                 func_args=None,
+                                 parallel=False,
+                                 batch=False):
         """
         Function which applies a function to all images of an input port. The MEMORY attribute
-        from the central configuration is used to load subsets of images into the memory. Note
-        that the function *func* is not allowed to change the shape of the images if the input
-        and output port have the same tag and ``MEMORY`` is not None.
+        from the central configuration is used to load subsets of images into the memory. The next
+        subset of images is read in the background while the current subset is processed (see
+        :func:`~pynpoint.core.dataio.InputPort.iter_blocks`). Note that the function *func* is
+        not allowed to change the shape of the images if the input and output port have the same
+        tag and ``MEMORY`` is not None.
 
         Parameters
         ----------
@@ -411,6 +416,19 @@ class ProcessingModule(six.with_metaclass(ABCMeta, PypelineModule)):
             Progress message that is printed.
         func_args : tuple
             Additional arguments which are needed by the function *func*.
+        parallel : bool
+            Distribute the images of each subset over a pool of CPU worker processes (see
+            configuration file). The results are written by the main process in the original
+            order. Should only be used if *func* does not change the state of the module (e.g.
+            counters, lists, or ports that are updated by the function), otherwise the images
+            are processed sequentially. The worker processes are forked, so the images are
+            processed sequentially, with a warning, on platforms that do not support forking.
+        batch : bool
+            The function *func* is applied to a subset of images at once instead of to the
+            individual images. In that case, *func* should accept a 3D stack of images as first
+            argument and return a stack of the same length. Recommended for functions that are
+            easily vectorized with numpy, since the loop over the images and the copy of the
+            results into a new array are avoided.
 
         Returns
         -------
@@ -453,30 +471,53 @@ class ProcessingModule(six.with_metaclass(ABCMeta, PypelineModule)):
 
             return np.asarray(result)
 
-        for i, _ in enumerate(frames[:-1]):
-            progress(i, len(frames[:-1]), message)
+        cpu = self._m_config_port.get_attribute("CPU")
+
+        if parallel and not batch and cpu > 1 and nimages > 1:
+            # the pool is created before the background reader thread is started
+            pool = frame_pool(cpu, func, func_args)
+        else:
+            pool = None
 
-            images = image_in_port[frames[i]:frames[i+1], ]
-            result = _append_result(images)
+        try:
+            for i, images in enumerate(image_in_port.iter_blocks(memory, prefetch=1)):
+                progress(i, len(frames[:-1]), message)
 
-            if image_out_port is not None:
-                if image_out_port.tag == image_in_port.tag:
-                    if image_in_port.get_shape()[-1] == result.shape[-1] and \
-                        image_in_port.get_shape()[-2] == result.shape[-2]:
+                if batch:
+                    if func_args is None:
+                        result = np.asarray(func(images))
+                    else:
+                        result = np.asarray(func(images, *func_args))
 
-                        if np.size(frames) == 2:
-                            image_out_port.set_all(result, keep_attributes=True)
+                elif pool is None:
+                    result = _append_result(images)
+
+                else:
+                    result = apply_function_pool(pool, images)
+
+                if image_out_port is not None:
+                    if image_out_port.tag == image_in_port.tag:
+                        if image_in_port.get_shape()[-1] == result.shape[-1] and \
+                            image_in_port.get_shape()[-2] == result.shape[-2]:
+
+                            if np.size(frames) == 2:
+                                image_out_port.set_all(result, keep_attributes=True)
+
+                            else:
+                                image_out_port[frames[i]:frames[i+1]] = result
 
                         else:
-                            image_out_port[frames[i]:frames[i+1]] = result
+                            raise ValueError("Input and output port have the same tag while the "
+                                             "input function is changing the image shape. This is "
+                                             "only possible with MEMORY=None.")
 
                     else:
-                        raise ValueError("Input and output port have the same tag while the input "
-                                         "function is changing the image shape. This is only "
-                                         "possible with MEMORY=None.")
+                        image_out_port.append(result)
 
-                else:
-                    image_out_port.append(result)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
 
         sys.stdout.write(message+" [DONE]\n")
         sys.stdout.flush()
@@ -6,11 +6,26 @@ from __future__ import absolute_import
 
 import os
 import sys
+import csv
+import json
+import time
 import warnings
 import configparser
 import collections
 import multiprocessing
 
+try:
+    import resource
+except ImportError:
+    # the resource module is not available on Windows
+    resource = None
+
+try:
+    import tracemalloc
+except ImportError:
+    # the tracemalloc module is not available on Python 2
+    tracemalloc = None
+
 import six
 import h5py
 import numpy as np
@@ -68,6 +83,7 @@ class Pypeline(object):
         self._m_output_place = output_place_in
 
         self._m_modules = collections.OrderedDict()
+        self._m_profile = collections.OrderedDict()
         self.m_data_storage = DataStorage(os.path.join(working_place_in, 'PynPoint_database.hdf5'))
 
         self._config_init()
@@ -181,8 +197,8 @@ class Pypeline(object):
                         if val["config"] == "header":
                             attributes[key]["value"] = "None"
 
-                        # elif val["type"] == "str":
-                        #     attributes[key]["value"] = "None"
+                        elif val["type"] == "str":
+                            attributes[key]["value"] = "None"
 
                         elif val["type"] == "float":
                             attributes[key]["value"] = float(0.)
@@ -194,8 +210,8 @@ class Pypeline(object):
                         if val["config"] == "header":
                             attributes[key]["value"] = str(config.get(val["config"], key))
 
-                        # elif val["type"] == "str":
-                        #     attributes[key]["value"] = str(config.get(val["config"], key))
+                        elif val["type"] == "str":
+                            attributes[key]["value"] = str(config.get(val["config"], key))
 
                         elif val["type"] == "float":
                             attributes[key]["value"] = float(config.get(val["config"], key))
@@ -236,6 +252,8 @@ class Pypeline(object):
 
         _write_config(attributes)
 
+        self.m_data_storage.m_chunk_cache = attributes["CHUNK_CACHE"]["value"]
+
     def add_module(self,
                    module):
         """
@@ -367,11 +385,153 @@ class Pypeline(object):
 
         return validate
 
-    def run(self):
+    @staticmethod
+    def _reset_peak_rss():
+        """
+        Internal function which resets the peak resident set size (VmHWM) of the process. Only
+        supported on Linux.
+
+        Returns
+        -------
+        bool
+            True if the peak resident set size has been reset.
+        """
+
+        try:
+            with open("/proc/self/clear_refs", "w") as clear_refs:
+                clear_refs.write("5")
+
+        except (IOError, OSError):
+            return False
+
+        return True
+
+    @staticmethod
+    def _peak_rss(who):
+        """
+        Internal function which returns the peak resident set size of the process or of its
+        terminated child processes.
+
+        Parameters
+        ----------
+        who : str
+            Process ("self") or terminated child processes ("children").
+
+        Returns
+        -------
+        float
+            Peak resident set size (MB). None if it is not supported by the platform.
+        """
+
+        if who == "self":
+            try:
+                with open("/proc/self/status", "r") as status:
+                    for line in status:
+                        if line.startswith("VmHWM:"):
+                            return int(line.split()[1]) / 1024.
+
+            except (IOError, OSError):
+                pass
+
+        if resource is None:
+            return None
+
+        if who == "self":
+            peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        else:
+            peak_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+        # the maximum resident set size is given in bytes on macOS and in kB on Linux
+        if sys.platform == "darwin":
+            return peak_rss / 1024.**2
+
+        return peak_rss / 1024.
+
+    def _run_and_profile(self,
+                         name,
+                         profile_memory):
+        """
+        Internal function which runs a pipeline module and stores the wall time, CPU time, peak
+        memory usage, and I/O statistics of the module in the profile of the Pypeline.
+
+        Parameters
+        ----------
+        name : str
+            Name of the pipeline module.
+        profile_memory : bool
+            Trace the memory allocations of the module with tracemalloc.
+
+        Returns
+        -------
+        NoneType
+            None
+        """
+
+        start_io = dict(self.m_data_storage.m_statistics)
+        start_cpu = os.times()
+        start_wall = time.time()
+
+        # the peak resident set size is a maximum since the start of the process if it can not
+        # be reset
+        self._reset_peak_rss()
+
+        # the memory allocations are only traced if tracing was not already started elsewhere,
+        # since the peak of an active trace can not be reset
+        trace_memory = profile_memory and tracemalloc is not None and \
+            not tracemalloc.is_tracing()
+
+        if trace_memory:
+            tracemalloc.start()
+
+        try:
+            self._m_modules[name].run()
+
+            # trim the datasets of output ports with pending write operations
+            self.m_data_storage.synchronize()
+
+            if trace_memory:
+                traced_memory = tracemalloc.get_traced_memory()[1] / 1024.**2
+            else:
+                traced_memory = None
+
+        finally:
+            if trace_memory:
+                tracemalloc.stop()
+
+        end_wall = time.time()
+        end_cpu = os.times()
+
+        # user and system time of the process and its terminated child processes
+        cpu_time = sum(end_cpu[0:4]) - sum(start_cpu[0:4])
+
+        profile = collections.OrderedDict()
+        profile["module"] = type(self._m_modules[name]).__name__
+        profile["wall_time"] = end_wall - start_wall
+        profile["cpu_time"] = cpu_time
+        profile["peak_memory"] = self._peak_rss("self")
+        profile["peak_memory_children"] = self._peak_rss("children")
+        profile["traced_memory"] = traced_memory
+
+        for key in ("read_calls", "read_bytes", "write_calls", "write_bytes"):
+            profile[key] = self.m_data_storage.m_statistics[key] - start_io[key]
+
+        # the profile of a module that runs again is replaced
+        self._m_profile.pop(name, None)
+        self._m_profile[name] = profile
+
+    def run(self,
+            profile_memory=False):
         """
         Walks through all saved processing steps and calls their run methods. The order in which
         the steps are called depends on the order they have been added to the Pypeline.
 
+        Parameters
+        ----------
+        profile_memory : bool
+            Trace the memory allocations of each module with tracemalloc (see
+            :func:`~pynpoint.core.pypeline.Pypeline.get_profile`). Tracing slows down modules
+            that allocate many (small) arrays considerably so it is disabled by default.
+
         Returns
         -------
         NoneType
@@ -392,9 +552,11 @@ class Pypeline(object):
         sys.stdout.flush()
 
         for key in self._m_modules:
-            self._m_modules[key].run()
+            self._run_and_profile(key, profile_memory)
 
-    def run_module(self, name):
+    def run_module(self,
+                   name,
+                   profile_memory=False):
         """
         Runs a single processing module.
 
@@ -402,6 +564,10 @@ class Pypeline(object):
         ----------
         name : str
             Name of the pipeline module.
+        profile_memory : bool
+            Trace the memory allocations of the module with tracemalloc (see
+            :func:`~pynpoint.core.pypeline.Pypeline.get_profile`). Tracing slows down modules
+            that allocate many (small) arrays considerably so it is disabled by default.
 
         Returns
         -------
@@ -422,7 +588,7 @@ class Pypeline(object):
             sys.stdout.write(" [DONE]\n")
             sys.stdout.flush()
 
-            self._m_modules[name].run()
+            self._run_and_profile(name, profile_memory)
 
         else:
             warnings.warn("Module '"+name+"' not found.")
@@ -444,6 +610,7 @@ class Pypeline(object):
         """
 
         self.m_data_storage.open_connection()
+        self.m_data_storage.synchronize(tag)
 
         return np.asarray(self.m_data_storage.m_data_bank[tag])
 
@@ -522,6 +689,136 @@ class Pypeline(object):
 
         self.m_data_storage.close_connection()
 
+    def set_storage_layout(self,
+                           data_tag,
+                           chunks=None,
+                           compression=None,
+                           shuffle=None,
+                           contiguous=None):
+        """
+        Function for setting the HDF5 storage layout of a specific database tag. The values
+        override the CHUNKS, COMPRESSION, and SHUFFLE settings of the central configuration and
+        are applied when the dataset is (re)created by an output port, for example by *set_all*
+        or by the first *append*. Only stacks of images (3D) are affected.
+
+        A contiguous dataset is stored as a single uncompressed block, which can be read
+        without loading the data into the memory with
+        :func:`~pynpoint.core.dataio.InputPort.get_memmap`. Appending data to a contiguous dataset
+        requires that the dataset is created again so it should be used for data that is written
+        at once.
+
+        Parameters
+        ----------
+        data_tag : str
+            Database tag.
+        chunks : int
+            Number of images per HDF5 chunk. The chunk shape is determined automatically by h5py
+            if set to 0. The central configuration is used if set to None.
+        compression : str
+            Compression filter ("gzip", "lzf", or "None"). The central configuration is used if
+            set to None.
+        shuffle : bool
+            Apply the shuffle filter before compression. The central configuration is used if set
+            to None.
+        contiguous : bool
+            Store the data with a contiguous layout, in which case the *chunks*, *compression*,
+            and *shuffle* values are not used. Chunked storage is used if set to None or False.
+
+        Returns
+        -------
+        NoneType
+            None
+        """
+
+        if contiguous and (chunks or compression not in (None, "None") or shuffle):
+            raise ValueError("A contiguous layout can not be combined with chunks, compression, "
+                             "or the shuffle filter.")
+
+        layout = {}
+
+        if chunks is not None:
+            layout["CHUNKS"] = chunks
+
+        if compression is not None:
+            layout["COMPRESSION"] = compression
+
+        if shuffle is not None:
+            layout["SHUFFLE"] = int(shuffle)
+
+        if contiguous is not None:
+            layout["CONTIGUOUS"] = int(contiguous)
+
+        self.m_data_storage.m_layout[data_tag] = layout
+
+    def get_profile(self,
+                    filename=None):
+        """
+        Function for getting the performance profile of the pipeline modules that have been run.
+        For each module, the profile contains the wall time (s), the CPU time (s) of the process
+        and its child processes, the peak memory usage (MB), and the number of read and write
+        operations on the database together with the number of bytes that have been transferred.
+        The peak memory usage is the peak resident set size of the process while the module was
+        running. It is reset for each module on Linux, whereas on other platforms it is the
+        maximum since the start of the process. The memory usage of worker processes is given
+        by peak_memory_children, which is the maximum resident set size (MB) of the terminated
+        child processes since the start of the process (i.e. not reset between modules). Both
+        are None if not supported by the platform. If the module was run with
+        profile_memory=True, traced_memory is the peak of the memory (MB) that was allocated by
+        the module in the main process, as traced with tracemalloc, and None otherwise or on
+        Python 2.
+
+        Parameters
+        ----------
+        filename : str
+            Filename of the report, which is written in JSON format if the extension is .json or
+            in CSV format if the extension is .csv. The default output place of the Pypeline is
+            used if no path is included. No report is written if set to None.
+
+        Returns
+        -------
+        collections.OrderedDict
+            Dictionary with the module names as keys and the profile of each module as value.
+        """
+
+        profile = collections.OrderedDict()
+
+        for key, value in six.iteritems(self._m_profile):
+            profile[key] = collections.OrderedDict(value)
+
+        if filename is not None:
+            if os.path.split(filename)[0] == "":
+                filename = os.path.join(self._m_output_place, filename)
+
+            extension = os.path.splitext(filename)[1].lower()
+
+            if extension == ".json":
+                with open(filename, "w") as json_file:
+                    json.dump(profile, json_file, indent=4)
+
+            elif extension == ".csv":
+                fields = ["name", "module", "wall_time", "cpu_time", "peak_memory",
+                          "peak_memory_children", "traced_memory", "read_calls", "read_bytes",
+                          "write_calls", "write_bytes"]
+
+                # the csv module requires a binary file on Python 2 and no newline translation
+                # on Python 3
+                if six.PY2:
+                    csv_file = open(filename, "wb")
+                else:
+                    csv_file = open(filename, "w", newline="")
+
+                with csv_file:
+                    writer = csv.writer(csv_file)
+                    writer.writerow(fields)
+
+                    for key, value in six.iteritems(profile):
+                        writer.writerow([key] + [value[item] for item in fields[1:]])
+
+            else:
+                raise ValueError("The profile can only be written to a .json or .csv file.")
+
+        return profile
+
     def get_tags(self):
         """
         Function for listing the database tags, ignoring header and config tags.
@@ -561,5 +858,6 @@ class Pypeline(object):
         """
 
         self.m_data_storage.open_connection()
+        self.m_data_storage.synchronize(tag)
 
         return self.m_data_storage.m_data_bank[tag].shape
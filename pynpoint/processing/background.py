@@ -380,7 +380,8 @@ class LineSubtractionModule(ProcessingModule):
                                       self.m_image_in_port,
                                       self.m_image_out_port,
                                       "Running LineSubtractionModule...",
-                                      func_args=(mask, ))
+                                      func_args=(mask, ),
+                                      parallel=True)
 
         history = "combine = "+str(self.m_combine)
         self.m_image_out_port.copy_attributes(self.m_image_in_port)
@@ -432,6 +433,7 @@ class NoddingBackgroundModule(ProcessingModule):
         self.m_science_in_port = self.add_input_port(science_in_tag)
         self.m_sky_in_port = self.add_input_port(sky_in_tag)
         self.m_image_out_port = self.add_output_port(image_out_tag)
+        self.m_image_out_port.set_growth("double")
 
         self.m_time_stamps = []
 
@@ -305,7 +305,8 @@ class BadPixelSigmaFilterModule(ProcessingModule):
                                       "Running BadPixelSigmaFilterModule...",
                                       func_args=(self.m_box,
                                                  self.m_sigma,
-                                                 self.m_iterate))
+                                                 self.m_iterate),
+                                      parallel=self.m_map_out_port is None)
 
         history = "sigma = "+str(self.m_sigma)
         self.m_image_out_port.copy_attributes(self.m_image_in_port)
@@ -506,7 +507,8 @@ class BadPixelInterpolationModule(ProcessingModule):
         self.apply_function_to_images(_image_interpolation,
                                       self.m_image_in_port,
                                       self.m_image_out_port,
-                                      "Running BadPixelInterpolationModule...")
+                                      "Running BadPixelInterpolationModule...",
+                                      parallel=True)
 
         history = "iterations = "+str(self.m_iterations)
         self.m_image_out_port.copy_attributes(self.m_image_in_port)
@@ -697,7 +699,8 @@ class ReplaceBadPixelsModule(ProcessingModule):
                                       self.m_image_in_port,
                                       self.m_image_out_port,
                                       "Running ReplaceBadPixelsModule...",
-                                      func_args=(index, ))
+                                      func_args=(index, ),
+                                      parallel=True)
 
         history = "replace = "+self.m_replace
         self.m_image_out_port.copy_attributes(self.m_image_in_port)
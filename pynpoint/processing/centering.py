@@ -336,7 +336,8 @@ class StarAlignmentModule(ProcessingModule):
         self.apply_function_to_images(_align_image,
                                       self.m_image_in_port,
                                       self.m_image_out_port,
-                                      "Running StarAlignmentModule...")
+                                      "Running StarAlignmentModule...",
+                                      parallel=True)
 
         self.m_image_out_port.copy_attributes(self.m_image_in_port)
 
@@ -456,8 +457,11 @@ class StarCenteringModule(ProcessingModule):
             self.m_mask_out_port = None
         else:
             self.m_mask_out_port = self.add_output_port(mask_out_tag)
+            self.m_mask_out_port.set_growth("double")
 
         self.m_fit_out_port = self.add_output_port(fit_out_tag)
+        self.m_fit_out_port.set_growth("double")
+        self.m_fit_out_port.set_buffer("MEMORY")
 
         self.m_method = method
         self.m_interpolation = interpolation
@@ -824,7 +828,8 @@ class ShiftImagesModule(ProcessingModule):
                                       self.m_image_in_port,
                                       self.m_image_out_port,
                                       "Running ShiftImagesModule...",
-                                      func_args=(self.m_shift, self.m_interpolation))
+                                      func_args=(self.m_shift, self.m_interpolation),
+                                      parallel=True)
 
         history = "shift_xy = "+str(self.m_shift)
         self.m_image_out_port.copy_attributes(self.m_image_in_port)
@@ -891,6 +896,7 @@ class WaffleCenteringModule(ProcessingModule):
         self.m_image_in_port = self.add_input_port(image_in_tag)
         self.m_center_in_port = self.add_input_port(center_in_tag)
         self.m_image_out_port = self.add_output_port(image_out_tag)
+        self.m_image_out_port.set_growth("double")
 
         self.m_size = size
         self.m_center = center
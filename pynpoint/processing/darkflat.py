@@ -102,8 +102,8 @@ class DarkCalibrationModule(ProcessingModule):
             None
         """
 
-        def _dark_calibration(image_in, dark_in):
-            return image_in - dark_in
+        def _dark_calibration(images, dark_in):
+            return images - dark_in
 
         dark = self.m_dark_in_port.get_all()
         master = _master_frame(dark, self.m_image_in_port)
@@ -112,7 +112,8 @@ class DarkCalibrationModule(ProcessingModule):
                                       self.m_image_in_port,
                                       self.m_image_out_port,
                                       "Running DarkCalibrationModule...",
-                                      func_args=(master, ))
+                                      func_args=(master, ),
+                                      batch=True)
 
         history = "dark_in_tag = "+self.m_dark_in_port.tag
         self.m_image_out_port.add_history("DarkCalibrationModule", history)
@@ -167,8 +168,8 @@ class FlatCalibrationModule(ProcessingModule):
             None
         """
 
-        def _flat_calibration(image_in, flat_in):
-            return image_in / flat_in
+        def _flat_calibration(images, flat_in):
+            return images / flat_in
 
         flat = self.m_flat_in_port.get_all()
         master = _master_frame(flat, self.m_image_in_port)
@@ -188,7 +189,8 @@ class FlatCalibrationModule(ProcessingModule):
                                       self.m_image_in_port,
                                       self.m_image_out_port,
                                       "Running FlatCalibrationModule...",
-                                      func_args=(master, ))
+                                      func_args=(master, ),
+                                      batch=True)
 
         history = "flat_in_tag = "+self.m_flat_in_port.tag
         self.m_image_out_port.add_history("FlatCalibrationModule", history)
@@ -258,7 +258,10 @@ class SimplexMinimizationModule(ProcessingModule):
             self.m_psf_in_port = self.add_input_port(psf_in_tag)
 
         self.m_res_out_port = self.add_output_port(res_out_tag)
+        self.m_res_out_port.set_buffer("MEMORY")
+
         self.m_flux_position_port = self.add_output_port(flux_position_tag)
+        self.m_flux_position_port.set_buffer("MEMORY")
 
         self.m_position = position
         self.m_magnitude = magnitude
@@ -818,7 +821,7 @@ class MCMCsamplingModule(ProcessingModule):
         pixscale = self.m_image_in_port.get_attribute("PIXSCALE")
         parang = self.m_image_in_port.get_attribute("PARANG")
 
-        images = self.m_image_in_port.get_all()
+        images = self.m_image_in_port.get_memmap()
         psf = self.m_psf_in_port.get_all()
 
         if psf.shape[0] != 1 and psf.shape[0] != images.shape[0]:
@@ -981,7 +984,8 @@ class AperturePhotometryModule(ProcessingModule):
                                       self.m_image_in_port,
                                       self.m_phot_out_port,
                                       "Running AperturePhotometryModule...",
-                                      func_args=(aperture,))
+                                      func_args=(aperture,),
+                                      parallel=True)
 
         history = "radius [arcsec] = "+str(self.m_radius*pixscale)
         self.m_phot_out_port.copy_attributes(self.m_image_in_port)
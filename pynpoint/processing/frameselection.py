@@ -63,11 +63,13 @@ class RemoveFramesModule(ProcessingModule):
             self.m_selected_out_port = None
         else:
             self.m_selected_out_port = self.add_output_port(selected_out_tag)
+            self.m_selected_out_port.set_buffer("MEMORY")
 
         if removed_out_tag is None:
             self.m_removed_out_port = None
         else:
             self.m_removed_out_port = self.add_output_port(removed_out_tag)
+            self.m_removed_out_port.set_buffer("MEMORY")
 
         if isinstance(frames, str):
             self.m_index_in_port = self.add_input_port(frames)
@@ -239,11 +241,13 @@ class FrameSelectionModule(ProcessingModule):
             self.m_selected_out_port = None
         else:
             self.m_selected_out_port = self.add_output_port(selected_out_tag)
+            self.m_selected_out_port.set_buffer("MEMORY")
 
         if removed_out_tag is None:
             self.m_removed_out_port = None
         else:
             self.m_removed_out_port = self.add_output_port(removed_out_tag)
+            self.m_removed_out_port.set_buffer("MEMORY")
 
         self.m_method = method
         self.m_fwhm = fwhm
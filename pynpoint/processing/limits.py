@@ -5,17 +5,17 @@ Pipeline modules for estimating detection limits.
 from __future__ import absolute_import
 
 import sys
-import os
 import warnings
-import multiprocessing as mp
+import functools
 
 import numpy as np
 
 from pynpoint.core.processing import ProcessingModule
 from pynpoint.util.image import create_mask
-from pynpoint.util.limits import contrast_limit
+from pynpoint.util.limits import contrast_limit, PcaThroughput
 from pynpoint.util.module import progress
-from pynpoint.util.psf import pca_psf_subtraction
+from pynpoint.util.multiproc import frame_pool, imap_function_pool
+from pynpoint.util.psf import pca_psf_subtraction, create_pca
 from pynpoint.util.residuals import combine_residuals
 
 
@@ -23,7 +23,8 @@ class ContrastCurveModule(ProcessingModule):
     """
     Module to calculate contrast limits by iterating towards a threshold for the false positive
     fraction, with a correction for small sample statistics. Positions are processed in parallel
-    if CPU > 1 in the configuration file.
+    if CPU > 1 in the configuration file. The worker processes are forked, or spawned on
+    platforms that do not support forking.
     """
 
     def __init__(self,
@@ -42,6 +43,10 @@ class ContrastCurveModule(ProcessingModule):
                  extra_rot=0.,
                  residuals="median",
                  snr_inject=100.,
+                 reuse_basis=False,
+                 stamp_radius=None,
+                 throughput_out_tag=None,
+                 adaptive=None,
                  **kwargs):
         """
         Constructor of ContrastCurveModule.
@@ -93,6 +98,36 @@ class ContrastCurveModule(ProcessingModule):
         snr_inject : float
             Signal-to-noise ratio of the injected planet signal that is used to measure the amount
             of self-subtraction.
+        reuse_basis : bool
+            Construct the PCA basis once from the images without fake planet and project the
+            images with fake planet onto this basis, instead of constructing a new basis for each
+            position. This is considerably faster for a large number of positions. Since the fake
+            planet is not part of the basis, the self-subtraction is underestimated if the fake
+            planet contributes to the principal components, which is the case for a small number
+            of images or a bright fake planet (see *snr_inject*). Except for the noise-weighted
+            residuals, the residuals of the images are then only created once and the PSF
+            subtraction for each position is only applied to the fake planet by itself, which is
+            added to the residuals of the images since the PSF subtraction with a fixed basis is
+            linear (see :class:`~pynpoint.util.limits.PcaThroughput`).
+        stamp_radius : float
+            Radius (arcsec) beyond which the PSF template of the fake planet is set to zero. The
+            fake planet is then only processed within a small region of the images. Only used if
+            *reuse_basis* is set to True. The full PSF template is used if set to None.
+        throughput_out_tag : str
+            Tag of the database entry that contains the separation (arcsec), position angle
+            (deg), and the fraction of the flux of the fake planet that remains after the PSF
+            subtraction, for each position. Not stored if set to None.
+        adaptive : float
+            Tolerance (mag) for an adaptive sampling of the separations and position angles.
+            The contrast is first calculated on a coarse grid with every fourth separation of
+            *separation*. At each separation, position angles are added (from the range specified
+            with *angle*, in an order that spreads them over the full circle) until the standard
+            error of the mean contrast is smaller than the tolerance. Separations are then
+            refined (on the grid of *separation*) between neighbouring separations for which the
+            mean contrast differs more than the tolerance or for which the standard error could
+            not be reduced below the tolerance. The contrast is only stored for the separations
+            that have been evaluated and a fifth column is added with the standard error of the
+            mean contrast. All separations and position angles are used if set to None.
 
         Returns
         -------
@@ -131,6 +166,11 @@ class ContrastCurveModule(ProcessingModule):
 
         self.m_contrast_out_port = self.add_output_port(contrast_out_tag)
 
+        if throughput_out_tag is None:
+            self.m_throughput_out_port = None
+        else:
+            self.m_throughput_out_port = self.add_output_port(throughput_out_tag)
+
         self.m_separation = separation
         self.m_angle = angle
         self.m_psf_scaling = psf_scaling
@@ -142,6 +182,9 @@ class ContrastCurveModule(ProcessingModule):
         self.m_extra_rot = extra_rot
         self.m_residuals = residuals
         self.m_snr_inject = snr_inject
+        self.m_reuse_basis = reuse_basis
+        self.m_stamp_radius = stamp_radius
+        self.m_adaptive = adaptive
 
         if self.m_angle[0] < 0. or self.m_angle[0] > 360. or self.m_angle[1] < 0. or \
            self.m_angle[1] > 360. or self.m_angle[2] < 0. or self.m_angle[2] > 360.:
@@ -149,6 +192,9 @@ class ContrastCurveModule(ProcessingModule):
             raise ValueError("The angular positions of the fake planets should lie between "
                              "0 deg and 360 deg.")
 
+        if self.m_adaptive is not None and self.m_adaptive <= 0.:
+            raise ValueError("The tolerance of the adaptive sampling should be positive.")
+
     def run(self):
         """
         Run method of the module. Fake positive companions are injected for a range of separations
@@ -164,7 +210,7 @@ class ContrastCurveModule(ProcessingModule):
             None
         """
 
-        images = self.m_image_in_port.get_all()
+        images = self.m_image_in_port.get_memmap()
         psf = self.m_psf_in_port.get_all()
 
         if psf.shape[0] != 1 and psf.shape[0] != images.shape[0]:
@@ -185,6 +231,9 @@ class ContrastCurveModule(ProcessingModule):
 
         self.m_aperture /= pixscale
 
+        if self.m_stamp_radius is not None:
+            self.m_stamp_radius /= pixscale
+
         pos_r = np.arange(self.m_separation[0]/pixscale,
                           self.m_separation[1]/pixscale,
                           self.m_separation[2]/pixscale)
@@ -210,88 +259,111 @@ class ContrastCurveModule(ProcessingModule):
         sys.stdout.write("Running ContrastCurveModule...\r")
         sys.stdout.flush()
 
-        positions = []
-        for sep in pos_r:
-            for ang in pos_t:
-                positions.append((sep, ang))
-
-        # Create a queue object which will contain the results
-        queue = mp.Queue()
-
-        result = []
-        jobs = []
-
-        working_place = self._m_config_port.get_attribute("WORKING_PLACE")
-
-        # Create temporary files
-        tmp_im_str = os.path.join(working_place, "tmp_images.npy")
-        tmp_psf_str = os.path.join(working_place, "tmp_psf.npy")
+        mask = create_mask(images.shape[-2:], [self.m_cent_size, self.m_edge_size])
 
-        np.save(tmp_im_str, images)
-        np.save(tmp_psf_str, psf)
+        if self.m_reuse_basis:
+            # select the first image and get the unmasked image indices
+            indices = np.where((images[0, ]*mask).reshape(-1) != 0.)[0]
 
-        mask = create_mask(images.shape[-2:], [self.m_cent_size, self.m_edge_size])
+            im_reshape = (images*mask).reshape(images.shape[0], -1)[:, indices]
+            im_reshape -= np.mean(im_reshape, axis=0)
 
-        _, im_res = pca_psf_subtraction(images=images*mask,
-                                        angles=-1.*parang+self.m_extra_rot,
-                                        pca_number=self.m_pca_number)
+            pca_sklearn = create_pca(self.m_pca_number)
+            pca_sklearn.fit(im_reshape)
 
-        noise = combine_residuals(method=self.m_residuals, res_rot=im_res)
+        else:
+            pca_sklearn = None
+            indices = None
 
-        for i, pos in enumerate(positions):
-            process = mp.Process(target=contrast_limit,
-                                 args=(tmp_im_str,
-                                       tmp_psf_str,
-                                       noise,
-                                       mask,
+        if self.m_reuse_basis and self.m_residuals != "weighted":
+            throughput = PcaThroughput(images*mask,
+                                       psf,
                                        parang,
-                                       self.m_psf_scaling,
-                                       self.m_extra_rot,
+                                       pca_sklearn,
                                        self.m_pca_number,
-                                       self.m_threshold,
-                                       self.m_aperture,
-                                       self.m_residuals,
-                                       self.m_snr_inject,
-                                       pos,
-                                       queue),
-                                 name=(str(os.path.basename(__file__)) + '_radius=' +
-                                       str(np.round(pos[0]*pixscale, 1)) + '_angle=' +
-                                       str(np.round(pos[1], 1))))
+                                       indices,
+                                       extra_rot=self.m_extra_rot,
+                                       psf_scaling=self.m_psf_scaling,
+                                       residuals=self.m_residuals,
+                                       stamp_radius=self.m_stamp_radius)
 
-            jobs.append(process)
+            noise = throughput.get_noise()
 
-        for i, job in enumerate(jobs):
-            job.start()
+        else:
+            throughput = None
 
-            if (i+1)%cpu == 0:
-                # Start *cpu* number of processes. Wait for them to finish and start again *cpu*
-                # number of processes.
+            if self.m_reuse_basis:
+                _, im_res = pca_psf_subtraction(images=im_reshape,
+                                                angles=-1.*parang+self.m_extra_rot,
+                                                pca_number=self.m_pca_number,
+                                                pca_sklearn=pca_sklearn,
+                                                im_shape=images.shape,
+                                                indices=indices)
+
+            else:
+                _, im_res = pca_psf_subtraction(images=images*mask,
+                                                angles=-1.*parang+self.m_extra_rot,
+                                                pca_number=self.m_pca_number)
+
+            noise = combine_residuals(method=self.m_residuals, res_rot=im_res)
+
+        # a partial of the module-level function can be pickled, such that the worker processes
+        # can also be spawned if forking is not supported by the platform
+        _contrast_limit = functools.partial(contrast_limit,
+                                            images,
+                                            psf,
+                                            noise,
+                                            mask,
+                                            parang,
+                                            self.m_psf_scaling,
+                                            self.m_extra_rot,
+                                            self.m_pca_number,
+                                            self.m_threshold,
+                                            self.m_aperture,
+                                            self.m_residuals,
+                                            self.m_snr_inject,
+                                            pca_sklearn=pca_sklearn,
+                                            indices=indices,
+                                            throughput=throughput)
+
+        # the images and PSF are inherited by the worker processes and each worker picks up
+        # the next position as soon as it is finished with the previous position
+        if cpu > 1:
+            pool = frame_pool(cpu, _contrast_limit, None, picklable=True)
+        else:
+            pool = None
 
-                for k in jobs[i+1-cpu:(i+1)]:
-                    k.join()
+        def _evaluate(positions):
+            result = []
 
-            elif (i+1) == len(jobs) and (i+1)%cpu != 0:
-                # Wait for the last processes to finish if number of processes is not a multiple
-                # of *cpu*
+            if pool is None:
+                for i, pos in enumerate(positions):
+                    progress(i, len(positions), "Running ContrastCurveModule...")
+                    result.append(_contrast_limit(pos))
 
-                for k in jobs[(i + 1 - (i+1)%cpu):]:
-                    k.join()
+            else:
+                for i, item in enumerate(imap_function_pool(pool, positions)):
+                    progress(i, len(positions), "Running ContrastCurveModule...")
+                    result.append(item)
 
-            progress(i, len(jobs), "Running ContrastCurveModule...")
+            return result
 
-        # Send termination sentinel to queue
-        queue.put(None)
+        try:
+            if self.m_adaptive is None:
+                positions = []
+                for sep in pos_r:
+                    for ang in pos_t:
+                        positions.append((sep, ang))
 
-        while True:
-            item = queue.get()
+                result = _evaluate(positions)
 
-            if item is None:
-                break
             else:
-                result.append(item)
+                result = self._adaptive_sampling(pos_r, pos_t, _evaluate)
 
-        os.remove(tmp_im_str)
-        os.remove(tmp_psf_str)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
 
         result = np.asarray(result)
 
@@ -299,13 +371,34 @@ class ContrastCurveModule(ProcessingModule):
         indices = np.lexsort((result[:, 1], result[:, 0]))
         result = result[indices]
 
-        result = result.reshape((pos_r.size, pos_t.size, 4))
+        if self.m_throughput_out_port is not None:
+            self.m_throughput_out_port.set_all(np.column_stack((result[:, 0]*pixscale,
+                                                                result[:, 1],
+                                                                result[:, 4])), data_dim=2)
+
+        if self.m_adaptive is None:
+            result = result.reshape((pos_r.size, pos_t.size, 5))
 
-        mag_mean = np.nanmean(result, axis=1)[:, 2]
-        mag_var = np.nanvar(result, axis=1)[:, 2]
-        res_fpf = result[:, 0, 3]
+            mag_mean = np.nanmean(result, axis=1)[:, 2]
+            mag_var = np.nanvar(result, axis=1)[:, 2]
+            res_fpf = result[:, 0, 3]
 
-        limits = np.column_stack((pos_r*pixscale, mag_mean, mag_var, res_fpf))
+            limits = np.column_stack((pos_r*pixscale, mag_mean, mag_var, res_fpf))
+
+        else:
+            limits = []
+
+            for sep in np.unique(result[:, 0]):
+                select = result[result[:, 0] == sep]
+                mag_mean, mag_error = self._mean_error(select[:, 2])
+
+                limits.append((sep*pixscale,
+                               mag_mean,
+                               np.nanvar(select[:, 2]),
+                               select[0, 3],
+                               mag_error))
+
+            limits = np.asarray(limits)
 
         self.m_contrast_out_port.set_all(limits, data_dim=2)
 
@@ -316,4 +409,157 @@ class ContrastCurveModule(ProcessingModule):
 
         self.m_contrast_out_port.add_history("ContrastCurveModule", history)
         self.m_contrast_out_port.copy_attributes(self.m_image_in_port)
+
+        if self.m_throughput_out_port is not None:
+            self.m_throughput_out_port.add_history("ContrastCurveModule", history)
+            self.m_throughput_out_port.copy_attributes(self.m_image_in_port)
         self.m_contrast_out_port.close_port()
+
+    @staticmethod
+    def _angle_order(pos_t):
+        """
+        Internal function which determines the order in which the position angles are
+        evaluated by the adaptive sampling. Each next angle is the one furthest away from the
+        angles that precede it, such that the first angles are spread over the full circle.
+
+        Parameters
+        ----------
+        pos_t : numpy.ndarray
+            Position angles (deg).
+
+        Returns
+        -------
+        list(int, )
+            Indices of the position angles in the order of evaluation.
+        """
+
+        order = [0]
+
+        dist = np.abs(pos_t-pos_t[0]) % 360.
+        dist = np.minimum(dist, 360.-dist)
+        dist[0] = -1.
+
+        while len(order) < pos_t.size:
+            index = int(np.argmax(dist))
+            order.append(index)
+
+            new_dist = np.abs(pos_t-pos_t[index]) % 360.
+            dist = np.minimum(dist, np.minimum(new_dist, 360.-new_dist))
+            dist[order] = -1.
+
+        return order
+
+    @staticmethod
+    def _mean_error(contrast):
+        """
+        Internal function which calculates the mean contrast and the standard error of the mean,
+        ignoring the positions for which the contrast could not be determined.
+
+        Parameters
+        ----------
+        contrast : list(float, )
+            Contrast (mag) at the evaluated position angles of a separation.
+
+        Returns
+        -------
+        float
+            Mean contrast (mag). NaN if there are no valid values.
+        float
+            Standard error of the mean contrast (mag). NaN if there are fewer than two valid
+            values.
+        """
+
+        contrast = np.asarray(contrast)
+        contrast = contrast[np.isfinite(contrast)]
+
+        if contrast.size == 0:
+            return np.nan, np.nan
+
+        if contrast.size == 1:
+            return contrast[0], np.nan
+
+        return np.mean(contrast), np.std(contrast, ddof=1)/np.sqrt(contrast.size)
+
+    def _adaptive_sampling(self,
+                           pos_r,
+                           pos_t,
+                           evaluate):
+        """
+        Internal function which evaluates the contrast on an adaptive subset of the separations
+        and position angles (see the *adaptive* parameter of the constructor). The positions
+        are processed in rounds, such that the positions of a round are distributed over the
+        worker processes.
+
+        Parameters
+        ----------
+        pos_r : numpy.ndarray
+            Separations (pix) of the full grid.
+        pos_t : numpy.ndarray
+            Position angles (deg) of the full grid.
+        evaluate : function
+            Function which returns the output of :func:`~pynpoint.util.limits.contrast_limit`
+            for a list of positions, given as (separation, angle) tuples.
+
+        Returns
+        -------
+        list(tuple, )
+            Output of :func:`~pynpoint.util.limits.contrast_limit` for all evaluated positions.
+        """
+
+        order = self._angle_order(pos_t)
+        n_batch = min(3, pos_t.size)
+
+        # the output contains the separation of the position so it can be mapped to the index of
+        # the separation when the positions are returned in a different order by the workers
+        sep_index = dict(zip(pos_r, range(pos_r.size)))
+
+        n_angles = {}
+        contrast = {}
+        result = []
+
+        pending = list(range(0, pos_r.size, 4))
+
+        if pos_r.size-1 not in pending:
+            pending.append(pos_r.size-1)
+
+        while pending:
+            for k in pending:
+                n_angles[k] = 0
+                contrast[k] = []
+
+            active = pending
+
+            # add position angles until the mean contrast has converged
+            while active:
+                positions = []
+
+                for k in active:
+                    for index in order[n_angles[k]:n_angles[k]+n_batch]:
+                        positions.append((pos_r[k], pos_t[index]))
+
+                    n_angles[k] = min(n_angles[k]+n_batch, pos_t.size)
+
+                for item in evaluate(positions):
+                    contrast[sep_index[item[0]]].append(item[2])
+                    result.append(item)
+
+                active = [k for k in active if n_angles[k] < pos_t.size and
+                          not self._mean_error(contrast[k])[1] <= self.m_adaptive]
+
+            # refine the separations between neighbours with a large difference in contrast or
+            # a large uncertainty of the contrast
+            evaluated = sorted(n_angles)
+            pending = []
+
+            for k_in, k_out in zip(evaluated[:-1], evaluated[1:]):
+                if k_out-k_in < 2:
+                    continue
+
+                mean_in, error_in = self._mean_error(contrast[k_in])
+                mean_out, error_out = self._mean_error(contrast[k_out])
+
+                if abs(mean_in-mean_out) > self.m_adaptive or error_in > self.m_adaptive or \
+                   error_out > self.m_adaptive:
+                    pending.append((k_in+k_out)//2)
+
+        return result
@@ -75,6 +75,7 @@ class PSFpreparationModule(ProcessingModule):
             self.m_mask_out_port = None
 
         self.m_image_out_port = self.add_output_port(image_out_tag)
+        self.m_image_out_port.set_growth("double")
 
         self.m_resize = resize
         self.m_cent_size = cent_size
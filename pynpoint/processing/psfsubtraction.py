@@ -12,14 +12,13 @@ from copy import deepcopy
 
 import numpy as np
 
-from scipy.ndimage import rotate
-from sklearn.decomposition import PCA
-
 from pynpoint.core.processing import ProcessingModule
+from pynpoint.util.image import center_subpixel, rotate_images
 from pynpoint.util.module import progress
 from pynpoint.util.multipca import PcaMultiprocessingCapsule
-from pynpoint.util.psf import pca_psf_subtraction
-from pynpoint.util.residuals import combine_residuals
+from pynpoint.util.multiproc import frame_pool, apply_function_pool, map_function_pool
+from pynpoint.util.psf import PcaResiduals, create_pca
+from pynpoint.util.residuals import combine_residuals, StreamingMedian
 
 
 class PcaPsfSubtractionModule(ProcessingModule):
@@ -42,7 +41,10 @@ class PcaPsfSubtractionModule(ProcessingModule):
                  res_arr_out_tag=None,
                  basis_out_tag=None,
                  extra_rot=0.,
-                 subtract_mean=True):
+                 subtract_mean=True,
+                 solver="arpack",
+                 out_of_core=False,
+                 interpolation="spline"):
         """
         Constructor of PcaPsfSubtractionModule.
 
@@ -80,6 +82,25 @@ class PcaPsfSubtractionModule(ProcessingModule):
         subtract_mean : bool
             The mean of the science and reference images is subtracted from the corresponding
             stack, before the PCA basis is constructed and fitted.
+        solver : str
+            Algorithm that constructs the PCA basis: "arpack" (truncated singular value
+            decomposition), "randomized" (randomized singular value decomposition), "gram"
+            (eigendecomposition of the Gram matrix, fastest if the number of images is smaller
+            than the number of pixels), or "incremental" (incremental PCA in batches of images).
+            The basis of the randomized solver is an approximation, which is accurate for the
+            components with the largest variance.
+        out_of_core : bool
+            Process the science and reference images in blocks of MEMORY images instead of
+            loading the full stacks into memory, such that datasets larger than the available
+            memory can be reduced. The PCA basis is constructed with an incremental PCA, so the
+            *solver* is not used. Only the mean and median residuals and the residuals of the
+            individual images (*res_arr_out_tag*) are supported. The median residuals require
+            several passes through the science images (see
+            :class:`~pynpoint.util.residuals.StreamingMedian`).
+        interpolation : str
+            Interpolation of the derotated residuals ("spline", "bilinear", or "bicubic"). The
+            bilinear and bicubic interpolation are considerably faster than the (default) spline
+            interpolation (see :func:`~pynpoint.util.image.rotate_images`).
 
         Returns
         -------
@@ -93,7 +114,18 @@ class PcaPsfSubtractionModule(ProcessingModule):
         self.m_extra_rot = extra_rot
         self.m_subtract_mean = subtract_mean
 
-        self.m_pca = PCA(n_components=np.amax(self.m_components), svd_solver="arpack")
+        self.m_out_of_core = out_of_core
+        self.m_interpolation = interpolation
+
+        if self.m_out_of_core:
+            if res_weighted_tag is not None or res_rot_mean_clip_tag is not None:
+                raise ValueError("Only the mean and median residuals and the residuals of the "
+                                 "individual images can be created with out_of_core=True.")
+
+            self.m_pca = create_pca(np.amax(self.m_components), solver="incremental")
+
+        else:
+            self.m_pca = create_pca(np.amax(self.m_components), solver=solver)
 
         self.m_reference_in_port = self.add_input_port(reference_in_tag)
         self.m_star_in_port = self.add_input_port(images_in_tag)
@@ -165,10 +197,11 @@ class PcaPsfSubtractionModule(ProcessingModule):
                                                 self._m_config_port.get_attribute("CPU"),
                                                 deepcopy(self.m_components),
                                                 deepcopy(self.m_pca),
-                                                deepcopy(star_reshape),
+                                                star_reshape,
                                                 deepcopy(angles),
                                                 im_shape,
-                                                indices)
+                                                indices,
+                                                interpolation=self.m_interpolation)
 
         pca_capsule.run()
 
@@ -183,17 +216,20 @@ class PcaPsfSubtractionModule(ProcessingModule):
             None
         """
 
+        parang = -1.*self.m_star_in_port.get_attribute("PARANG") + self.m_extra_rot
+
+        # the residuals are updated incrementally from one PC number to the next
+        pca_residuals = PcaResiduals(images=star_reshape,
+                                     pca_sklearn=self.m_pca,
+                                     im_shape=im_shape,
+                                     indices=indices)
+
         for i, pca_number in enumerate(self.m_components):
             progress(i, len(self.m_components), "Creating residuals...")
 
-            parang = -1.*self.m_star_in_port.get_attribute("PARANG") + self.m_extra_rot
-
-            residuals, res_rot = pca_psf_subtraction(images=star_reshape,
-                                                     angles=parang,
-                                                     pca_number=pca_number,
-                                                     pca_sklearn=self.m_pca,
-                                                     im_shape=im_shape,
-                                                     indices=indices)
+            residuals, res_rot = pca_residuals.subtract(pca_number,
+                                                        parang,
+                                                        interpolation=self.m_interpolation)
 
             hist = "max PC number = "+str(np.amax(self.m_components))
 
@@ -252,12 +288,9 @@ class PcaPsfSubtractionModule(ProcessingModule):
                 self.m_res_arr_out_ports[pca_number].del_all_data()
                 self.m_res_arr_out_ports[pca_number].del_all_attributes()
 
-    def run(self):
+    def _write_basis(self, im_shape, indices):
         """
-        Run method of the module. Subtracts the mean of the image stack from all images, reshapes
-        the stack of images into a 2D array, uses singular value decomposition to construct the
-        orthogonal basis set, calculates the PCA coefficients for each image, subtracts the PSF
-        model, and writes the residuals as output.
+        Internal function to write the PCA basis in the original image shape.
 
         Returns
         -------
@@ -265,15 +298,201 @@ class PcaPsfSubtractionModule(ProcessingModule):
             None
         """
 
-        cpu = self._m_config_port.get_attribute("CPU")
+        pc_size = self.m_pca.components_.shape[0]
 
-        if cpu > 1 and self.m_res_arr_out_ports is not None:
-            warnings.warn("Multiprocessing not possible if 'res_arr_out_tag' is not set to None.")
+        basis = np.zeros((pc_size, im_shape[1]*im_shape[2]))
+        basis[:, indices] = self.m_pca.components_
+        basis = basis.reshape((pc_size, im_shape[1], im_shape[2]))
 
-        self._clear_output_ports()
+        self.m_basis_out_port.set_all(basis)
+
+    def _fit_out_of_core(self, indices):
+        """
+        Internal function to construct the PCA basis with an incremental PCA, by streaming the
+        reference images in blocks of MEMORY images from the database. The last block is
+        combined with the previous block if it contains fewer images than principal components.
+
+        Returns
+        -------
+        numpy.ndarray
+            Mean of the reference images.
+        """
+
+        memory = self._m_config_port.get_attribute("MEMORY")
+        n_components = np.amax(self.m_components)
+
+        if 0 < memory < n_components:
+            memory = n_components
+
+        block = None
+
+        for images in self.m_reference_in_port.iter_blocks(memory):
+            images = images.reshape(images.shape[0], -1)[:, indices]
+
+            if block is None:
+                block = images
+
+            elif images.shape[0] < n_components:
+                block = np.concatenate((block, images), axis=0)
+
+            else:
+                self.m_pca.partial_fit(block)
+                block = images
+
+        self.m_pca.partial_fit(block)
+
+        # the incremental PCA subtracts the mean of the reference images internally
+        mean_ref = self.m_pca.mean_
+        self.m_pca.mean_ = np.zeros(mean_ref.shape)
+
+        return mean_ref
+
+    def _run_out_of_core(self):
+        """
+        Internal function to construct the PCA basis and create the residuals without loading
+        the stacks of science and reference images into memory. The images are processed in
+        blocks of MEMORY images, with the residuals of all PC numbers created in a single pass
+        through the science images. Additional passes are required for the median residuals.
+
+        Returns
+        -------
+        NoneType
+            None
+        """
+
+        memory = self._m_config_port.get_attribute("MEMORY")
+        im_shape = self.m_star_in_port.get_shape()
+
+        if self.m_reference_in_port.get_shape()[-2:] != im_shape[-2:]:
+            raise ValueError("The image size of the science data and the reference data "
+                             "should be identical.")
+
+        # select the first image and get the unmasked image indices
+        indices = np.where(self.m_star_in_port[0, ].reshape(-1) != 0.)[0]
+
+        sys.stdout.write("Constructing PSF model...")
+        sys.stdout.flush()
+
+        mean_ref = self._fit_out_of_core(indices)
+
+        # mean of the science images, which is required before the residuals are created
+        if not self.m_subtract_mean:
+            mean_star = None
+
+        elif self.m_reference_in_port.tag == self.m_star_in_port.tag:
+            mean_star = mean_ref
+
+        else:
+            mean_star = np.zeros(indices.shape)
+
+            for images in self.m_star_in_port.iter_blocks(memory):
+                images = images.reshape(images.shape[0], -1)[:, indices]
+                mean_star += np.sum(images, axis=0)
+
+            mean_star /= float(im_shape[0])
+
+        # add mean of reference array as 1st PC and orthogonalize it with respect to the PCA basis
+        if not self.m_subtract_mean:
+            mean_ref_reshape = mean_ref.reshape((1, mean_ref.shape[0]))
+
+            q_ortho, _ = np.linalg.qr(np.vstack((mean_ref_reshape,
+                                                 self.m_pca.components_[:-1, ])).T)
+
+            self.m_pca.components_ = q_ortho.T
+
+        sys.stdout.write(" [DONE]\n")
+        sys.stdout.flush()
+
+        if self.m_basis_out_port is not None:
+            self._write_basis(im_shape, indices)
+
+        parang = -1.*self.m_star_in_port.get_attribute("PARANG") + self.m_extra_rot
+        hist = "max PC number = "+str(np.amax(self.m_components))
+
+        def _residual_blocks(active):
+            start = 0
+
+            for images in self.m_star_in_port.iter_blocks(memory):
+                progress(start, im_shape[0], "Creating residuals...")
+
+                nimages = images.shape[0]
+
+                images = images.reshape(nimages, -1)[:, indices]
+
+                if mean_star is not None:
+                    images = images - mean_star
+
+                pca_residuals = PcaResiduals(images=images,
+                                             pca_sklearn=self.m_pca,
+                                             im_shape=(nimages, im_shape[1], im_shape[2]),
+                                             indices=indices)
+
+                for i, pca_number in enumerate(self.m_components):
+                    # the residuals are only created for the PC numbers that are still required
+                    if not active[i]:
+                        continue
+
+                    _, res_rot = pca_residuals.subtract(pca_number,
+                                                        parang[start:start+nimages],
+                                                        interpolation=self.m_interpolation)
+
+                    yield i, pca_number, res_rot
+
+                start += nimages
+
+            sys.stdout.write("Creating residuals... [DONE]\n")
+            sys.stdout.flush()
+
+        res_sum = np.zeros((len(self.m_components), im_shape[1], im_shape[2]))
+
+        if self.m_res_median_out_port is None:
+            medians = []
+        else:
+            medians = [StreamingMedian(im_shape[0]) for _ in self.m_components]
+
+        for i, pca_number, res_rot in _residual_blocks([True]*len(self.m_components)):
+            res_sum[i, ] += np.sum(res_rot, axis=0)
+
+            if medians:
+                medians[i].update(res_rot)
+
+            if self.m_res_arr_out_ports is not None:
+                self.m_res_arr_out_ports[pca_number].append(res_rot, data_dim=3)
+
+        # the median residuals require several passes through the science images
+        active = [median.next_pass() for median in medians]
+
+        while any(active):
+            for i, _, res_rot in _residual_blocks(active):
+                medians[i].update(res_rot)
+
+            active = [active[i] and median.next_pass() for i, median in enumerate(medians)]
+
+        if self.m_res_arr_out_ports is not None:
+            for pca_number in self.m_components:
+                self.m_res_arr_out_ports[pca_number].copy_attributes(self.m_star_in_port)
+                self.m_res_arr_out_ports[pca_number].add_history("PcaPsfSubtractionModule", hist)
+
+        if self.m_res_mean_out_port is not None:
+            self.m_res_mean_out_port.set_all(res_sum/float(im_shape[0]), data_dim=3)
+
+        if self.m_res_median_out_port is not None:
+            stack = np.array([median.get_median() for median in medians])
+            self.m_res_median_out_port.set_all(stack, data_dim=3)
+
+    def _run_in_memory(self, cpu):
+        """
+        Internal function to construct the PCA basis and create the residuals with the full
+        stacks of science and reference images in memory.
+
+        Returns
+        -------
+        NoneType
+            None
+        """
 
         # get all data
-        star_data = self.m_star_in_port.get_all()
+        star_data = self.m_star_in_port.get_memmap()
         im_shape = star_data.shape
 
         # select the first image and get the unmasked image indices
@@ -288,7 +507,7 @@ class PcaPsfSubtractionModule(ProcessingModule):
             ref_reshape = deepcopy(star_reshape)
 
         else:
-            ref_data = self.m_reference_in_port.get_all()
+            ref_data = self.m_reference_in_port.get_memmap()
             ref_shape = ref_data.shape
 
             if ref_shape[-2:] != im_shape[-2:]:
@@ -327,13 +546,7 @@ class PcaPsfSubtractionModule(ProcessingModule):
         sys.stdout.flush()
 
         if self.m_basis_out_port is not None:
-            pc_size = self.m_pca.components_.shape[0]
-
-            basis = np.zeros((pc_size, im_shape[1]*im_shape[2]))
-            basis[:, indices] = self.m_pca.components_
-            basis = basis.reshape((pc_size, im_shape[1], im_shape[2]))
-
-            self.m_basis_out_port.set_all(basis)
+            self._write_basis(im_shape, indices)
 
         if cpu == 1 or self.m_res_arr_out_ports is not None:
             self._run_single_processing(star_reshape, im_shape, indices)
@@ -347,6 +560,32 @@ class PcaPsfSubtractionModule(ProcessingModule):
             sys.stdout.write(" [DONE]\n")
             sys.stdout.flush()
 
+    def run(self):
+        """
+        Run method of the module. Subtracts the mean of the image stack from all images, reshapes
+        the stack of images into a 2D array, uses singular value decomposition to construct the
+        orthogonal basis set, calculates the PCA coefficients for each image, subtracts the PSF
+        model, and writes the residuals as output.
+
+        Returns
+        -------
+        NoneType
+            None
+        """
+
+        cpu = self._m_config_port.get_attribute("CPU")
+
+        if cpu > 1 and self.m_res_arr_out_ports is not None:
+            warnings.warn("Multiprocessing not possible if 'res_arr_out_tag' is not set to None.")
+
+        self._clear_output_ports()
+
+        if self.m_out_of_core:
+            self._run_out_of_core()
+
+        else:
+            self._run_in_memory(cpu)
+
         history = "max PC number = "+str(np.amax(self.m_components))
 
         # save history for all other ports
@@ -369,6 +608,478 @@ class PcaPsfSubtractionModule(ProcessingModule):
         self.m_star_in_port.close_port()
 
 
+class AnnulusPcaPsfSubtractionModule(ProcessingModule):
+    """
+    Module for PSF subtraction with local principal component analysis (PCA). The images are
+    divided into annuli, and optionally azimuthal sectors, and a separate PCA basis is constructed
+    for each region. The regions contain far fewer pixels than the full images so the basis is
+    cheaper to construct and describes the local structure of the PSF. The regions are processed
+    in parallel if CPU > 1 in the configuration file.
+    """
+
+    def __init__(self,
+                 pca_numbers,
+                 name_in="annulus_pca",
+                 images_in_tag="im_arr",
+                 reference_in_tag="im_arr",
+                 res_out_tag="res_annulus",
+                 residuals="mean",
+                 annulus_width=0.1,
+                 sectors=1,
+                 extra_rot=0.,
+                 subtract_mean=True,
+                 solver="arpack",
+                 interpolation="spline"):
+        """
+        Constructor of AnnulusPcaPsfSubtractionModule.
+
+        Parameters
+        ----------
+        pca_numbers : int or tuple(int, )
+            Number of principal components used for the PSF model. Can be a single value or a tuple
+            with integers. The number of principal components is limited by the number of images
+            and pixels in each region.
+        name_in : str
+            Unique name of the module instance.
+        images_in_tag : str
+            Tag of the database entry with the science images that are read as input.
+        reference_in_tag : str
+            Tag of the database entry with the reference images that are read as input.
+        res_out_tag : str
+            Tag of the database entry with the combined residuals, one image for each number of
+            principal components, that are written as output.
+        residuals : str
+            Method used for combining the residuals ("mean", "median", "weighted", or "clipped").
+        annulus_width : float
+            Width of the annuli (arcsec).
+        sectors : int
+            Number of azimuthal sectors of each annulus.
+        extra_rot : float
+            Additional rotation angle of the images (deg).
+        subtract_mean : bool
+            The mean of the science and reference images is subtracted from the corresponding
+            stack, before the PCA basis is constructed and fitted.
+        solver : str
+            Algorithm that constructs the PCA basis of each region (see
+            :func:`~pynpoint.util.psf.create_pca`).
+        interpolation : str
+            Interpolation of the derotated residuals (see
+            :func:`~pynpoint.util.image.rotate_images`).
+
+        Returns
+        -------
+        NoneType
+            None
+        """
+
+        super(AnnulusPcaPsfSubtractionModule, self).__init__(name_in)
+
+        if sectors < 1:
+            raise ValueError("The number of sectors should be a positive integer.")
+
+        # checks the name of the solver
+        create_pca(1, solver=solver)
+
+        self.m_components = np.sort(np.atleast_1d(pca_numbers))
+        self.m_residuals = residuals
+        self.m_annulus_width = annulus_width
+        self.m_sectors = sectors
+        self.m_extra_rot = extra_rot
+        self.m_subtract_mean = subtract_mean
+        self.m_solver = solver
+        self.m_interpolation = interpolation
+
+        self.m_reference_in_port = self.add_input_port(reference_in_tag)
+        self.m_star_in_port = self.add_input_port(images_in_tag)
+        self.m_res_out_port = self.add_output_port(res_out_tag)
+
+    def _regions(self, im_shape, indices):
+        """
+        Internal function which divides the non-masked pixels into annuli and sectors.
+
+        Parameters
+        ----------
+        im_shape : tuple(int, int, int)
+            Shape of the stack of images.
+        indices : numpy.ndarray
+            Non-masked image indices.
+
+        Returns
+        -------
+        list(numpy.ndarray, )
+            Image indices of each region that contains non-masked pixels.
+        """
+
+        pixscale = self.m_star_in_port.get_attribute("PIXSCALE")
+        width = self.m_annulus_width/pixscale
+
+        center = center_subpixel(np.zeros(im_shape[-2:]))
+
+        y_grid, x_grid = np.indices(im_shape[-2:])
+        y_grid = y_grid.reshape(-1)[indices] - center[0]
+        x_grid = x_grid.reshape(-1)[indices] - center[1]
+
+        annulus = np.floor(np.sqrt(x_grid**2+y_grid**2)/width).astype(int)
+
+        theta = np.mod(np.arctan2(y_grid, x_grid), 2.*np.pi)
+        sector = np.floor(theta/(2.*np.pi/self.m_sectors)).astype(int)
+        sector = np.clip(sector, 0, self.m_sectors-1)
+
+        region = annulus*self.m_sectors + sector
+
+        regions = []
+        for item in np.unique(region):
+            regions.append(indices[region == item])
+
+        return regions
+
+    def run(self):
+        """
+        Run method of the module. Divides the images into annuli and sectors, constructs the PCA
+        basis and creates the residuals for each region separately, derotates the residuals, and
+        writes the combined residuals for each number of principal components.
+
+        Returns
+        -------
+        NoneType
+            None
+        """
+
+        def _region_residuals(region):
+            index = regions[region]
+
+            star = star_reshape[:, index]
+            ref = ref_reshape[:, index]
+
+            if self.m_subtract_mean:
+                star = star - np.mean(star, axis=0)
+
+            mean_ref = np.mean(ref, axis=0)
+            ref = ref - mean_ref
+
+            # the number of principal components is limited by the size of the region
+            pca_max = min(np.amax(self.m_components), ref.shape[0]-1, index.size-1)
+
+            if pca_max < 1:
+                return np.repeat(star[np.newaxis, ], self.m_components.size, axis=0)
+
+            pca_sklearn = create_pca(pca_max, solver=self.m_solver)
+            pca_sklearn.fit(ref)
+
+            # add mean of reference array as 1st PC and orthogonalize it with respect to the basis
+            if not self.m_subtract_mean:
+                q_ortho, _ = np.linalg.qr(np.vstack((mean_ref[np.newaxis, ],
+                                                     pca_sklearn.components_[:-1, ])).T)
+
+                pca_sklearn.components_ = q_ortho.T
+
+            pca_residuals = PcaResiduals(images=star,
+                                         pca_sklearn=pca_sklearn,
+                                         im_shape=im_shape,
+                                         indices=index)
+
+            result = np.zeros((self.m_components.size, star.shape[0], index.size))
+
+            for i, pca_number in enumerate(self.m_components):
+                result[i, ] = pca_residuals.get_residuals(min(pca_number, pca_max))
+
+            return result
+
+        cpu = self._m_config_port.get_attribute("CPU")
+
+        star_data = self.m_star_in_port.get_memmap()
+        im_shape = star_data.shape
+
+        # select the first image and get the unmasked image indices
+        indices = np.where(star_data[0, ].reshape(-1) != 0.)[0]
+
+        star_reshape = star_data.reshape(im_shape[0], im_shape[1]*im_shape[2])
+
+        if self.m_reference_in_port.tag == self.m_star_in_port.tag:
+            ref_reshape = star_reshape
+
+        else:
+            ref_data = self.m_reference_in_port.get_memmap()
+
+            if ref_data.shape[-2:] != im_shape[-2:]:
+                raise ValueError("The image size of the science data and the reference data "
+                                 "should be identical.")
+
+            ref_reshape = ref_data.reshape(ref_data.shape[0], im_shape[1]*im_shape[2])
+
+        regions = self._regions(im_shape, indices)
+
+        sys.stdout.write("Creating residuals of "+str(len(regions))+" regions...")
+        sys.stdout.flush()
+
+        if cpu > 1:
+            pool = frame_pool(cpu, _region_residuals, None)
+        else:
+            pool = None
+
+        if pool is None:
+            results = [_region_residuals(i) for i in range(len(regions))]
+
+        else:
+            try:
+                results = map_function_pool(pool, list(range(len(regions))))
+
+            finally:
+                pool.close()
+                pool.join()
+
+        residuals = np.zeros((self.m_components.size, im_shape[0], im_shape[1]*im_shape[2]))
+
+        for i, result in enumerate(results):
+            residuals[:, :, regions[i]] = result
+
+        residuals = residuals.reshape((self.m_components.size, ) + im_shape)
+
+        sys.stdout.write(" [DONE]\n")
+        sys.stdout.flush()
+
+        parang = -1.*self.m_star_in_port.get_attribute("PARANG") + self.m_extra_rot
+
+        self.m_res_out_port.del_all_data()
+
+        for i in range(self.m_components.size):
+            progress(i, self.m_components.size, "Combining residuals...")
+
+            res_rot = rotate_images(residuals[i, ],
+                                    parang,
+                                    interpolation=self.m_interpolation,
+                                    threads=cpu)
+
+            stack = combine_residuals(method=self.m_residuals,
+                                      res_rot=res_rot,
+                                      residuals=residuals[i, ],
+                                      angles=parang)
+
+            self.m_res_out_port.append(stack, data_dim=3)
+
+        sys.stdout.write("Combining residuals... [DONE]\n")
+        sys.stdout.flush()
+
+        history = "max PC number = "+str(np.amax(self.m_components))+", regions = " + \
+                  str(len(regions))
+
+        self.m_res_out_port.copy_attributes(self.m_star_in_port)
+        self.m_res_out_port.add_history("AnnulusPcaPsfSubtractionModule", history)
+        self.m_res_out_port.close_port()
+
+
+class FrameRejectionPcaModule(ProcessingModule):
+    """
+    Module for PSF subtraction with principal component analysis (PCA) in which the reference
+    library of each image only contains the images with sufficient field rotation, to limit the
+    self-subtraction of a companion at a given separation. The Gram matrix of the images is
+    computed once and the PCA basis of each reference library is derived from the eigenvectors
+    of the corresponding part of the Gram matrix, which is reused by consecutive images with the
+    same reference library. The images are processed in parallel if CPU > 1 in the configuration
+    file.
+    """
+
+    def __init__(self,
+                 pca_numbers,
+                 threshold,
+                 name_in="rejection_pca",
+                 image_in_tag="im_arr",
+                 res_out_tag="res_rejection",
+                 residuals="mean",
+                 extra_rot=0.,
+                 interpolation="spline"):
+        """
+        Constructor of FrameRejectionPcaModule.
+
+        Parameters
+        ----------
+        pca_numbers : int or tuple(int, )
+            Number of principal components used for the PSF model. Can be a single value or a tuple
+            with integers. The number of principal components is limited by the size of the
+            reference library of each image.
+        threshold : tuple(float, float, float)
+            Tuple with the separation for which the angle threshold is optimized (arcsec), FWHM of
+            the PSF (arcsec), and the threshold (FWHM) for the field rotation between an image and
+            its reference images.
+        name_in : str
+            Unique name of the module instance.
+        image_in_tag : str
+            Tag of the database entry with the science images that are read as input. The mean of
+            the images is subtracted before the PSF subtraction.
+        res_out_tag : str
+            Tag of the database entry with the combined residuals, one image for each number of
+            principal components, that are written as output.
+        residuals : str
+            Method used for combining the residuals ("mean", "median", "weighted", or "clipped").
+        extra_rot : float
+            Additional rotation angle of the images (deg).
+        interpolation : str
+            Interpolation of the derotated residuals (see
+            :func:`~pynpoint.util.image.rotate_images`).
+
+        Returns
+        -------
+        NoneType
+            None
+        """
+
+        super(FrameRejectionPcaModule, self).__init__(name_in)
+
+        self.m_components = np.sort(np.atleast_1d(pca_numbers))
+        self.m_threshold = threshold
+        self.m_residuals = residuals
+        self.m_extra_rot = extra_rot
+        self.m_interpolation = interpolation
+
+        self.m_image_in_port = self.add_input_port(image_in_tag)
+        self.m_res_out_port = self.add_output_port(res_out_tag)
+
+    def run(self):
+        """
+        Run method of the module. Selects the reference images of each image with the rotation
+        threshold, creates the residuals of each image with the PCA basis of its reference
+        library, derotates the residuals, and writes the combined residuals for each number of
+        principal components.
+
+        Returns
+        -------
+        NoneType
+            None
+        """
+
+        # eigendecomposition of the most recent reference library of the process
+        cache = {}
+
+        def _reference_basis(select):
+            key = select.tobytes()
+
+            if key not in cache:
+                index = np.where(select)[0]
+                nref = index.size
+
+                # Gram matrix of the mean-subtracted reference images
+                center = np.eye(nref) - 1./float(nref)
+                gram_ref = np.matmul(center, np.matmul(gram[np.ix_(index, index)], center))
+
+                # the number of principal components is limited by the size of the library
+                pca_max = min(np.amax(self.m_components), nref-1)
+
+                eigen_val, eigen_vec = np.linalg.eigh(gram_ref)
+
+                eigen_val = eigen_val[::-1][:pca_max]
+                eigen_vec = eigen_vec[:, ::-1][:, :pca_max]
+
+                # components without variance are not used
+                sing_val = np.sqrt(np.clip(eigen_val, 0., None))
+                scale = np.zeros(sing_val.shape)
+                valid = sing_val > sing_val[0]*1e-12
+                scale[valid] = 1./sing_val[valid]
+
+                # principal components as linear combinations of the reference images
+                cache.clear()
+                cache[key] = (index, np.matmul(center, eigen_vec)*scale)
+
+            return cache[key]
+
+        def _frame_residuals(frame):
+            index, basis = _reference_basis(references[frame, ])
+
+            # PCA coefficients of the image
+            coeff = np.matmul(gram[frame, index], basis)
+
+            weights = np.zeros((self.m_components.size, index.size))
+
+            for i, pca_number in enumerate(self.m_components):
+                pca_number = min(pca_number, basis.shape[1])
+                weights[i, ] = np.matmul(basis[:, :pca_number], coeff[:pca_number])
+
+            return images[frame, ] - np.matmul(weights, images[index, ])
+
+        cpu = self._m_config_port.get_attribute("CPU")
+        parang = self.m_image_in_port.get_attribute("PARANG")
+
+        parang_thres = 2.*math.atan2(self.m_threshold[2]*self.m_threshold[1],
+                                     2.*self.m_threshold[0])
+        parang_thres = math.degrees(parang_thres)
+
+        # reference images of each image
+        references = np.abs(parang[:, np.newaxis]-parang[np.newaxis, :]) > parang_thres
+
+        nrej = np.sum(np.sum(references, axis=1) < 2)
+
+        if nrej > 0:
+            warnings.warn("The rotation threshold is not met for %s images. All images are used "
+                          "as reference for these images instead." % nrej)
+
+            references[np.sum(references, axis=1) < 2, ] = True
+
+        star_data = self.m_image_in_port.get_memmap()
+        im_shape = star_data.shape
+
+        # select the first image and get the unmasked image indices
+        indices = np.where(star_data[0, ].reshape(-1) != 0.)[0]
+
+        images = star_data.reshape(im_shape[0], im_shape[1]*im_shape[2])[:, indices]
+        images = images - np.mean(images, axis=0)
+
+        sys.stdout.write("Creating residuals...")
+        sys.stdout.flush()
+
+        # Gram matrix of all images which is shared by the reference libraries
+        gram = np.matmul(images, images.T)
+
+        if cpu > 1:
+            pool = frame_pool(cpu, _frame_residuals, None)
+        else:
+            pool = None
+
+        if pool is None:
+            res_reshape = np.array([_frame_residuals(i) for i in range(im_shape[0])])
+
+        else:
+            try:
+                res_reshape = apply_function_pool(pool, np.arange(im_shape[0]))
+
+            finally:
+                pool.close()
+                pool.join()
+
+        sys.stdout.write(" [DONE]\n")
+        sys.stdout.flush()
+
+        angles = -1.*parang + self.m_extra_rot
+
+        self.m_res_out_port.del_all_data()
+
+        for i in range(self.m_components.size):
+            progress(i, self.m_components.size, "Combining residuals...")
+
+            residuals = np.zeros((im_shape[0], im_shape[1]*im_shape[2]))
+            residuals[:, indices] = res_reshape[:, i, :]
+            residuals = residuals.reshape(im_shape)
+
+            res_rot = rotate_images(residuals,
+                                    angles,
+                                    interpolation=self.m_interpolation,
+                                    threads=cpu)
+
+            stack = combine_residuals(method=self.m_residuals,
+                                      res_rot=res_rot,
+                                      residuals=residuals,
+                                      angles=angles)
+
+            self.m_res_out_port.append(stack, data_dim=3)
+
+        sys.stdout.write("Combining residuals... [DONE]\n")
+        sys.stdout.flush()
+
+        history = "threshold [deg] = "+'{0:.2f}'.format(parang_thres)
+
+        self.m_res_out_port.copy_attributes(self.m_image_in_port)
+        self.m_res_out_port.add_history("FrameRejectionPcaModule", history)
+        self.m_res_out_port.close_port()
+
+
 class ClassicalADIModule(ProcessingModule):
     """
     Module for PSF subtraction with classical ADI by subtracting a median-combined reference
@@ -497,9 +1208,7 @@ class ClassicalADIModule(ProcessingModule):
 
         im_res = self.m_res_inout_port.get_all()
 
-        res_rot = np.zeros(im_res.shape)
-        for i, item in enumerate(parang):
-            res_rot[i, ] = rotate(im_res[i, ], item, reshape=False)
+        res_rot = rotate_images(im_res, parang)
 
         stack = combine_residuals(self.m_residuals,
                                   res_rot,
@@ -77,17 +77,18 @@ class CropImagesModule(ProcessingModule):
 
         self.m_size = int(math.ceil(self.m_size/pixscale))
 
-        def _image_cutting(image_in,
+        def _image_cutting(images,
                            size,
                            center):
 
-            return crop_image(image_in, center, size)
+            return crop_image(images, center, size)
 
         self.apply_function_to_images(_image_cutting,
                                       self.m_image_in_port,
                                       self.m_image_out_port,
                                       "Running CropImagesModule...",
-                                      func_args=(self.m_size, self.m_center))
+                                      func_args=(self.m_size, self.m_center),
+                                      batch=True)
 
         history = "image size [pix] = "+str(self.m_size)
         self.m_image_out_port.add_history("CropImagesModule", history)
@@ -191,7 +192,8 @@ class ScaleImagesModule(ProcessingModule):
                                       "Running ScaleImagesModule...",
                                       func_args=(self.m_scaling_x,
                                                  self.m_scaling_y,
-                                                 self.m_scaling_flux,))
+                                                 self.m_scaling_flux,),
+                                      parallel=True)
 
         history = "scaling = ("+str("{:.2f}".format(self.m_scaling_x)) + ", " + \
                   str("{:.2f}".format(self.m_scaling_y)) + ", " + \
@@ -264,13 +266,14 @@ class AddLinesModule(ProcessingModule):
             warnings.warn("The dimensions of the output images %s are not equal. PynPoint only "
                           "supports square images." % str(shape_out))
 
-        def _add_lines(image_in):
-            image_out = np.zeros(shape_out)
+        def _add_lines(images):
+            images_out = np.zeros((images.shape[0], ) + shape_out)
 
-            image_out[int(self.m_lines[2]):int(self.m_lines[3]),
-                      int(self.m_lines[0]):int(self.m_lines[1])] = image_in
+            images_out[:,
+                       int(self.m_lines[2]):int(self.m_lines[3]),
+                       int(self.m_lines[0]):int(self.m_lines[1])] = images
 
-            return image_out
+            return images_out
 
         self.m_lines[1] = shape_out[1] - self.m_lines[1] # right side of image
         self.m_lines[3] = shape_out[0] - self.m_lines[3] # top side of image
@@ -278,7 +281,8 @@ class AddLinesModule(ProcessingModule):
         self.apply_function_to_images(_add_lines,
                                       self.m_image_in_port,
                                       self.m_image_out_port,
-                                      "Running AddLinesModule...")
+                                      "Running AddLinesModule...",
+                                      batch=True)
 
         history = "number of lines = "+str(self.m_lines)
         self.m_image_out_port.add_history("AddLinesModule", history)
@@ -334,16 +338,18 @@ class RemoveLinesModule(ProcessingModule):
             None
         """
 
-        def _remove_lines(image_in):
-            shape_in = image_in.shape
+        def _remove_lines(images):
+            shape_in = images.shape
 
-            return image_in[int(self.m_lines[2]):shape_in[0]-int(self.m_lines[3]),
-                            int(self.m_lines[0]):shape_in[1]-int(self.m_lines[1])]
+            return images[:,
+                          int(self.m_lines[2]):shape_in[1]-int(self.m_lines[3]),
+                          int(self.m_lines[0]):shape_in[2]-int(self.m_lines[1])]
 
         self.apply_function_to_images(_remove_lines,
                                       self.m_image_in_port,
                                       self.m_image_out_port,
-                                      "Running RemoveLinesModule...")
+                                      "Running RemoveLinesModule...",
+                                      batch=True)
 
         history = "number of lines = "+str(self.m_lines)
         self.m_image_out_port.add_history("RemoveLinesModule", history)
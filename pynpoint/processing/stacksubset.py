@@ -16,6 +16,7 @@ from six.moves import range
 from pynpoint.core.processing import ProcessingModule
 from pynpoint.util.module import progress, memory_frames
 from pynpoint.util.image import rotate_images
+from pynpoint.util.residuals import StreamingMean, StreamingMedian
 
 
 class StackAndSubsetModule(ProcessingModule):
@@ -399,7 +400,8 @@ class DerotateAndStackModule(ProcessingModule):
                  image_out_tag="im_stack",
                  derotate=True,
                  stack=None,
-                 extra_rot=0.):
+                 extra_rot=0.,
+                 interpolation="spline"):
         """
         Constructor of DerotateAndStackModule.
 
@@ -416,9 +418,17 @@ class DerotateAndStackModule(ProcessingModule):
             Derotate the images with the PARANG attribute.
         stack : str
             Type of stacking applied after optional derotation ("mean", "median", or None for no
-            stacking).
+            stacking). The images are read and derotated in blocks of MEMORY images. The median
+            requires several passes through the images (see
+            :class:`~pynpoint.util.residuals.StreamingMedian`) if the stack does not fit in a
+            single block, such that the memory usage remains within the MEMORY budget. Setting
+            MEMORY to 0 loads all images at once and computes the median in a single pass.
         extra_rot : float
             Additional rotation angle of the images in clockwise direction (deg).
+        interpolation : str
+            Interpolation of the derotated images ("spline", "bilinear", or "bicubic"). The
+            bilinear and bicubic interpolation are considerably faster than the (default) spline
+            interpolation and use CPU threads (see :func:`~pynpoint.util.image.rotate_images`).
 
         Returns
         -------
@@ -434,6 +444,7 @@ class DerotateAndStackModule(ProcessingModule):
         self.m_derotate = derotate
         self.m_stack = stack
         self.m_extra_rot = extra_rot
+        self.m_interpolation = interpolation
 
     def run(self):
         """
@@ -446,19 +457,22 @@ class DerotateAndStackModule(ProcessingModule):
             None
         """
 
-        def _initialize(ndim, npix):
+        def _initialize(ndim):
             if ndim == 2:
                 nimages = 1
             elif ndim == 3:
                 nimages = self.m_image_in_port.get_shape()[0]
 
-            if self.m_stack == "median":
-                frames = [0, nimages]
-            else:
-                frames = memory_frames(memory, nimages)
+            frames = memory_frames(memory, nimages)
 
             if self.m_stack == "mean":
-                im_tot = np.zeros((npix, npix))
+                im_tot = StreamingMean()
+
+            elif self.m_stack == "median" and frames.size > 2:
+                # the stack does not fit in a single block of MEMORY images so the median is
+                # computed with multiple passes through the stack
+                im_tot = StreamingMedian(nimages)
+
             else:
                 im_tot = None
 
@@ -471,42 +485,55 @@ class DerotateAndStackModule(ProcessingModule):
             raise ValueError("Input and output port should have a different tag.")
 
         memory = self._m_config_port.get_attribute("MEMORY")
+        cpu = self._m_config_port.get_attribute("CPU")
 
         if self.m_derotate:
             parang = self.m_image_in_port.get_attribute("PARANG")
 
         ndim = self.m_image_in_port.get_ndim()
-        npix = self.m_image_in_port.get_shape()[1]
 
-        nimages, frames, im_tot = _initialize(ndim, npix)
+        nimages, frames, im_tot = _initialize(ndim)
 
-        for i, _ in enumerate(frames[:-1]):
-            progress(i, len(frames[:-1]), "Running DerotateAndStackModule...")
+        while True:
+            for i, _ in enumerate(frames[:-1]):
+                progress(i, len(frames[:-1]), "Running DerotateAndStackModule...")
 
-            images = self.m_image_in_port[frames[i]:frames[i+1], ]
+                images = self.m_image_in_port[frames[i]:frames[i+1], ]
 
-            if self.m_derotate:
-                angles = -parang[frames[i]:frames[i+1]]+self.m_extra_rot
-                images = rotate_images(images, angles)
+                if self.m_derotate:
+                    angles = -parang[frames[i]:frames[i+1]]+self.m_extra_rot
+                    images = rotate_images(images,
+                                           angles,
+                                           interpolation=self.m_interpolation,
+                                           threads=cpu)
 
-            if self.m_stack is None:
-                if ndim == 2:
-                    self.m_image_out_port.set_all(images[np.newaxis, ...])
-                elif ndim == 3:
-                    self.m_image_out_port.append(images, data_dim=3)
+                if self.m_stack is None:
+                    if ndim == 2:
+                        self.m_image_out_port.set_all(images[np.newaxis, ...])
+                    elif ndim == 3:
+                        self.m_image_out_port.append(images, data_dim=3)
 
-            elif self.m_stack == "mean":
-                im_tot += np.sum(images, axis=0)
+                elif im_tot is not None:
+                    im_tot.update(images)
+
+            # the streaming median requires several passes through the images
+            if not isinstance(im_tot, StreamingMedian) or not im_tot.next_pass():
+                break
 
         sys.stdout.write("Running DerotateAndStackModule... [DONE]\n")
         sys.stdout.flush()
 
         if self.m_stack == "mean":
-            im_stack = im_tot/float(nimages)
+            im_stack = im_tot.get_mean()
             self.m_image_out_port.set_all(im_stack[np.newaxis, ...])
 
         elif self.m_stack == "median":
-            im_stack = np.median(images, axis=0)
+            if im_tot is None:
+                # all images fit in a single block
+                im_stack = np.median(images, axis=0)
+            else:
+                im_stack = im_tot.get_median()
+
             self.m_image_out_port.set_all(im_stack[np.newaxis, ...])
 
         if self.m_derotate or self.m_stack is not None:
@@ -292,14 +292,15 @@ class TimeNormalizationModule(ProcessingModule):
             None
         """
 
-        def _normalization(image_in):
-            median = np.median(image_in)
-            return image_in - median
+        def _normalization(images):
+            median = np.median(images, axis=(1, 2), keepdims=True)
+            return images - median
 
         self.apply_function_to_images(_normalization,
                                       self.m_image_in_port,
                                       self.m_image_out_port,
-                                      "Running TimeNormalizationModule...")
+                                      "Running TimeNormalizationModule...",
+                                      batch=True)
 
         self.m_image_out_port.copy_attributes(self.m_image_in_port)
         self.m_image_out_port.add_history("TimeNormalizationModule", "normalization = median")
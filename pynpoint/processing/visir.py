@@ -12,12 +12,12 @@ import six
 import warnings
 from pynpoint.core.processing import ReadingModule, ProcessingModule
 from pynpoint.util.module import progress, locate_star, memory_frames
+from pynpoint.util.image import rotate_images
 from pynpoint.core.attributes import get_attributes
 import threading
 # import multiprocessing as mp
 # from functools import partial
 # import ctypes
-from scipy.ndimage import rotate
 
 
 class VisirInitializationModule(ReadingModule):
@@ -932,10 +932,8 @@ class VisirNodAdditionModule(ProcessingModule):
 
         data_out = np.zeros(data.shape)
 
-        for i in range(index):
-            data_out[i, :, :] = rotate(input=data[i, :, :],
-                                       angle=posang_1[i]-posang_2[i],
-                                       reshape=False)
+        angles = np.asarray(posang_1[:index]) - np.asarray(posang_2[:index])
+        data_out[:index, ] = rotate_images(data[:index, ], angles)
 
         return data_out
 
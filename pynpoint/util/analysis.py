@@ -5,9 +5,11 @@ Functions for analysis of a point source.
 from __future__ import absolute_import
 
 import math
+import collections
 
 import numpy as np
 
+from scipy.sparse import csr_matrix
 from scipy.stats import t
 from scipy.ndimage.filters import gaussian_filter
 from skimage.feature import hessian_matrix
@@ -17,6 +19,189 @@ from six.moves import range
 from pynpoint.util.image import shift_image, center_subpixel
 
 
+# exact overlap of the pixels with circular apertures, keyed by the image shape, aperture
+# positions, and aperture radius, with the least recently used weights first
+_APERTURE_WEIGHTS = collections.OrderedDict()
+
+# maximum size (bytes) of the cached aperture weights
+_APERTURE_CACHE = 64*1024**2
+
+# current size (bytes) of the cached aperture weights
+_APERTURE_NBYTES = 0
+
+# apertures that have been requested once, of which the weights are only cached when they are
+# requested again, such that apertures at one-off positions (e.g. during a minimization) do
+# not fill the cache
+_APERTURE_KEYS = collections.OrderedDict()
+
+# maximum number of apertures that are remembered
+_APERTURE_NKEYS = 1024
+
+def _aperture_overlap(shape,
+                      positions,
+                      radius):
+    """
+    Internal function which calculates the exact overlap of the pixels with circular
+    apertures. The overlap is identical to the one used by photutils with method='exact'.
+
+    Parameters
+    ----------
+    shape : tuple(int, int)
+        Image shape.
+    positions : numpy.ndarray
+        Positions (x, y) of the aperture centers (pix), with shape (n_aperture, 2).
+    radius : float
+        Aperture radius (pix).
+
+    Returns
+    -------
+    list(tuple, )
+        For each aperture, the vertical and horizontal slice of the image region that overlaps
+        with the bounding box of the aperture and the overlap of the pixels in that region.
+        None for apertures that do not overlap with the image.
+    """
+
+    overlap = []
+
+    for mask in CircularAperture(positions, radius).to_mask(method='exact'):
+        # part of the bounding box of the aperture that lies within the image
+        x_min, x_max = max(mask.bbox.ixmin, 0), min(mask.bbox.ixmax, shape[1])
+        y_min, y_max = max(mask.bbox.iymin, 0), min(mask.bbox.iymax, shape[0])
+
+        if x_min >= x_max or y_min >= y_max:
+            overlap.append(None)
+            continue
+
+        weight = mask.data[y_min-mask.bbox.iymin:y_max-mask.bbox.iymin,
+                           x_min-mask.bbox.ixmin:x_max-mask.bbox.ixmin]
+
+        overlap.append((slice(y_min, y_max), slice(x_min, x_max), weight))
+
+    return overlap
+
+def _aperture_weights(shape,
+                      overlap):
+    """
+    Internal function which stores the overlap of the pixels with circular apertures as a
+    sparse matrix, such that the apertures are evaluated with a single matrix product.
+
+    Parameters
+    ----------
+    shape : tuple(int, int)
+        Image shape.
+    overlap : list(tuple, )
+        Overlap of the apertures with the image, as returned by
+        :func:`~pynpoint.util.analysis._aperture_overlap`.
+
+    Returns
+    -------
+    scipy.sparse.csr_matrix
+        Weights with shape (n_aperture, n_pixel).
+    numpy.ndarray
+        Apertures that do not overlap with the image.
+    """
+
+    rows = [np.zeros(0, dtype=np.int64)]
+    cols = [np.zeros(0, dtype=np.int64)]
+    weights = [np.zeros(0)]
+
+    no_overlap = np.zeros(len(overlap), dtype=bool)
+
+    for i, item in enumerate(overlap):
+        if item is None:
+            no_overlap[i] = True
+            continue
+
+        y_slice, x_slice, weight = item
+
+        # the pixels with zero weight are also stored, such that NaN values within the bounding
+        # box of an aperture propagate to the sum, identical to photutils
+        y_grid, x_grid = np.mgrid[y_slice, x_slice]
+
+        rows.append(np.full(weight.size, i, dtype=np.int64))
+        cols.append((y_grid*shape[1]+x_grid).ravel())
+        weights.append(weight.ravel())
+
+    matrix = csr_matrix((np.concatenate(weights), (np.concatenate(rows), np.concatenate(cols))),
+                        shape=(len(overlap), shape[0]*shape[1]))
+
+    return matrix, no_overlap
+
+def aperture_sums(image,
+                  positions,
+                  radius):
+    """
+    Function for the exact aperture photometry of an image with circular apertures at
+    multiple positions. Equivalent to aperture_photometry of photutils with method='exact',
+    without the overhead of the photometry table. When the same apertures are requested again,
+    for example while iterating towards the contrast limit of a fake planet, the pixel weights
+    are cached as a sparse matrix and the apertures are evaluated with a single matrix product.
+
+    Parameters
+    ----------
+    image : numpy.ndarray
+        Input image (2D).
+    positions : numpy.ndarray
+        Positions (x, y) of the aperture centers (pix), with shape (n_aperture, 2). The pixel
+        coordinates of the bottom-left corner of the image are (-0.5, -0.5).
+    radius : float
+        Aperture radius (pix).
+
+    Returns
+    -------
+    numpy.ndarray
+        Aperture sums. The sum is NaN for apertures that do not overlap with the image.
+    """
+
+    global _APERTURE_NBYTES
+
+    image = np.asarray(image, dtype=np.float64)
+    positions = np.asarray(positions, dtype=np.float64).reshape(-1, 2)
+
+    key = (image.shape, tuple(positions.ravel()), float(radius))
+
+    if key in _APERTURE_WEIGHTS:
+        # move the weights to the end of the cache as most recently used
+        matrix, no_overlap = _APERTURE_WEIGHTS.pop(key)
+        _APERTURE_WEIGHTS[key] = (matrix, no_overlap)
+
+    elif key in _APERTURE_KEYS:
+        # the apertures are requested again so the weights are cached
+        del _APERTURE_KEYS[key]
+
+        matrix, no_overlap = _aperture_weights(image.shape,
+                                               _aperture_overlap(image.shape, positions, radius))
+
+        nbytes = matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes
+
+        while _APERTURE_WEIGHTS and _APERTURE_NBYTES + nbytes > _APERTURE_CACHE:
+            # remove the least recently used weights
+            item = _APERTURE_WEIGHTS.popitem(last=False)[1][0]
+            _APERTURE_NBYTES -= item.data.nbytes + item.indices.nbytes + item.indptr.nbytes
+
+        _APERTURE_WEIGHTS[key] = (matrix, no_overlap)
+        _APERTURE_NBYTES += nbytes
+
+    else:
+        # apertures that are requested for the first time are summed directly
+        _APERTURE_KEYS[key] = None
+
+        if len(_APERTURE_KEYS) > _APERTURE_NKEYS:
+            _APERTURE_KEYS.popitem(last=False)
+
+        phot = np.full(positions.shape[0], np.nan)
+
+        for i, item in enumerate(_aperture_overlap(image.shape, positions, radius)):
+            if item is not None:
+                phot[i] = np.sum(image[item[0], item[1]]*item[2])
+
+        return phot
+
+    phot = matrix.dot(image.reshape(-1))
+    phot[no_overlap] = np.nan
+
+    return phot
+
 def false_alarm(image,
                 x_pos,
                 y_pos,
@@ -67,18 +252,10 @@ def false_alarm(image,
         raise ValueError("Number of apertures (num_ap=%s) is too small to calculate the "
                          "false positive fraction." % num_ap)
 
-    ap_phot = np.zeros(num_ap)
+    x_ap = center[1] + (x_pos-center[1])*np.cos(ap_theta) - (y_pos-center[0])*np.sin(ap_theta)
+    y_ap = center[0] + (x_pos-center[1])*np.sin(ap_theta) + (y_pos-center[0])*np.cos(ap_theta)
 
-    for i, theta in enumerate(ap_theta):
-        x_tmp = center[1] + (x_pos-center[1])*math.cos(theta) - \
-                            (y_pos-center[0])*math.sin(theta)
-
-        y_tmp = center[0] + (x_pos-center[1])*math.sin(theta) + \
-                            (y_pos-center[0])*math.cos(theta)
-
-        aperture = CircularAperture((x_tmp, y_tmp), size)
-        phot_table = aperture_photometry(image, aperture, method='exact')
-        ap_phot[i] = phot_table['aperture_sum']
+    ap_phot = aperture_sums(image, np.column_stack((x_ap, y_ap)), size)
 
     noise = np.std(ap_phot[1:]) * math.sqrt(1.+1./float(num_ap-1))
     t_test = (ap_phot[0] - np.mean(ap_phot[1:])) / noise
@@ -257,11 +434,17 @@ def merit_function(residuals,
         # the value of data[0, 0] is taken as the value over the range -0.5 < x <= 0.5,
         # -0.5 < y <= 0.5. Note that this is the same coordinate system as used by PynPoint.
 
-        phot_table = aperture_photometry(np.abs(residuals),
-                                         create_aperture(aperture),
-                                         method='exact')
+        if aperture['type'] == "circular":
+            merit = aperture_sums(np.abs(residuals),
+                                  (aperture['pos_x'], aperture['pos_y']),
+                                  aperture['radius'])[0]
+
+        else:
+            phot_table = aperture_photometry(np.abs(residuals),
+                                             create_aperture(aperture),
+                                             method='exact')
 
-        merit = phot_table['aperture_sum'][0]
+            merit = phot_table['aperture_sum'][0]
 
         if variance[0] == "gaussian":
             merit = merit**2/variance[1]
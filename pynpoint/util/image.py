@@ -5,13 +5,32 @@ Functions for image processing.
 from __future__ import absolute_import
 
 import math
+import threading
+import collections
 
+from multiprocessing.pool import ThreadPool
+
+import cv2
 import numpy as np
 
 from skimage.transform import rescale
 from scipy.ndimage import fourier_shift, shift, rotate
 
 
+# coordinate maps of the rotations by cv2.remap, keyed by the image shape and rotation angle,
+# with the least recently used maps first
+_ROTATION_MAPS = collections.OrderedDict()
+
+# maximum size (bytes) of the cached coordinate maps
+_ROTATION_CACHE = 256*1024**2
+
+# current size (bytes) of the cached coordinate maps
+_ROTATION_NBYTES = 0
+
+# the cache is shared by the threads of rotate_images
+_ROTATION_LOCK = threading.Lock()
+
+
 def center_pixel(image):
     """
     Function to get the pixel position of the image center. Note that this position
@@ -108,17 +127,87 @@ def crop_image(image,
 
     return im_return
 
+def _rotation_map(shape,
+                  angle):
+    """
+    Internal function which returns the coordinate maps for the rotation of an image with
+    cv2.remap. The maps are cached such that images with the same shape and rotation angle, for
+    example the residuals of the PSF subtraction for different numbers of principal components,
+    share the maps. The least recently used maps are removed when the cache is full. The cache
+    is protected by a lock since the maps are requested by multiple threads.
+
+    Parameters
+    ----------
+    shape : tuple(int, int)
+        Image shape.
+    angle : float
+        Rotation angle (deg).
+
+    Returns
+    -------
+    numpy.ndarray
+        Horizontal coordinates of the input image for each output pixel.
+    numpy.ndarray
+        Vertical coordinates of the input image for each output pixel.
+    """
+
+    global _ROTATION_NBYTES
+
+    key = (tuple(shape), float(angle))
+
+    with _ROTATION_LOCK:
+        if key in _ROTATION_MAPS:
+            # move the maps to the end of the cache as most recently used
+            maps = _ROTATION_MAPS.pop(key)
+            _ROTATION_MAPS[key] = maps
+
+            return maps
+
+    # the rotation is applied in clockwise direction around the image center, identical to
+    # scipy.ndimage.rotate
+    center = ((shape[1]-1.)/2., (shape[0]-1.)/2.)
+    matrix = cv2.invertAffineTransform(cv2.getRotationMatrix2D(center, float(angle), 1.))
+
+    y_grid, x_grid = np.indices(shape, dtype=np.float64)
+
+    map_x = (matrix[0, 0]*x_grid + matrix[0, 1]*y_grid + matrix[0, 2]).astype(np.float32)
+    map_y = (matrix[1, 0]*x_grid + matrix[1, 1]*y_grid + matrix[1, 2]).astype(np.float32)
+
+    nbytes = map_x.nbytes + map_y.nbytes
+
+    with _ROTATION_LOCK:
+        # the maps may have been added by another thread in the meantime
+        if key not in _ROTATION_MAPS:
+            while _ROTATION_MAPS and _ROTATION_NBYTES + nbytes > _ROTATION_CACHE:
+                # remove the least recently used maps
+                item = _ROTATION_MAPS.popitem(last=False)[1]
+                _ROTATION_NBYTES -= item[0].nbytes + item[1].nbytes
+
+            _ROTATION_MAPS[key] = (map_x, map_y)
+            _ROTATION_NBYTES += nbytes
+
+    return map_x, map_y
+
 def rotate_images(images,
-                  angles):
+                  angles,
+                  interpolation="spline",
+                  threads=1):
     """
-    Function to rotate all images in clockwise direction.
+    Function to rotate all images in clockwise direction. The spline interpolation uses
+    scipy.ndimage.rotate. The bilinear and bicubic interpolation use OpenCV with cached
+    coordinate maps for each image shape and rotation angle, which is considerably faster and
+    can be distributed over multiple threads.
 
     Parameters
     ----------
     images : numpy.ndarray
         Stack of images (3D).
-    angle : numpy.ndarray
+    angles : numpy.ndarray
         Rotation angles (deg).
+    interpolation : str
+        Interpolation of the rotated images ("spline", "bilinear", or "bicubic").
+    threads : int
+        Number of threads that are used for the bilinear and bicubic interpolation.
 
     Returns
     -------
@@ -128,8 +217,43 @@ def rotate_images(images,
 
     im_rot = np.zeros(images.shape)
 
-    for i, item in enumerate(angles):
-        im_rot[i, ] = rotate(input=images[i, ], angle=item, reshape=False)
+    if interpolation == "spline":
+        for i, item in enumerate(angles):
+            im_rot[i, ] = rotate(input=images[i, ], angle=item, reshape=False)
+
+    elif interpolation in ("bilinear", "bicubic"):
+        if interpolation == "bilinear":
+            flag = cv2.INTER_LINEAR
+        else:
+            flag = cv2.INTER_CUBIC
+
+        def _rotate(i):
+            map_x, map_y = _rotation_map(images.shape[-2:], angles[i])
+
+            im_rot[i, ] = cv2.remap(np.asarray(images[i, ], dtype=np.float64),
+                                    map_x,
+                                    map_y,
+                                    interpolation=flag,
+                                    borderMode=cv2.BORDER_CONSTANT,
+                                    borderValue=0.)
+
+        if threads > 1 and images.shape[0] > 1:
+            # OpenCV releases the GIL so the images are rotated in parallel
+            pool = ThreadPool(min(threads, images.shape[0]))
+
+            try:
+                pool.map(_rotate, range(images.shape[0]))
+
+            finally:
+                pool.close()
+                pool.join()
+
+        else:
+            for i in range(images.shape[0]):
+                _rotate(i)
+
+    else:
+        raise ValueError("The interpolation should be 'spline', 'bilinear', or 'bicubic'.")
 
     return im_rot
 
@@ -6,16 +6,17 @@ import math
 
 import numpy as np
 
-from photutils import aperture_photometry
+from scipy.ndimage import affine_transform
+from six.moves import range
 
-from pynpoint.util.analysis import student_t, fake_planet, false_alarm, create_aperture
-from pynpoint.util.image import polar_to_cartesian, center_subpixel
+from pynpoint.util.analysis import student_t, fake_planet, false_alarm, aperture_sums
+from pynpoint.util.image import polar_to_cartesian, center_subpixel, shift_image
 from pynpoint.util.psf import pca_psf_subtraction
 from pynpoint.util.residuals import combine_residuals
 
 
-def contrast_limit(path_images,
-                   path_psf,
+def contrast_limit(images,
+                   psf,
                    noise,
                    mask,
                    parang,
@@ -27,7 +28,9 @@ def contrast_limit(path_images,
                    residuals,
                    snr_inject,
                    position,
-                   queue):
+                   pca_sklearn=None,
+                   indices=None,
+                   throughput=None):
 
     """
     Function for calculating the contrast limit at a specified position with a correction for
@@ -35,11 +38,11 @@ def contrast_limit(path_images,
 
     Parameters
     ----------
-    path_images : str
-        System location of the stack of images (3D).
-    path_psf : str
-        System location of the PSF template for the fake planet (3D). Either a single image or a
-        stack of images equal in size to science data.
+    images : numpy.ndarray
+        Stack of images (3D).
+    psf : numpy.ndarray
+        PSF template for the fake planet (3D). Either a single image or a stack of images equal
+        in size to science data.
     noise : numpy.ndarray
         Residuals of the PSF subtraction (3D) without injection of fake planets. Used to measure
         the noise level with a correction for small sample statistics.
@@ -69,16 +72,24 @@ def contrast_limit(path_images,
     snr_inject : float
         Signal-to-noise ratio of the injected planet signal that is used to measure the amount
         of self-subtraction.
+    pca_sklearn : sklearn.decomposition.pca.PCA
+        PCA object with a basis that has been fitted to the images without fake planet. The
+        images with fake planet are projected onto this basis instead of fitting a new basis if
+        not set to None.
+    indices : numpy.ndarray
+        Non-masked image indices. Required if *pca_sklearn* is not set to None.
+    throughput : pynpoint.util.limits.PcaThroughput
+        Residuals of the images with a fixed PCA basis, which are combined with the residuals of
+        the fake planet by itself instead of running the PSF subtraction on the images with fake
+        planet. Not used if set to None.
 
     Returns
     -------
-    NoneType
-        None
+    tuple(float, float, float, float, float)
+        Separation (pix), position angle (deg), contrast (mag), false positive fraction, and
+        the fraction of the flux of the fake planet that remains after the PSF subtraction.
     """
 
-    images = np.load(path_images)
-    psf = np.load(path_psf)
-
     if threshold[0] == "sigma":
         sigma = threshold[1]
 
@@ -112,9 +123,7 @@ def contrast_limit(path_images,
 
     # Measure the flux of the star
     im_center = center_subpixel(images)
-    ap_dict = {'type':'circular', 'pos_x':im_center[1], 'pos_y':im_center[0], 'radius':aperture}
-    phot_table = aperture_photometry(psf_scaling*psf[0, ], create_aperture(ap_dict), method='exact')
-    star = phot_table['aperture_sum'][0]
+    star = aperture_sums(psf_scaling*psf[0, ], (im_center[1], im_center[0]), aperture)[0]
 
     # Magnitude of the injected planet
     flux_in = snr_inject*t_noise
@@ -123,28 +132,46 @@ def contrast_limit(path_images,
     mag = -2.5*math.log10(flux_in/star)
     print('mag: ', mag)
 
-    # Inject the fake planet
-    fake = fake_planet(images=images,
-                       psf=psf,
-                       parang=parang,
-                       position=(position[0], position[1]),
-                       magnitude=mag,
-                       psf_scaling=psf_scaling)
-
-    # Run the PSF subtraction
-    _, im_res = pca_psf_subtraction(images=fake*mask,
-                                    angles=-1.*parang+extra_rot,
-                                    pca_number=pca_number)
-
-    # Stack the residuals
-    im_res = combine_residuals(method=residuals, res_rot=im_res)
-
-    # Measure the flux of the fake planet
-    flux_out, _, _, _ = false_alarm(image=im_res[0, ],
-                                    x_pos=xy_fake[0],
-                                    y_pos=xy_fake[1],
-                                    size=aperture,
-                                    ignore=False)
+    if throughput is not None:
+        # Combine the residuals of the images with the residuals of the fake planet
+        flux_out = throughput.aperture_flux(position, xy_fake, aperture, flux_in/star)
+
+    else:
+        # Inject the fake planet
+        fake = fake_planet(images=images,
+                           psf=psf,
+                           parang=parang,
+                           position=(position[0], position[1]),
+                           magnitude=mag,
+                           psf_scaling=psf_scaling)
+
+        # Run the PSF subtraction
+        if pca_sklearn is None:
+            _, im_res = pca_psf_subtraction(images=fake*mask,
+                                            angles=-1.*parang+extra_rot,
+                                            pca_number=pca_number)
+
+        else:
+            # reshape the images, select the unmasked pixels, and subtract the mean image
+            im_reshape = (fake*mask).reshape(fake.shape[0], -1)[:, indices]
+            im_reshape -= np.mean(im_reshape, axis=0)
+
+            _, im_res = pca_psf_subtraction(images=im_reshape,
+                                            angles=-1.*parang+extra_rot,
+                                            pca_number=pca_number,
+                                            pca_sklearn=pca_sklearn,
+                                            im_shape=fake.shape,
+                                            indices=indices)
+
+        # Stack the residuals
+        im_res = combine_residuals(method=residuals, res_rot=im_res)
+
+        # Measure the flux of the fake planet
+        flux_out, _, _, _ = false_alarm(image=im_res[0, ],
+                                        x_pos=xy_fake[0],
+                                        y_pos=xy_fake[1],
+                                        size=aperture,
+                                        ignore=False)
 
     # Calculate the self-subtraction
     attenuation = flux_out/flux_in
@@ -153,5 +180,387 @@ def contrast_limit(path_images,
     contrast = sigma*t_noise/(attenuation*star)
     contrast = -2.5*math.log10(contrast)
 
-    # Separation [pix], position antle [deg], contrast [mag], FPF
-    queue.put((position[0], position[1], contrast, fpf))
+    # Separation [pix], position antle [deg], contrast [mag], FPF, attenuation
+    return position[0], position[1], contrast, fpf, attenuation
+
+
+class PcaThroughput(object):
+    """
+    Class for the flux of fake planets after the PSF subtraction with a fixed PCA basis. The
+    projection onto a fixed basis and the derotation are linear, so the residuals of the images
+    with a fake planet are the residuals of the images without fake planet plus the residuals of
+    the fake planet by itself. The residuals of the images are created once. For each position,
+    only the residuals of the fake planet are created, within the region of the images from
+    which the aperture of the fake planet is derotated. With a finite *stamp_radius*, also the
+    fake planet is only created within a stamp around its position in each image, such that the
+    computation time scales with the size of the stamp instead of the size of the images.
+    """
+
+    def __init__(self,
+                 images,
+                 psf,
+                 parang,
+                 pca_sklearn,
+                 pca_number,
+                 indices,
+                 extra_rot=0.,
+                 psf_scaling=1.,
+                 residuals="mean",
+                 stamp_radius=None):
+        """
+        Constructor of PcaThroughput.
+
+        Parameters
+        ----------
+        images : numpy.ndarray
+            Stack of masked images without fake planet (3D).
+        psf : numpy.ndarray
+            PSF template for the fake planet (3D). Either a single image or a stack of images
+            equal in size to *images*.
+        parang : numpy.ndarray
+            Parallactic angles (deg).
+        pca_sklearn : sklearn.decomposition.pca.PCA
+            PCA object with a basis that has been fitted to the images.
+        pca_number : int
+            Number of principal components used for the PSF subtraction.
+        indices : numpy.ndarray
+            Non-masked image indices.
+        extra_rot : float
+            Additional rotation angle of the images in clockwise direction (deg).
+        psf_scaling : float
+            Additional scaling factor of the planet flux.
+        residuals : str
+            Method used for combining the residuals ("mean", "median", or "clipped").
+        stamp_radius : float
+            Radius (pix) beyond which the PSF template is set to zero. The full PSF template is
+            used if set to None.
+
+        Returns
+        -------
+        NoneType
+            None
+        """
+
+        if residuals not in ("mean", "median", "clipped"):
+            raise ValueError("The residuals of the fake planets can only be combined with "
+                             "'mean', 'median', or 'clipped'.")
+
+        self.m_shape = images.shape
+        self.m_parang = parang
+        self.m_angles = -1.*parang + extra_rot
+        self.m_residuals = residuals
+        self.m_stamp_radius = stamp_radius
+
+        self.m_psf = psf_scaling*psf
+
+        if stamp_radius is not None:
+            center = center_subpixel(psf)
+            yy, xx = np.mgrid[:psf.shape[-2], :psf.shape[-1]]
+
+            self.m_psf = self.m_psf*((yy-center[0])**2+(xx-center[1])**2 <= stamp_radius**2)
+
+        # basis in the original image size
+        self.m_indices = indices
+        self.m_components = np.zeros((pca_number, self.m_shape[1]*self.m_shape[2]))
+        self.m_components[:, indices] = pca_sklearn.components_[:pca_number]
+
+        # residuals of the images without fake planet
+        im_reshape = images.reshape(self.m_shape[0], -1)[:, indices]
+        im_reshape -= np.mean(im_reshape, axis=0)
+
+        _, self.m_res_rot = pca_psf_subtraction(images=im_reshape,
+                                                angles=self.m_angles,
+                                                pca_number=pca_number,
+                                                pca_sklearn=pca_sklearn,
+                                                im_shape=self.m_shape,
+                                                indices=indices)
+
+        self.m_noise = combine_residuals(method=residuals, res_rot=self.m_res_rot)
+
+    def get_noise(self):
+        """
+        Function for getting the combined residuals of the images without fake planet.
+
+        Returns
+        -------
+        numpy.ndarray
+            Combined residuals (3D).
+        """
+
+        return self.m_noise
+
+    def _rotation(self,
+                  angle):
+        """
+        Internal function which returns the transformation from the derotated to the original
+        pixel coordinates (y, x), which is used by scipy.ndimage.rotate.
+
+        Parameters
+        ----------
+        angle : float
+            Derotation angle (deg).
+
+        Returns
+        -------
+        numpy.ndarray
+            Rotation matrix.
+        numpy.ndarray
+            Center of the rotation (y, x).
+        """
+
+        angle = math.radians(angle)
+
+        matrix = np.array([[math.cos(angle), math.sin(angle)],
+                           [-math.sin(angle), math.cos(angle)]])
+
+        center = np.array([self.m_shape[1]/2.-0.5, self.m_shape[2]/2.-0.5])
+
+        return matrix, center
+
+    def _planet(self,
+                position,
+                region):
+        """
+        Internal function which creates the fake planet, with the flux of the (scaled) PSF
+        template, in the 2D reshaped format.
+
+        Parameters
+        ----------
+        position : tuple(float, float)
+            The separation (pix) and position angle (deg) of the fake planet.
+        region : numpy.ndarray
+            Pixel indices of the region of the images where the fake planet is required.
+
+        Returns
+        -------
+        numpy.ndarray
+            Fake planet within the region of the images.
+        """
+
+        if self.m_stamp_radius is None:
+            planet = fake_planet(images=np.zeros(self.m_shape),
+                                 psf=self.m_psf,
+                                 parang=self.m_parang,
+                                 position=position,
+                                 magnitude=0.,
+                                 psf_scaling=1.)
+
+            return planet.reshape(self.m_shape[0], -1)[:, region]
+
+        planet = np.zeros((self.m_shape[0], self.m_shape[1]*self.m_shape[2]))
+
+        # the stamp of the PSF template includes a margin for the spline interpolation
+        size = int(math.ceil(self.m_stamp_radius)) + 3
+        center = center_subpixel(self.m_psf)
+
+        y_0 = int(round(center[0])) - size
+        x_0 = int(round(center[1])) - size
+
+        ang = np.radians(position[1] + 90. - self.m_parang)
+
+        y_shift = position[0]*np.sin(ang)
+        x_shift = position[0]*np.cos(ang)
+
+        for i in range(self.m_shape[0]):
+            if self.m_psf.shape[0] == 1:
+                psf = self.m_psf[0, ]
+            else:
+                psf = self.m_psf[i, ]
+
+            y_int = int(round(y_shift[i]))
+            x_int = int(round(x_shift[i]))
+
+            stamp = psf[max(y_0, 0):y_0+2*size+1, max(x_0, 0):x_0+2*size+1]
+
+            stamp = shift_image(stamp,
+                                (y_shift[i]-y_int, x_shift[i]-x_int),
+                                "spline",
+                                mode='reflect')
+
+            image = np.zeros(self.m_shape[1:])
+
+            y_start = max(y_0, 0) + y_int
+            x_start = max(x_0, 0) + x_int
+
+            y_slice = slice(max(y_start, 0), min(y_start+stamp.shape[0], self.m_shape[1]))
+            x_slice = slice(max(x_start, 0), min(x_start+stamp.shape[1], self.m_shape[2]))
+
+            image[y_slice, x_slice] = stamp[y_slice.start-y_start:y_slice.stop-y_start,
+                                            x_slice.start-x_start:x_slice.stop-x_start]
+
+            planet[i, ] = image.reshape(-1)
+
+        return planet[:, region]
+
+    def _regions(self,
+                 xy_pos,
+                 aperture):
+        """
+        Internal function which determines the region around the aperture in the derotated
+        images, and the region of the original images from which it is derotated.
+
+        Parameters
+        ----------
+        xy_pos : tuple(float, float)
+            Position (x, y) of the fake planet in the derotated images.
+        aperture : float
+            Aperture radius (pix).
+
+        Returns
+        -------
+        tuple(int, int, int, int)
+            Boundaries (y_min, y_max, x_min, x_max) of the region in the derotated images.
+        tuple(int, int, int, int)
+            Boundaries (y_min, y_max, x_min, x_max) of the region in the original images.
+        """
+
+        out_box = (max(int(math.floor(xy_pos[1]-aperture))-1, 0),
+                   min(int(math.ceil(xy_pos[1]+aperture))+2, self.m_shape[1]),
+                   max(int(math.floor(xy_pos[0]-aperture))-1, 0),
+                   min(int(math.ceil(xy_pos[0]+aperture))+2, self.m_shape[2]))
+
+        corners = np.array([[out_box[0], out_box[2]],
+                            [out_box[0], out_box[3]-1],
+                            [out_box[1]-1, out_box[2]],
+                            [out_box[1]-1, out_box[3]-1]], dtype=np.float64)
+
+        in_min = np.full(2, np.inf)
+        in_max = np.full(2, -np.inf)
+
+        for angle in self.m_angles:
+            matrix, center = self._rotation(angle)
+
+            coord = np.dot(corners-center, matrix.T) + center
+
+            in_min = np.minimum(in_min, np.amin(coord, axis=0))
+            in_max = np.maximum(in_max, np.amax(coord, axis=0))
+
+        # the spline interpolation of the derotation depends on the surrounding pixels
+        margin = 10
+
+        in_box = (max(int(math.floor(in_min[0]))-margin, 0),
+                  min(int(math.ceil(in_max[0]))+margin+1, self.m_shape[1]),
+                  max(int(math.floor(in_min[1]))-margin, 0),
+                  min(int(math.ceil(in_max[1]))+margin+1, self.m_shape[2]))
+
+        return out_box, in_box
+
+    def planet_residuals(self,
+                         position,
+                         xy_pos,
+                         aperture):
+        """
+        Function for the derotated residuals of a fake planet, with the flux of the (scaled)
+        PSF template, in the region around the aperture.
+
+        Parameters
+        ----------
+        position : tuple(float, float)
+            The separation (pix) and position angle (deg) of the fake planet.
+        xy_pos : tuple(float, float)
+            Position (x, y) of the fake planet in the derotated images.
+        aperture : float
+            Aperture radius (pix).
+
+        Returns
+        -------
+        numpy.ndarray
+            Derotated residuals of the fake planet (3D).
+        tuple(int, int, int, int)
+            Boundaries (y_min, y_max, x_min, x_max) of the region in the derotated images.
+        """
+
+        out_box, in_box = self._regions(xy_pos, aperture)
+
+        yy, xx = np.mgrid[in_box[0]:in_box[1], in_box[2]:in_box[3]]
+        region = (yy*self.m_shape[2] + xx).reshape(-1)
+
+        # the fake planet only contributes to the PCA coefficients within its stamp
+        if self.m_stamp_radius is None:
+            support = self.m_indices
+
+        else:
+            ang = np.radians(position[1] + 90. - self.m_parang)
+            center = center_subpixel(self.m_psf)
+
+            y_planet = center[0] + position[0]*np.sin(ang)
+            x_planet = center[1] + position[0]*np.cos(ang)
+
+            yy_all, xx_all = np.mgrid[:self.m_shape[1], :self.m_shape[2]]
+            select = np.zeros(self.m_shape[1:], dtype=bool)
+
+            for i in range(self.m_shape[0]):
+                select |= (yy_all-y_planet[i])**2 + (xx_all-x_planet[i])**2 <= \
+                    (self.m_stamp_radius+3.)**2
+
+            support = np.intersect1d(np.where(select.reshape(-1))[0], self.m_indices)
+
+        planet = self._planet(position, support)
+        planet -= np.mean(planet, axis=0)
+
+        coefficients = np.matmul(planet, self.m_components[:, support].T)
+
+        # residuals of the fake planet within the region, with the masked pixels set to zero
+        residuals = np.zeros((self.m_shape[0], self.m_shape[1]*self.m_shape[2]))
+        residuals[:, support] = planet
+
+        residuals = residuals[:, region] - np.matmul(coefficients, self.m_components[:, region])
+
+        unmasked = np.zeros(self.m_shape[1]*self.m_shape[2], dtype=bool)
+        unmasked[self.m_indices] = True
+        residuals[:, ~unmasked[region]] = 0.
+
+        residuals = residuals.reshape(self.m_shape[0], in_box[1]-in_box[0], in_box[3]-in_box[2])
+
+        out_shape = (out_box[1]-out_box[0], out_box[3]-out_box[2])
+        res_rot = np.zeros((self.m_shape[0], ) + out_shape)
+
+        out_origin = np.array([out_box[0], out_box[2]], dtype=np.float64)
+        in_origin = np.array([in_box[0], in_box[2]], dtype=np.float64)
+
+        for i, angle in enumerate(self.m_angles):
+            matrix, center = self._rotation(angle)
+
+            offset = np.dot(matrix, out_origin-center) + center - in_origin
+
+            res_rot[i, ] = affine_transform(residuals[i, ],
+                                            matrix,
+                                            offset=offset,
+                                            output_shape=out_shape,
+                                            order=3,
+                                            mode='constant')
+
+        return res_rot, out_box
+
+    def aperture_flux(self,
+                      position,
+                      xy_pos,
+                      aperture,
+                      flux_ratio):
+        """
+        Function for the aperture flux of the combined residuals of the images with a fake planet.
+
+        Parameters
+        ----------
+        position : tuple(float, float)
+            The separation (pix) and position angle (deg) of the fake planet.
+        xy_pos : tuple(float, float)
+            Position (x, y) of the fake planet in the derotated images.
+        aperture : float
+            Aperture radius (pix).
+        flux_ratio : float
+            Flux of the fake planet relative to the flux of the (scaled) PSF template.
+
+        Returns
+        -------
+        float
+            Aperture flux.
+        """
+
+        planet, box = self.planet_residuals(position, xy_pos, aperture)
+
+        res_rot = self.m_res_rot[:, box[0]:box[1], box[2]:box[3]] + flux_ratio*planet
+
+        stack = combine_residuals(method=self.m_residuals, res_rot=res_rot)
+
+        return aperture_sums(stack[0, ], (xy_pos[0]-box[2], xy_pos[1]-box[0]), aperture)[0]
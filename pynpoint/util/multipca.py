@@ -1,6 +1,8 @@
 """
 Capsule for multiprocessing of the PSF subtraction with PCA. Residuals are created in parallel for
-a range of principal components for which the PCA basis is required as input.
+a range of principal components for which the PCA basis is required as input. The mean and
+noise-weighted residuals are created in parallel for blocks of images, while the median and
+clipped mean residuals are created in parallel for the principal component numbers.
 """
 
 from __future__ import absolute_import
@@ -12,21 +14,25 @@ import numpy as np
 from six.moves import range
 
 from pynpoint.util.multiproc import TaskProcessor, TaskCreator, TaskWriter, TaskResult, \
-                                    TaskInput, MultiprocessingCapsule, to_slice
-from pynpoint.util.psf import pca_psf_subtraction
-from pynpoint.util.residuals import combine_residuals
+                                    TaskInput, MultiprocessingCapsule, SharedArray, to_slice
+from pynpoint.util.psf import PcaResiduals
+from pynpoint.util.residuals import combine_residuals, noise_weighted_sums
 
 
 class PcaTaskCreator(TaskCreator):
     """
-    The TaskCreator of the PCA multiprocessing. Creates one task for each principal component
-    number. Does not require an input port since the data is directly given to the task processors.
+    The TaskCreator of the PCA multiprocessing. Creates one task for each block of images if the
+    mean or noise-weighted residuals are required, and one task for each principal component
+    number if the median or clipped mean residuals are required. Does not require an input port
+    since the data is directly given to the task processors.
     """
 
     def __init__(self,
                  tasks_queue_in,
                  number_of_processors,
-                 pca_numbers):
+                 pca_numbers,
+                 nimages,
+                 requirements=(False, False, False, False)):
         """
         Constructor of PcaTaskCreator.
 
@@ -38,6 +44,10 @@ class PcaTaskCreator(TaskCreator):
             Number of processors.
         pca_numbers : numpy.ndarray
             Principal components for which the residuals are computed.
+        nimages : int
+            Number of images.
+        requirements : tuple(bool, bool, bool, bool)
+            Required output residuals.
 
         Returns
         -------
@@ -48,6 +58,8 @@ class PcaTaskCreator(TaskCreator):
         super(PcaTaskCreator, self).__init__(None, tasks_queue_in, None, number_of_processors)
 
         self.m_pca_numbers = pca_numbers
+        self.m_nimages = nimages
+        self.m_requirements = requirements
 
     def run(self):
         """
@@ -59,26 +71,39 @@ class PcaTaskCreator(TaskCreator):
             None
         """
 
-        res_position = 0
+        if self.m_requirements[0] or self.m_requirements[2]:
+            # one block of images per processor, without job parameters since the partial sums
+            # of the blocks are added by the writer
+            frames = np.linspace(0, self.m_nimages, self.m_number_of_processors+1).astype(int)
+
+            for i in range(self.m_number_of_processors):
+                if frames[i+1] > frames[i]:
+                    self.m_task_queue.put(TaskInput((frames[i], frames[i+1]), None))
 
-        for pca_number in self.m_pca_numbers:
-            parameters = (((res_position, res_position+1, None),
-                           (None, None, None), (None, None, None)), )
+        if self.m_requirements[1] or self.m_requirements[3]:
+            res_position = 0
 
-            self.m_task_queue.put(TaskInput(pca_number, parameters))
+            for pca_number in self.m_pca_numbers:
+                parameters = (((res_position, res_position+1, None),
+                               (None, None, None), (None, None, None)), )
 
-            res_position += 1
+                self.m_task_queue.put(TaskInput(pca_number, parameters))
+
+                res_position += 1
 
         self.create_poison_pills()
 
 
 class PcaTaskProcessor(TaskProcessor):
     """
-    The TaskProcessor of the PCA multiprocessing is the core of the parallelization. An instance
-    of this class will calculate one forward and backward PCA transformation given the pre-trained
-    scikit-learn PCA model. It does not get data from the TaskCreator but uses its own copy of the
-    input data, which are the same and independent for each task. The following residuals can be
-    created:
+    The TaskProcessor of the PCA multiprocessing is the core of the parallelization. A task is
+    either a block of images or a PC number. For a block of images, the images are projected once
+    onto the basis with the maximum number of principal components and the partial sums of the
+    mean and noise-weighted residuals are created for all PC numbers. For a PC number, the median
+    and clipped mean residuals are created from all images by updating the residuals of the
+    previous task of the processor. It does not get data from the TaskCreator but uses a view on
+    the input data in shared memory, which are the same and independent for each task. The
+    following residuals can be created:
 
     * Mean residuals -- requirements[0] = True
     * Median residuals -- requirements[1] = True
@@ -94,7 +119,10 @@ class PcaTaskProcessor(TaskProcessor):
                  pca_model,
                  im_shape,
                  indices,
-                 requirements=(False, False, False, False)):
+                 pca_numbers,
+                 res_var=None,
+                 requirements=(False, False, False, False),
+                 interpolation="spline"):
         """
         Constructor of PcaTaskProcessor.
 
@@ -104,8 +132,8 @@ class PcaTaskProcessor(TaskProcessor):
             Input task queue.
         result_queue_in : multiprocessing.queues.JoinableQueue
             Input result queue.
-        star_reshape : numpy.ndarray
-            Reshaped (2D) stack of images.
+        star_reshape : pynpoint.util.multiproc.SharedArray
+            Reshaped (2D) stack of images in shared memory.
         angles : numpy.ndarray
             Derotation angles (deg).
         pca_model : sklearn.decomposition.pca.PCA
@@ -114,8 +142,16 @@ class PcaTaskProcessor(TaskProcessor):
             Original shape of the stack of images.
         indices : numpy.ndarray
             Non-masked image indices.
+        pca_numbers : numpy.ndarray
+            Principal components for which the residuals are computed.
+        res_var : pynpoint.util.multiproc.SharedArray
+            Variance of the non-derotated residuals for each PC number in shared memory. Only
+            required for the noise-weighted residuals.
         requirements : tuple(bool, bool, bool, bool)
             Required output residuals.
+        interpolation : str
+            Interpolation of the derotated residuals (see
+            :func:`~pynpoint.util.image.rotate_images`).
 
         Returns
         -------
@@ -130,7 +166,56 @@ class PcaTaskProcessor(TaskProcessor):
         self.m_angles = angles
         self.m_im_shape = im_shape
         self.m_indices = indices
+        self.m_pca_numbers = pca_numbers
+        self.m_res_var = res_var
         self.m_requirements = requirements
+        self.m_interpolation = interpolation
+
+        # created by the processor such that the residuals are not copied to the child process
+        self.m_residuals = None
+
+    def _run_frames(self, first, last):
+        """
+        Internal function which creates the partial sums of the mean and noise-weighted
+        residuals of a block of images for all PC numbers.
+
+        Parameters
+        ----------
+        first : int
+            Index of the first image of the block.
+        last : int
+            Index of the last image of the block (exclusive).
+
+        Returns
+        -------
+        numpy.ndarray
+            Sum of the derotated residuals, and the two sums of the noise-weighted residuals, for
+            each PC number.
+        """
+
+        angles = self.m_angles[first:last]
+
+        residuals = PcaResiduals(images=self.m_star_reshape.get_array()[first:last, ],
+                                 pca_sklearn=self.m_pca_model,
+                                 im_shape=(last-first, self.m_im_shape[1], self.m_im_shape[2]),
+                                 indices=self.m_indices)
+
+        res_output = np.zeros((3, len(self.m_pca_numbers), self.m_im_shape[1],
+                               self.m_im_shape[2]))
+
+        for i, pca_number in enumerate(self.m_pca_numbers):
+            _, res_rot = residuals.subtract(pca_number,
+                                            angles,
+                                            interpolation=self.m_interpolation)
+
+            if self.m_requirements[0]:
+                res_output[0, i, ] = np.sum(res_rot, axis=0)
+
+            if self.m_requirements[2]:
+                res_output[1, i, ], res_output[2, i, ] = \
+                    noise_weighted_sums(res_rot, self.m_res_var.get_array()[i, ], angles)
+
+        return res_output
 
     def run_job(self, tmp_task):
         """
@@ -147,27 +232,31 @@ class PcaTaskProcessor(TaskProcessor):
             Output residuals.
         """
 
-        residuals, res_rot = pca_psf_subtraction(images=self.m_star_reshape,
-                                                 angles=self.m_angles,
-                                                 pca_number=tmp_task.m_input_data,
-                                                 pca_sklearn=self.m_pca_model,
-                                                 im_shape=self.m_im_shape,
-                                                 indices=self.m_indices)
+        if tmp_task.m_job_parameter is None:
+            res_output = self._run_frames(tmp_task.m_input_data[0], tmp_task.m_input_data[1])
 
-        res_output = np.zeros((4, res_rot.shape[1], res_rot.shape[2]))
+            sys.stdout.write('.')
+            sys.stdout.flush()
+
+            return TaskResult(res_output, None)
 
-        if self.m_requirements[0]:
-            res_output[0, ] = combine_residuals(method="mean", res_rot=res_rot)
+        if self.m_residuals is None:
+            self.m_residuals = PcaResiduals(images=self.m_star_reshape.get_array(),
+                                            pca_sklearn=self.m_pca_model,
+                                            im_shape=self.m_im_shape,
+                                            indices=self.m_indices)
+
+        # the tasks are created in order of PC number so the residuals of the previous task
+        # of this processor are updated
+        _, res_rot = self.m_residuals.subtract(tmp_task.m_input_data,
+                                               self.m_angles,
+                                               interpolation=self.m_interpolation)
+
+        res_output = np.zeros((4, res_rot.shape[1], res_rot.shape[2]))
 
         if self.m_requirements[1]:
             res_output[1, ] = combine_residuals(method="median", res_rot=res_rot)
 
-        if self.m_requirements[2]:
-            res_output[2, ] = combine_residuals(method="weighted",
-                                                res_rot=res_rot,
-                                                residuals=residuals,
-                                                angles=self.m_angles)
-
         if self.m_requirements[3]:
             res_output[3, ] = combine_residuals(method="clipped", res_rot=res_rot)
 
@@ -180,7 +269,9 @@ class PcaTaskProcessor(TaskProcessor):
 class PcaTaskWriter(TaskWriter):
     """
     The TaskWriter of the PCA parallelization. Four different ports are used to save the
-    results of the task processors (mean, median, weighted, and clipped).
+    results of the task processors (mean, median, weighted, and clipped). The partial sums of
+    the blocks of images are added by the writer and the mean and noise-weighted residuals are
+    written after all tasks are finished.
     """
 
     def __init__(self,
@@ -190,6 +281,7 @@ class PcaTaskWriter(TaskWriter):
                  weighted_out_port,
                  clip_out_port,
                  data_mutex_in,
+                 nimages,
                  requirements=(False, False, False, False)):
         """
         Constructor of PcaTaskWriter.
@@ -208,6 +300,8 @@ class PcaTaskWriter(TaskWriter):
             Output port with the clipped mean residuals. Not used if set to None.
         data_mutex_in : multiprocessing.synchronize.Lock
             A mutual exclusion variable which ensure that no read and write simultaneously occur.
+        nimages : int
+            Number of images.
         requirements : tuple(bool, bool, bool, bool)
             Required output residuals.
 
@@ -235,8 +329,38 @@ class PcaTaskWriter(TaskWriter):
         self.m_median_out_port = median_out_port
         self.m_weighted_out_port = weighted_out_port
         self.m_clip_out_port = clip_out_port
+        self.m_nimages = nimages
         self.m_requirements = requirements
 
+        # sums of the blocks of images, which are created by the writer process
+        self.m_sums = None
+
+    def _write_sums(self):
+        """
+        Internal function which writes the mean and noise-weighted residuals from the sums of the
+        blocks of images.
+
+        Returns
+        -------
+        NoneType
+            None
+        """
+
+        if self.m_sums is None:
+            return
+
+        with self.m_data_mutex:
+            if self.m_requirements[0]:
+                self.m_mean_out_port[...] = self.m_sums[0, ]/float(self.m_nimages)
+
+            if self.m_requirements[2]:
+                self.m_weighted_out_port[...] = \
+                    np.divide(self.m_sums[1, ],
+                              self.m_sums[2, ],
+                              out=np.zeros_like(self.m_sums[2, ]),
+                              where=(np.abs(self.m_sums[2, ]) > 1e-100) &
+                              (self.m_sums[2, ] != np.nan))
+
     def run(self):
         """
         Run method of PcaTaskWriter. Writes the residuals to the output ports.
@@ -252,24 +376,26 @@ class PcaTaskWriter(TaskWriter):
             poison_pill_case = self.check_poison_pill(next_result)
 
             if poison_pill_case == 1:
+                self._write_sums()
                 break
 
             elif poison_pill_case == 2:
                 continue
 
-            with self.m_data_mutex:
-                if self.m_requirements[0]:
-                    self.m_mean_out_port[to_slice(next_result.m_position)] = \
-                        next_result.m_data_array[0, :, :]
+            if next_result.m_position is None:
+                if self.m_sums is None:
+                    self.m_sums = next_result.m_data_array
+                else:
+                    self.m_sums += next_result.m_data_array
+
+                self.m_result_queue.task_done()
+                continue
 
+            with self.m_data_mutex:
                 if self.m_requirements[1]:
                     self.m_median_out_port[to_slice(next_result.m_position)] = \
                         next_result.m_data_array[1, :, :]
 
-                if self.m_requirements[2]:
-                    self.m_weighted_out_port[to_slice(next_result.m_position)] = \
-                        next_result.m_data_array[2, :, :]
-
                 if self.m_requirements[3]:
                     self.m_clip_out_port[to_slice(next_result.m_position)] = \
                         next_result.m_data_array[3, :, :]
@@ -293,7 +419,8 @@ class PcaMultiprocessingCapsule(MultiprocessingCapsule):
                  star_reshape,
                  angles,
                  im_shape,
-                 indices):
+                 indices,
+                 interpolation="spline"):
         """
         Constructor of PcaMultiprocessingCapsule.
 
@@ -314,13 +441,16 @@ class PcaMultiprocessingCapsule(MultiprocessingCapsule):
         pca_model : sklearn.decomposition.pca.PCA
             PCA object with the basis.
         star_reshape : numpy.ndarray
-            Reshaped (2D) input images.
+            Reshaped (2D) input images, which are copied to shared memory.
         angles : numpy.ndarray
             Derotation angles (deg).
         im_shape : tuple(int, int, int)
             Original shape of the input images.
         indices : numpy.ndarray
             Non-masked pixel indices.
+        interpolation : str
+            Interpolation of the derotated residuals (see
+            :func:`~pynpoint.util.image.rotate_images`).
 
         Returns
         -------
@@ -334,10 +464,10 @@ class PcaMultiprocessingCapsule(MultiprocessingCapsule):
         self.m_clip_out_port = clip_out_port
         self.m_pca_numbers = pca_numbers
         self.m_pca_model = pca_model
-        self.m_star_reshape = star_reshape
         self.m_angles = angles
         self.m_im_shape = im_shape
         self.m_indices = indices
+        self.m_interpolation = interpolation
 
         self.m_requirements = [False, False, False, False]
 
@@ -355,6 +485,28 @@ class PcaMultiprocessingCapsule(MultiprocessingCapsule):
 
         self.m_requirements = tuple(self.m_requirements)
 
+        # the images are shared by all processors instead of copied to each processor
+        self.m_star_reshape = SharedArray(star_reshape.shape, dtype=star_reshape.dtype)
+        self.m_star_reshape.get_array()[...] = star_reshape
+
+        # the noise-weighted residuals of a block of images require the variance of the
+        # residuals of all images, which is computed before the blocks are distributed
+        if self.m_requirements[2]:
+            self.m_res_var = SharedArray((len(pca_numbers), im_shape[1], im_shape[2]))
+
+            res_var = self.m_res_var.get_array().reshape(len(pca_numbers), -1)
+
+            residuals = PcaResiduals(images=star_reshape,
+                                     pca_sklearn=pca_model,
+                                     im_shape=im_shape,
+                                     indices=indices)
+
+            for i, pca_number in enumerate(pca_numbers):
+                res_var[i, indices] = np.var(residuals.get_residuals(pca_number), axis=0)
+
+        else:
+            self.m_res_var = None
+
         super(PcaMultiprocessingCapsule, self).__init__(None, None, num_processors)
 
     def create_writer(self, image_out_port):
@@ -378,6 +530,7 @@ class PcaMultiprocessingCapsule(MultiprocessingCapsule):
                                self.m_weighted_out_port,
                                self.m_clip_out_port,
                                self.m_data_mutex,
+                               self.m_im_shape[0],
                                self.m_requirements)
 
         return writer
@@ -399,7 +552,9 @@ class PcaMultiprocessingCapsule(MultiprocessingCapsule):
 
         creator = PcaTaskCreator(self.m_tasks_queue,
                                  self.m_num_processors,
-                                 self.m_pca_numbers)
+                                 self.m_pca_numbers,
+                                 self.m_im_shape[0],
+                                 self.m_requirements)
 
         return creator
 
@@ -423,6 +578,9 @@ class PcaMultiprocessingCapsule(MultiprocessingCapsule):
                                                self.m_pca_model,
                                                self.m_im_shape,
                                                self.m_indices,
-                                               self.m_requirements))
+                                               self.m_pca_numbers,
+                                               self.m_res_var,
+                                               self.m_requirements,
+                                               self.m_interpolation))
 
         return processors
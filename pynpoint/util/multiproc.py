@@ -4,6 +4,9 @@ implementation needed to process lines in time as used in the
 :class:`~pynpoint.processing.timedenoising.WaveletTimeDenoisingModule`
 """
 
+import sys
+import ctypes
+import warnings
 import multiprocessing
 
 from abc import ABCMeta, abstractmethod
@@ -343,6 +346,56 @@ class TaskWriter(multiprocessing.Process):
             self.m_result_queue.task_done()
 
 
+# ------ Shared memory ------
+class SharedArray(object):
+    """
+    Numpy array in shared memory which is allocated with multiprocessing.RawArray. An instance is
+    given to the TaskCreator, TaskProcessors, and TaskWriter of a multiprocessing capsule when they
+    are created, such that the processes inherit the memory and exchange data through views on the
+    same memory instead of pickled copies. Only indices (e.g. the slot of a task) should be send
+    through the queues.
+    """
+
+    def __init__(self,
+                 shape,
+                 dtype=np.float64):
+        """
+        Constructor of SharedArray.
+
+        Parameters
+        ----------
+        shape : tuple(int, )
+            Shape of the array.
+        dtype : numpy.dtype
+            Data type of the array.
+
+        Returns
+        -------
+        NoneType
+            None
+        """
+
+        self.m_shape = tuple(shape)
+        self.m_dtype = np.dtype(dtype)
+
+        size = int(np.prod(self.m_shape))*self.m_dtype.itemsize
+        self.m_memory = multiprocessing.RawArray(ctypes.c_char, max(size, 1))
+
+    def get_array(self):
+        """
+        Returns a numpy view on the shared memory.
+
+        Returns
+        -------
+        numpy.ndarray
+            Shared array.
+        """
+
+        count = int(np.prod(self.m_shape))
+
+        return np.frombuffer(self.m_memory, dtype=self.m_dtype, count=count).reshape(self.m_shape)
+
+
 # ------ Multiprocessing Capsule -------
 class MultiprocessingCapsule(six.with_metaclass(ABCMeta, object)):
     """
@@ -501,6 +554,179 @@ def apply_function(tmp_data,
     return np.array(func(tmp_data, *func_args))
 
 
+# ----- Pool of forked processes to apply a function to images ------
+
+# function and arguments that are inherited by the forked worker processes
+_FRAME_FUNCTION = {}
+
+
+def _init_frame_worker(func,
+                       func_args):
+    """
+    Initializer of the worker processes of :func:`~pynpoint.util.multiproc.frame_pool`.
+
+    Parameters
+    ----------
+    func : function
+        Function that is applied to the images.
+    func_args : tuple
+        Additional arguments of the function.
+
+    Returns
+    -------
+    NoneType
+        None
+    """
+
+    _FRAME_FUNCTION["func"] = func
+    _FRAME_FUNCTION["func_args"] = func_args
+
+
+def _apply_frame_worker(image):
+    """
+    Applies the function of the worker process to a single image.
+
+    Parameters
+    ----------
+    image : numpy.ndarray
+        Input image.
+
+    Returns
+    -------
+    numpy.ndarray
+        The result of the function.
+    """
+
+    return apply_function(image, _FRAME_FUNCTION["func"], _FRAME_FUNCTION["func_args"])
+
+
+def frame_pool(cpu,
+               func,
+               func_args,
+               picklable=False):
+    """
+    Creates a pool of worker processes which apply a function to individual images. The worker
+    processes are forked such that the function (e.g. a closure inside the run method of a
+    pipeline module) and its arguments are inherited instead of pickled.
+
+    Parameters
+    ----------
+    cpu : int
+        Number of worker processes.
+    func : function
+        Function that is applied to the images.
+    func_args : tuple
+        Additional arguments of the function.
+    picklable : bool
+        The function (e.g. a module-level function or a functools.partial of it) and its
+        arguments can be pickled. The worker processes are then spawned on platforms that do
+        not support forking, in which case the function and its arguments are pickled once for
+        each worker process.
+
+    Returns
+    -------
+    multiprocessing.pool.Pool
+        Pool of worker processes. None is returned, with a warning, if forking of processes is
+        not supported on the platform and *picklable* is False, in which case the images should
+        be processed serially.
+    """
+
+    if hasattr(multiprocessing, "get_context"):
+        if "fork" in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context("fork")
+
+        elif picklable:
+            context = multiprocessing.get_context("spawn")
+
+        else:
+            context = None
+
+        if context is not None:
+            return context.Pool(processes=cpu,
+                                initializer=_init_frame_worker,
+                                initargs=(func, func_args))
+
+    elif sys.platform != "win32" or picklable:
+        # Python 2 always forks the worker processes, except on Windows
+        return multiprocessing.Pool(processes=cpu,
+                                    initializer=_init_frame_worker,
+                                    initargs=(func, func_args))
+
+    warnings.warn("Forking of processes is not supported on this platform so the images are "
+                  "processed with a single process instead of CPU={}.".format(cpu))
+
+    return None
+
+
+def apply_function_pool(pool,
+                        images):
+    """
+    Applies the function of a :func:`~pynpoint.util.multiproc.frame_pool` to a stack of images.
+    The images are distributed over the worker processes and the results are returned in the
+    order of the input images.
+
+    Parameters
+    ----------
+    pool : multiprocessing.pool.Pool
+        Pool of worker processes.
+    images : numpy.ndarray
+        Stack of images.
+
+    Returns
+    -------
+    numpy.ndarray
+        The results of the function.
+    """
+
+    return np.asarray(pool.map(_apply_frame_worker, images))
+
+
+def map_function_pool(pool,
+                      items):
+    """
+    Applies the function of a :func:`~pynpoint.util.multiproc.frame_pool` to a sequence of
+    items, for example indices of image regions, of which the results can have different shapes.
+
+    Parameters
+    ----------
+    pool : multiprocessing.pool.Pool
+        Pool of worker processes.
+    items : list
+        Input items of the function.
+
+    Returns
+    -------
+    list
+        The results of the function, in the order of the input items.
+    """
+
+    return pool.map(_apply_frame_worker, items)
+
+
+def imap_function_pool(pool,
+                       items):
+    """
+    Applies the function of a :func:`~pynpoint.util.multiproc.frame_pool` to a sequence of
+    items. Each item is a separate task which is picked up by the next idle worker process, and
+    the results are returned as soon as they are finished, such that workers with long tasks
+    do not hold up the other workers.
+
+    Parameters
+    ----------
+    pool : multiprocessing.pool.Pool
+        Pool of worker processes.
+    items : list
+        Input items of the function.
+
+    Returns
+    -------
+    iterator
+        The results of the function, in the order in which they are finished.
+    """
+
+    return pool.imap_unordered(_apply_frame_worker, items, chunksize=1)
+
+
 def to_slice(tuple_slice):
     """
     This function is needed to pickle slices as reburied for multiprocessing queues.
@@ -525,14 +751,17 @@ def to_slice(tuple_slice):
 class LineTaskProcessor(TaskProcessor):
     """
     Line Task Processors are part of the parallel line processing. They take a row of lines in time
-    and apply a function to them.
+    and apply a function to them. The input rows and the results are exchanged through shared
+    memory, only the slot index of the rows is send through the queues.
     """
 
     def __init__(self,
                  tasks_queue_in,
                  result_queue_in,
                  function,
-                 function_args):
+                 function_args,
+                 shared_in,
+                 shared_out):
         """
         Parameters
         ----------
@@ -544,6 +773,10 @@ class LineTaskProcessor(TaskProcessor):
             Input function.
         function_args :
             Function arguments.
+        shared_in : pynpoint.util.multiproc.SharedArray
+            Shared memory with the input rows, one slot for each task.
+        shared_out : pynpoint.util.multiproc.SharedArray
+            Shared memory for the results, one slot for each task.
 
         Returns
         -------
@@ -555,22 +788,25 @@ class LineTaskProcessor(TaskProcessor):
 
         self.m_function = function
         self.m_function_args = function_args
+        self.m_shared_in = shared_in
+        self.m_shared_out = shared_out
 
     def run_job(self,
                 tmp_task):
-        result_arr = np.zeros((tmp_task.m_job_parameter[0],
-                               tmp_task.m_input_data.shape[1],
-                               tmp_task.m_input_data.shape[2]))
+        slot, nrows = tmp_task.m_input_data
+
+        input_data = self.m_shared_in.get_array()[slot, :, :nrows, :]
+        result_arr = self.m_shared_out.get_array()[slot, :tmp_task.m_job_parameter[0], :nrows, :]
 
-        for i in six.moves.range(tmp_task.m_input_data.shape[1]):
-            for j in six.moves.range(tmp_task.m_input_data.shape[2]):
-                tmp_line = tmp_task.m_input_data[:, i, j]
+        for i in six.moves.range(input_data.shape[1]):
+            for j in six.moves.range(input_data.shape[2]):
+                tmp_line = input_data[:, i, j]
 
                 result_arr[:, i, j] = apply_function(tmp_line,
                                                      self.m_function,
                                                      self.m_function_args)
 
-        result = TaskResult(result_arr, tmp_task.m_job_parameter[1])
+        result = TaskResult((slot, nrows), tmp_task.m_job_parameter[1])
 
         return result
 
@@ -578,7 +814,7 @@ class LineTaskProcessor(TaskProcessor):
 class LineReader(TaskCreator):
     """
     Line Reader are part of the parallel line processing. They continuously read all rows of a data
-    set and puts them into a task queue.
+    set, copy them into the shared memory, and put the slot index into a task queue.
     """
 
     def __init__(self,
@@ -586,7 +822,8 @@ class LineReader(TaskCreator):
                  tasks_queue_in,
                  data_mutex_in,
                  number_of_processors,
-                 data_length):
+                 data_length,
+                 shared_in):
         """
         Parameters
         ----------
@@ -601,6 +838,8 @@ class LineReader(TaskCreator):
             Number of processors.
         data_length : int
             Length of the processed data.
+        shared_in : pynpoint.util.multiproc.SharedArray
+            Shared memory for the input rows, one slot for each task.
 
         Returns
         -------
@@ -614,6 +853,7 @@ class LineReader(TaskCreator):
                                          number_of_processors)
 
         self.m_data_length = data_length
+        self.m_shared_in = shared_in
 
     def run(self):
         """
@@ -624,33 +864,106 @@ class LineReader(TaskCreator):
         """
 
         total_number_of_rows = self.m_data_in_port.get_shape()[1]
-        row_length = int(np.ceil(self.m_data_in_port.get_shape()[1] /
-                                 float(self.m_number_of_processors)))
+        row_length = self.m_shared_in.m_shape[2]
+
+        shared_in = self.m_shared_in.get_array()
 
         i = 0
+        slot = 0
+
         while i < total_number_of_rows:
             # read rows from i to j
             j = min((i + row_length), total_number_of_rows)
 
             # lock Mutex and read data
             with self.m_data_mutex:
-                # print "Reading lines from " + str(i) + " to " + str(j)
-                tmp_data = self.m_data_in_port[:, i:j, :]
+                shared_in[slot, :, :j-i, :] = self.m_data_in_port[:, i:j, :]
 
-            self.m_task_queue.put(TaskInput(tmp_data,
+            self.m_task_queue.put(TaskInput((slot, j-i),
                                             (self.m_data_length,
                                              ((None, None, None),
                                               (i, j, None),
                                               (None, None, None)))))
             i = j
+            slot += 1
 
         self.create_poison_pills()
 
 
+class LineTaskWriter(TaskWriter):
+    """
+    The TaskWriter of the parallel line processing. The results are read from the shared memory
+    and stored in the central database.
+    """
+
+    def __init__(self,
+                 result_queue_in,
+                 data_out_port_in,
+                 data_mutex_in,
+                 data_length,
+                 shared_out):
+        """
+        Parameters
+        ----------
+        result_queue_in : multiprocessing.queues.JoinableQueue
+            The result queue.
+        data_out_port_in : pynpoint.core.dataio.OutputPort
+            The output port where the results are stored.
+        data_mutex_in : multiprocessing.synchronize.Lock
+            A mutex shared with the writer to ensure that no read and write operations happen at
+            the same time.
+        data_length : int
+            Length of the processed data.
+        shared_out : pynpoint.util.multiproc.SharedArray
+            Shared memory with the results, one slot for each task.
+
+        Returns
+        -------
+        NoneType
+            None
+        """
+
+        super(LineTaskWriter, self).__init__(result_queue_in, data_out_port_in, data_mutex_in)
+
+        self.m_data_length = data_length
+        self.m_shared_out = shared_out
+
+    def run(self):
+        """
+        Run method of the LineTaskWriter. Writes the results to the output port.
+
+        Returns
+        -------
+        NoneType
+            None
+        """
+
+        shared_out = self.m_shared_out.get_array()
+
+        while True:
+            next_result = self.m_result_queue.get()
+
+            # Poison Pill
+            poison_pill_case = self.check_poison_pill(next_result)
+            if poison_pill_case == 1:
+                break
+            if poison_pill_case == 2:
+                continue
+
+            slot, nrows = next_result.m_data_array
+
+            with self.m_data_mutex:
+                self.m_data_out_port[to_slice(next_result.m_position)] = \
+                    shared_out[slot, :self.m_data_length, :nrows, :]
+
+            self.m_result_queue.task_done()
+
+
 class LineProcessingCapsule(MultiprocessingCapsule):
     """
     The central processing class for parallel line processing. Use this class to apply a function
-    in time in parallel.
+    in time in parallel. The rows of the dataset and the results are exchanged between the
+    processes through shared memory.
     """
 
     def __init__(self,
@@ -686,8 +999,37 @@ class LineProcessingCapsule(MultiprocessingCapsule):
         self.m_function_args = function_args
         self.m_data_length = data_length
 
+        # each task processes a row slab of the images and uses its own slot of the shared memory
+        im_shape = image_in_port.get_shape()
+        row_length = int(np.ceil(im_shape[1] / float(num_processors)))
+        ntasks = int(np.ceil(im_shape[1] / float(row_length)))
+
+        self.m_shared_in = SharedArray((ntasks, im_shape[0], row_length, im_shape[2]),
+                                       dtype=image_in_port[0, 0, 0].dtype)
+        self.m_shared_out = SharedArray((ntasks, data_length, row_length, im_shape[2]))
+
         super(LineProcessingCapsule, self).__init__(image_in_port, image_out_port, num_processors)
 
+    def create_writer(self,
+                      image_out_port):
+        """
+        Parameters
+        ----------
+        image_out_port : pynpoint.core.dataio.OutputPort
+            Output port.
+
+        Returns
+        -------
+        pynpoint.util.multiproc.LineTaskWriter
+            Line task writer.
+        """
+
+        return LineTaskWriter(self.m_result_queue,
+                              image_out_port,
+                              self.m_data_mutex,
+                              self.m_data_length,
+                              self.m_shared_out)
+
     def create_processors(self):
         """
         Returns
@@ -703,7 +1045,9 @@ class LineProcessingCapsule(MultiprocessingCapsule):
             tmp_processors.append(LineTaskProcessor(tasks_queue_in=self.m_tasks_queue,
                                                     result_queue_in=self.m_result_queue,
                                                     function=self.m_function,
-                                                    function_args=self.m_function_args))
+                                                    function_args=self.m_function_args,
+                                                    shared_in=self.m_shared_in,
+                                                    shared_out=self.m_shared_out))
 
         return tmp_processors
 
@@ -725,4 +1069,5 @@ class LineProcessingCapsule(MultiprocessingCapsule):
                           self.m_tasks_queue,
                           self.m_data_mutex,
                           self.m_num_processors,
-                          self.m_data_length)
+                          self.m_data_length,
+                          self.m_shared_in)
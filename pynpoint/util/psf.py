@@ -6,8 +6,156 @@ from __future__ import absolute_import
 
 import numpy as np
 
-from scipy.ndimage import rotate
-from sklearn.decomposition import PCA
+from sklearn.decomposition import PCA, IncrementalPCA
+
+from pynpoint.util.image import rotate_images
+
+
+class GramPCA(object):
+    """
+    PCA with an eigendecomposition of the Gram matrix of the mean-subtracted images, which has
+    the size of the number of images instead of the number of pixels. This is much faster than a
+    singular value decomposition if the number of images is small compared to the number of
+    pixels. The class has the same attributes and methods as the scikit-learn PCA, as far as
+    they are used for the PSF subtraction.
+    """
+
+    def __init__(self,
+                 n_components):
+        """
+        Constructor of GramPCA.
+
+        Parameters
+        ----------
+        n_components : int
+            Number of principal components.
+
+        Returns
+        -------
+        NoneType
+            None
+        """
+
+        self.n_components = n_components
+
+        self.components_ = None
+        self.explained_variance_ = None
+        self.mean_ = None
+
+    def fit(self,
+            data):
+        """
+        Function for constructing the principal components.
+
+        Parameters
+        ----------
+        data : numpy.ndarray
+            Stack of images in the 2D reshaped format.
+
+        Returns
+        -------
+        pynpoint.util.psf.GramPCA
+            The fitted instance.
+        """
+
+        if self.n_components > data.shape[0]:
+            raise ValueError("The number of principal components is larger than the number of "
+                             "images.")
+
+        self.mean_ = np.mean(data, axis=0)
+        data = data - self.mean_
+
+        # eigenvalues in ascending order
+        eigen_val, eigen_vec = np.linalg.eigh(np.matmul(data, data.T))
+
+        eigen_val = eigen_val[::-1][:self.n_components]
+        eigen_vec = eigen_vec[:, ::-1][:, :self.n_components]
+
+        # components without variance (e.g. beyond the rank of the data) are set to zero
+        sing_val = np.sqrt(np.clip(eigen_val, 0., None))
+        scale = np.zeros(sing_val.shape)
+        valid = sing_val > sing_val[0]*1e-12
+        scale[valid] = 1./sing_val[valid]
+
+        self.components_ = np.matmul(eigen_vec.T, data)*scale[:, np.newaxis]
+        self.explained_variance_ = eigen_val/(data.shape[0]-1)
+
+        return self
+
+    def transform(self,
+                  data):
+        """
+        Function for projecting images onto the principal components.
+
+        Parameters
+        ----------
+        data : numpy.ndarray
+            Stack of images in the 2D reshaped format.
+
+        Returns
+        -------
+        numpy.ndarray
+            PCA coefficients.
+        """
+
+        return np.matmul(data - self.mean_, self.components_.T)
+
+    def inverse_transform(self,
+                          data):
+        """
+        Function for creating images from PCA coefficients.
+
+        Parameters
+        ----------
+        data : numpy.ndarray
+            PCA coefficients.
+
+        Returns
+        -------
+        numpy.ndarray
+            Stack of images in the 2D reshaped format.
+        """
+
+        return np.matmul(data, self.components_) + self.mean_
+
+
+def create_pca(n_components,
+               solver="arpack"):
+    """
+    Function for creating the PCA object that is used to construct the basis for the PSF
+    subtraction.
+
+    Parameters
+    ----------
+    n_components : int
+        Number of principal components.
+    solver : str
+        Algorithm that constructs the principal components: "arpack" (truncated singular value
+        decomposition), "randomized" (randomized singular value decomposition, fastest if only a
+        small number of components is needed), "gram" (eigendecomposition of the Gram matrix,
+        fastest if the number of images is small compared to the number of pixels), or
+        "incremental" (incremental PCA in batches of images, requires the least memory).
+
+    Returns
+    -------
+    sklearn.decomposition.PCA, sklearn.decomposition.IncrementalPCA, or pynpoint.util.psf.GramPCA
+        PCA object.
+    """
+
+    if solver in ("arpack", "randomized"):
+        pca_sklearn = PCA(n_components=n_components, svd_solver=solver)
+
+    elif solver == "gram":
+        pca_sklearn = GramPCA(n_components=n_components)
+
+    elif solver == "incremental":
+        pca_sklearn = IncrementalPCA(n_components=n_components)
+
+    else:
+        raise ValueError("The PCA solver should be 'arpack', 'randomized', 'gram', or "
+                         "'incremental'.")
+
+    return pca_sklearn
 
 
 def pca_psf_subtraction(images,
@@ -15,7 +163,9 @@ def pca_psf_subtraction(images,
                         pca_number,
                         pca_sklearn=None,
                         im_shape=None,
-                        indices=None):
+                        indices=None,
+                        solver="arpack",
+                        interpolation="spline"):
     """
     Function for PSF subtraction with PCA.
 
@@ -34,6 +184,12 @@ def pca_psf_subtraction(images,
     indices : numpy.ndarray
         Non-masked image indices, required if `pca_sklearn` is not set to None. Optional if
         `pca_sklearn` is set to None.
+    solver : str
+        Algorithm that constructs the PCA basis if `pca_sklearn` is set to None (see
+        :func:`~pynpoint.util.psf.create_pca`).
+    interpolation : str
+        Interpolation of the derotated residuals (see
+        :func:`~pynpoint.util.image.rotate_images`).
 
     Returns
     -------
@@ -44,7 +200,7 @@ def pca_psf_subtraction(images,
     """
 
     if pca_sklearn is None:
-        pca_sklearn = PCA(n_components=pca_number, svd_solver="arpack")
+        pca_sklearn = create_pca(pca_number, solver=solver)
 
         im_shape = images.shape
 
@@ -84,8 +240,149 @@ def pca_psf_subtraction(images,
     residuals = residuals.reshape(im_shape)
 
     # derotate the images
-    res_rot = np.zeros(residuals.shape)
-    for j, item in enumerate(angles):
-        res_rot[j, ] = rotate(residuals[j, ], item, reshape=False)
+    res_rot = rotate_images(residuals, angles, interpolation=interpolation)
 
     return residuals, res_rot
+
+
+class PcaResiduals(object):
+    """
+    Class for creating the residuals of the PSF subtraction with PCA for a sequence of principal
+    component numbers. The PCA coefficients of the images are computed once and the residuals are
+    updated with the difference in principal components between the requested PC numbers instead
+    of creating the full PSF model for each PC number. The basis is orthonormal so the residuals
+    with k+1 components are the residuals with k components minus a single rank-1 term. The cost
+    of a sweep over K principal components is therefore proportional to K instead of K^2. The
+    residuals are identical to the residuals of
+    :func:`~pynpoint.util.psf.pca_psf_subtraction` apart from rounding errors.
+    """
+
+    def __init__(self,
+                 images,
+                 pca_sklearn,
+                 im_shape,
+                 indices):
+        """
+        Constructor of PcaResiduals.
+
+        Parameters
+        ----------
+        images : numpy.ndarray
+            Stack of images in the 2D reshaped format with only the non-masked pixels.
+        pca_sklearn : sklearn.decomposition.pca.PCA
+            PCA object with the basis.
+        im_shape : tuple(int, int, int)
+            Original shape of the stack with images.
+        indices : numpy.ndarray
+            Non-masked image indices.
+
+        Returns
+        -------
+        NoneType
+            None
+        """
+
+        self.m_components = pca_sklearn.components_
+        self.m_mean = pca_sklearn.mean_
+        self.m_im_shape = im_shape
+        self.m_indices = indices
+
+        # coefficients of all principal components
+        self.m_coefficients = np.matmul(images, self.m_components.T)
+
+        self.m_images = images
+        self.m_residuals = None
+        self.m_pca_number = 0
+
+    def _update(self,
+                pca_number):
+        """
+        Internal function which updates the residuals to the requested number of principal
+        components. The residuals are created again from the images if that requires fewer
+        components than updating the current residuals.
+
+        Parameters
+        ----------
+        pca_number : int
+            Number of principal components used for the PSF model.
+
+        Returns
+        -------
+        NoneType
+            None
+        """
+
+        if self.m_residuals is None or pca_number < abs(pca_number - self.m_pca_number):
+            self.m_residuals = self.m_images - self.m_mean
+            self.m_pca_number = 0
+
+        if pca_number > self.m_pca_number:
+            self.m_residuals -= np.matmul(self.m_coefficients[:, self.m_pca_number:pca_number],
+                                          self.m_components[self.m_pca_number:pca_number])
+
+        elif pca_number < self.m_pca_number:
+            self.m_residuals += np.matmul(self.m_coefficients[:, pca_number:self.m_pca_number],
+                                          self.m_components[pca_number:self.m_pca_number])
+
+        self.m_pca_number = pca_number
+
+    def get_residuals(self,
+                      pca_number):
+        """
+        Function for getting the residuals of the non-masked pixels for a given number of
+        principal components.
+
+        Parameters
+        ----------
+        pca_number : int
+            Number of principal components used for the PSF model.
+
+        Returns
+        -------
+        numpy.ndarray
+            Residuals of the non-masked pixels in the 2D reshaped format.
+        """
+
+        self._update(pca_number)
+
+        return np.copy(self.m_residuals)
+
+    def subtract(self,
+                 pca_number,
+                 angles,
+                 interpolation="spline"):
+        """
+        Function for the PSF subtraction with a given number of principal components. The
+        residuals are most efficiently created in order of increasing PC number.
+
+        Parameters
+        ----------
+        pca_number : int
+            Number of principal components used for the PSF model.
+        angles : numpy.ndarray
+            Derotation angles (deg).
+        interpolation : str
+            Interpolation of the derotated residuals (see
+            :func:`~pynpoint.util.image.rotate_images`).
+
+        Returns
+        -------
+        numpy.ndarray
+            Residuals of the PSF subtraction.
+        numpy.ndarray
+            Derotated residuals of the PSF subtraction.
+        """
+
+        self._update(pca_number)
+
+        # create original array size
+        residuals = np.zeros((self.m_im_shape[0], self.m_im_shape[1]*self.m_im_shape[2]))
+        residuals[:, self.m_indices] = self.m_residuals
+
+        # reshape to the original image size
+        residuals = residuals.reshape(self.m_im_shape)
+
+        # derotate the images
+        res_rot = rotate_images(residuals, angles, interpolation=interpolation)
+
+        return residuals, res_rot
@@ -1,5 +1,6 @@
 """
-Functions for combining the residuals of the PSF subtraction.
+Functions for combining the residuals of the PSF subtraction, and streaming combiners for stacks
+of images that are processed in blocks.
 """
 
 from __future__ import absolute_import
@@ -13,7 +14,9 @@ from six.moves import range
 def combine_residuals(method,
                       res_rot,
                       residuals=None,
-                      angles=None):
+                      angles=None,
+                      sigma=3.,
+                      iterations=1):
     """
     Function for combining the derotated residuals of the PSF subtraction.
 
@@ -28,6 +31,13 @@ def combine_residuals(method,
         residuals.
     angles : numpy.ndimage
         Derotation angles (deg). Only required for the noise-weighted residuals.
+    sigma : float
+        Clipping threshold in units of the standard deviation. Only used for the clipped mean of
+        the residuals.
+    iterations : int
+        Number of clipping iterations. The mean and standard deviation of the values that
+        remain after an iteration are used for the next iteration. Only used for the clipped
+        mean of the residuals.
 
     Returns
     -------
@@ -44,29 +54,7 @@ def combine_residuals(method,
     elif method == "weighted":
         tmp_res_var = np.var(residuals, axis=0)
 
-        res_repeat = np.repeat(tmp_res_var[np.newaxis, :, :],
-                               repeats=residuals.shape[0],
-                               axis=0)
-
-        res_var = np.zeros(res_repeat.shape)
-        for j, angle in enumerate(angles):
-            # scipy.ndimage.rotate rotates in clockwise direction for positive angles
-            res_var[j, ] = rotate(input=res_repeat[j, ],
-                                  angle=angle,
-                                  reshape=False)
-
-        weight1 = np.divide(res_rot,
-                            res_var,
-                            out=np.zeros_like(res_var),
-                            where=(np.abs(res_var) > 1e-100) & (res_var != np.nan))
-
-        weight2 = np.divide(1.,
-                            res_var,
-                            out=np.zeros_like(res_var),
-                            where=(np.abs(res_var) > 1e-100) & (res_var != np.nan))
-
-        sum1 = np.sum(weight1, axis=0)
-        sum2 = np.sum(weight2, axis=0)
+        sum1, sum2 = noise_weighted_sums(res_rot, tmp_res_var, angles)
 
         stack = np.divide(sum1,
                           sum2,
@@ -74,20 +62,490 @@ def combine_residuals(method,
                           where=(np.abs(sum2) > 1e-100) & (sum2 != np.nan))
 
     elif method == "clipped":
-        stack = np.zeros(res_rot.shape[-2:])
+        res_mean = np.mean(res_rot, axis=0)
+        no_mean = res_rot - res_mean
+
+        res_var = np.var(no_mean, axis=0)
 
-        for i in range(stack.shape[0]):
-            for j in range(stack.shape[1]):
-                temp = res_rot[:, i, j]
+        # the first iteration is centered on the mean with the standard deviation of all values
+        center = np.zeros(res_mean.shape)
+        std = np.sqrt(res_var)
 
-                if temp.var() > 0.0:
-                    no_mean = temp - temp.mean()
+        for _ in range(iterations):
+            select = (no_mean < center+sigma*std) & (no_mean > center-sigma*std)
+            count = np.sum(select, axis=0)
 
-                    part1 = no_mean.compress((no_mean < 3.0*np.sqrt(no_mean.var())).flat)
-                    part2 = part1.compress((part1 > (-1.0)*3.0*np.sqrt(no_mean.var())).flat)
+            center = np.divide(np.sum(no_mean*select, axis=0),
+                               count,
+                               out=np.zeros(count.shape),
+                               where=count > 0)
 
-                    stack[i, j] = temp.mean() + part2.mean()
+            std = np.divide(np.sum(select*(no_mean-center)**2, axis=0),
+                            count,
+                            out=np.zeros(count.shape),
+                            where=count > 0)
+
+            std = np.sqrt(std)
+
+        # pixels without variation are set to zero
+        stack = np.where(res_var > 0., res_mean+center, 0.)
 
     stack = stack[np.newaxis, ...]
 
     return stack
+
+
+def noise_weighted_sums(res_rot,
+                        res_var,
+                        angles):
+    """
+    Function for computing the sums of the noise-weighted residuals. The noise-weighted residuals
+    are the ratio of the two sums, which can be accumulated separately for subsets of the images
+    and added afterwards.
+
+    Parameters
+    ----------
+    res_rot : numpy.ndimage
+        Derotated residuals of the PSF subtraction (3D).
+    res_var : numpy.ndimage
+        Variance of the non-derotated residuals (2D), computed with all images.
+    angles : numpy.ndimage
+        Derotation angles (deg) of the images in *res_rot*.
+
+    Returns
+    -------
+    numpy.ndimage
+        Sum of the derotated residuals divided by the derotated variance.
+    numpy.ndimage
+        Sum of the inverse of the derotated variance.
+    """
+
+    sum1 = np.zeros(res_rot.shape[-2:])
+    sum2 = np.zeros(res_rot.shape[-2:])
+
+    # the variance map is rotated once for each unique angle and only the rotated map of the
+    # current angle is kept in memory
+    unique_angles, angle_index = np.unique(angles, return_inverse=True)
+
+    for i, angle in enumerate(unique_angles):
+        # scipy.ndimage.rotate rotates in clockwise direction for positive angles
+        tmp_var = rotate(input=res_var,
+                         angle=angle,
+                         reshape=False)
+
+        inv_var = np.divide(1.,
+                            tmp_var,
+                            out=np.zeros_like(tmp_var),
+                            where=(np.abs(tmp_var) > 1e-100) & (tmp_var != np.nan))
+
+        for j in np.where(angle_index == i)[0]:
+            sum1 += np.divide(res_rot[j, ],
+                              tmp_var,
+                              out=np.zeros_like(tmp_var),
+                              where=(np.abs(tmp_var) > 1e-100) & (tmp_var != np.nan))
+
+            sum2 += inv_var
+
+    return sum1, sum2
+
+
+class StreamingMean(object):
+    """
+    Class for the running mean and variance of a stack of images that is provided in blocks. The
+    mean and sum of squared deviations of each block are merged with the pairwise algorithm of
+    Chan et al. (1979), such that only two images are kept in memory.
+    """
+
+    def __init__(self):
+        """
+        Constructor of StreamingMean.
+
+        Returns
+        -------
+        NoneType
+            None
+        """
+
+        self.m_count = 0
+        self.m_mean = None
+        self.m_m2 = None
+
+    def update(self,
+               images):
+        """
+        Function for adding a block of images.
+
+        Parameters
+        ----------
+        images : numpy.ndarray
+            Block of images (3D).
+
+        Returns
+        -------
+        NoneType
+            None
+        """
+
+        nimages = images.shape[0]
+
+        if nimages == 0:
+            return
+
+        block_mean = np.mean(images, axis=0)
+        block_m2 = np.sum((images-block_mean)**2, axis=0)
+
+        if self.m_mean is None:
+            self.m_mean = block_mean
+            self.m_m2 = block_m2
+
+        else:
+            count = self.m_count + nimages
+
+            with np.errstate(invalid="ignore"):
+                delta = block_mean - self.m_mean
+
+                mean = self.m_mean + delta*float(nimages)/float(count)
+                self.m_m2 += block_m2 + delta**2*float(self.m_count)*float(nimages)/float(count)
+
+                # the means of pixels with infinite values are combined directly, which gives
+                # the same result as numpy.mean (e.g. inf instead of inf-inf)
+                finite = np.isfinite(self.m_mean) & np.isfinite(block_mean)
+
+                if not np.all(finite):
+                    mean = np.where(finite,
+                                    mean,
+                                    (self.m_mean*float(self.m_count) +
+                                     block_mean*float(nimages))/float(count))
+
+            self.m_mean = mean
+
+        self.m_count += nimages
+
+    def get_mean(self):
+        """
+        Function for getting the mean of the images that have been added.
+
+        Returns
+        -------
+        numpy.ndarray
+            Mean image.
+        """
+
+        return self.m_mean
+
+    def get_variance(self):
+        """
+        Function for getting the (population) variance of the images that have been added.
+
+        Returns
+        -------
+        numpy.ndarray
+            Variance image.
+        """
+
+        return self.m_m2/float(self.m_count)
+
+
+class StreamingMedian(object):
+    """
+    Class for the exact median of a stack of images that is provided in blocks. The stack is
+    processed in several passes. The first pass determines the range of each pixel. The following
+    passes create a histogram of each pixel and narrow the range to the bins that contain the
+    median, until these bins contain at most *bins* values. The last pass collects the values in
+    the remaining bins, from which the median is selected. The memory usage is therefore
+    proportional to the number of pixels times the number of bins instead of the number of
+    images. Pixels with a constant value are completed after the first pass and pixels with a NaN
+    value have a NaN median, identical to numpy.median. Each pass requires
+    all blocks of the stack, in the same order, followed by a call of
+    :meth:`~pynpoint.util.residuals.StreamingMedian.next_pass`:
+
+    .. code-block:: python
+
+        median = StreamingMedian(nimages)
+
+        while True:
+            for images in blocks:
+                median.update(images)
+
+            if not median.next_pass():
+                break
+
+        image = median.get_median()
+    """
+
+    def __init__(self,
+                 nimages,
+                 bins=64,
+                 max_levels=4):
+        """
+        Constructor of StreamingMedian.
+
+        Parameters
+        ----------
+        nimages : int
+            Total number of images in the stack.
+        bins : int
+            Number of histogram bins per pixel. Also the number of values per pixel which are
+            kept in memory for the last pass.
+        max_levels : int
+            Maximum number of histogram passes. The values are collected after the last
+            histogram pass, also if the bins contain more than *bins* values, which can be the
+            case if a pixel contains many identical values.
+
+        Returns
+        -------
+        NoneType
+            None
+        """
+
+        self.m_nimages = nimages
+        self.m_bins = bins
+        self.m_max_levels = max_levels
+
+        self.m_stage = "range"
+        self.m_shape = None
+
+        # properties of each histogram level, with the bins of the median for the completed levels
+        self.m_levels = []
+
+        self.m_min = None
+        self.m_max = None
+        self.m_nan = None
+        self.m_done = None
+        self.m_below = None
+        self.m_counts = None
+        self.m_buffer = None
+        self.m_filled = None
+        self.m_median = None
+
+    def _bin(self,
+             values,
+             level):
+        """
+        Internal function which computes the histogram bin of each value for a given level.
+
+        Parameters
+        ----------
+        values : numpy.ndarray
+            Block of images in the 2D reshaped format.
+        level : dict
+            Lower limit and bin width of each pixel.
+
+        Returns
+        -------
+        numpy.ndarray
+            Bin indices.
+        """
+
+        with np.errstate(invalid="ignore"):
+            index = np.floor((values-level["lower"])/level["width"])
+
+        # non-finite values are not selected but still require a valid index
+        index = np.clip(np.nan_to_num(index), 0, self.m_bins-1)
+
+        return index.astype(np.int64)
+
+    def _select(self,
+                values):
+        """
+        Internal function which selects the values that are in the median bins of all completed
+        levels.
+
+        Parameters
+        ----------
+        values : numpy.ndarray
+            Block of images in the 2D reshaped format.
+
+        Returns
+        -------
+        numpy.ndarray
+            Boolean selection of the values.
+        """
+
+        select = np.repeat(~self.m_done[np.newaxis, :], values.shape[0], axis=0)
+        select &= ~np.isnan(values)
+
+        for level in self.m_levels:
+            if "first" in level:
+                index = self._bin(values, level)
+                select &= (index >= level["first"]) & (index <= level["last"])
+
+        return select
+
+    def update(self,
+               images):
+        """
+        Function for adding a block of images to the current pass.
+
+        Parameters
+        ----------
+        images : numpy.ndarray
+            Block of images (3D).
+
+        Returns
+        -------
+        NoneType
+            None
+        """
+
+        if self.m_shape is None:
+            self.m_shape = images.shape[1:]
+
+        values = images.reshape(images.shape[0], -1)
+
+        if self.m_stage == "range":
+            if self.m_min is None:
+                self.m_min = np.amin(values, axis=0)
+                self.m_max = np.amax(values, axis=0)
+                self.m_nan = np.any(np.isnan(values), axis=0)
+
+            else:
+                self.m_min = np.minimum(self.m_min, np.amin(values, axis=0))
+                self.m_max = np.maximum(self.m_max, np.amax(values, axis=0))
+                self.m_nan |= np.any(np.isnan(values), axis=0)
+
+        elif self.m_stage == "histogram":
+            select = self._select(values)
+            index = self._bin(values, self.m_levels[-1])
+
+            # flattened index of the pixel and bin
+            index += np.arange(values.shape[1])*self.m_bins
+
+            self.m_counts += np.bincount(index[select], minlength=self.m_counts.size)
+
+        elif self.m_stage == "collect":
+            select = self._select(values)
+
+            for i in range(values.shape[0]):
+                pixels = np.where(select[i, ])[0]
+
+                self.m_buffer[pixels, self.m_filled[pixels]] = values[i, pixels]
+                self.m_filled[pixels] += 1
+
+    def _start_collect(self,
+                       count):
+        """
+        Internal function which allocates the buffer for the values in the median bins.
+
+        Parameters
+        ----------
+        count : numpy.ndarray
+            Number of values in the median bins of each pixel.
+
+        Returns
+        -------
+        NoneType
+            None
+        """
+
+        size = np.amax(count[~self.m_done]) if np.any(~self.m_done) else 0
+
+        # empty elements are sorted after the collected values
+        self.m_buffer = np.full((count.size, max(size, 1)), np.inf)
+        self.m_filled = np.zeros(count.size, dtype=np.int64)
+
+        self.m_stage = "collect"
+
+    def next_pass(self):
+        """
+        Function which completes the current pass through the stack of images.
+
+        Returns
+        -------
+        bool
+            True if another pass through the stack of images is required, False if the median
+            has been computed.
+        """
+
+        npix = self.m_min.size
+
+        if self.m_stage == "range":
+            self.m_done = (self.m_min == self.m_max) | self.m_nan
+            self.m_below = np.zeros(npix, dtype=np.int64)
+
+            self.m_median = np.where(self.m_done, self.m_min, 0.)
+            self.m_median[self.m_nan] = np.nan
+
+            # the range of the pixels with NaN values is not used for the histograms
+            self.m_min = np.where(self.m_nan, 0., self.m_min)
+            self.m_max = np.where(self.m_nan, 0., self.m_max)
+
+            if self.m_nimages <= self.m_bins:
+                self._start_collect(np.full(npix, self.m_nimages))
+
+            else:
+                width = np.where(self.m_done, 1., (self.m_max-self.m_min)/float(self.m_bins))
+
+                self.m_levels.append({"lower": self.m_min, "width": width})
+                self.m_counts = np.zeros(npix*self.m_bins, dtype=np.int64)
+
+                self.m_stage = "histogram"
+
+            return True
+
+        if self.m_stage == "histogram":
+            counts = self.m_counts.reshape(npix, self.m_bins)
+            cumulative = np.cumsum(counts, axis=1)
+
+            pixels = np.arange(npix)
+            level = self.m_levels[-1]
+
+            # order of the two central values within the values of the current level
+            first = np.argmax(cumulative > ((self.m_nimages-1)//2-self.m_below)[:, np.newaxis],
+                              axis=1)
+
+            last = np.argmax(cumulative > (self.m_nimages//2-self.m_below)[:, np.newaxis],
+                             axis=1)
+
+            below = cumulative[pixels, first] - counts[pixels, first]
+            count = cumulative[pixels, last] - below
+
+            level["first"] = first
+            level["last"] = last
+
+            self.m_below += below
+
+            if np.amax(np.where(self.m_done, 0, count)) <= self.m_bins or \
+                    len(self.m_levels) == self.m_max_levels:
+                self.m_counts = None
+                self._start_collect(count)
+
+            else:
+                # infinite values give non-finite bin limits, which are handled by _bin
+                with np.errstate(invalid="ignore"):
+                    lower = level["lower"]+first*level["width"]
+                    width = (last-first+1)*level["width"]/float(self.m_bins)
+
+                self.m_levels.append({"lower": lower, "width": width})
+
+                self.m_counts[:] = 0
+
+            return True
+
+        self.m_buffer.sort(axis=1)
+
+        pixels = np.where(~self.m_done)[0]
+        below = self.m_below[pixels]
+
+        value1 = self.m_buffer[pixels, (self.m_nimages-1)//2-below]
+        value2 = self.m_buffer[pixels, self.m_nimages//2-below]
+
+        self.m_median[pixels] = (value1+value2)/2.
+
+        self.m_buffer = None
+        self.m_filled = None
+        self.m_stage = "done"
+
+        return False
+
+    def get_median(self):
+        """
+        Function for getting the median after the last pass.
+
+        Returns
+        -------
+        numpy.ndarray
+            Median image.
+        """
+
+        return self.m_median.reshape(self.m_shape)
@@ -124,3 +124,83 @@ class TestInputPort(object):
 
         port = InputPort('images', self.storage)
         assert port.get_ndim() == 3
+
+    def test_cached_metadata(self):
+        out_port = OutputPort('cache', self.storage)
+        out_port.set_all(np.zeros((2, 5, 5)))
+        out_port.add_attribute('PIXSCALE', 0.01, static=True)
+        out_port.add_attribute('PARANG', np.arange(2.), static=False)
+
+        port = InputPort('cache', self.storage)
+
+        assert port.get_shape() == (2, 5, 5)
+        assert port.get_attribute('PIXSCALE') == 0.01
+
+        parang = port.get_attribute('PARANG')
+        parang += 10.
+
+        assert np.array_equal(port.get_attribute('PARANG'), [0., 1.])
+        assert 'PARANG' in port._m_cache['non-static']
+
+        out_port.append(np.zeros((5, 5)), data_dim=3)
+        out_port.add_attribute('PARANG', np.arange(3.), static=False)
+
+        assert port.get_shape() == (3, 5, 5)
+        assert port.get_ndim() == 3
+        assert np.array_equal(port.get_attribute('PARANG'), [0., 1., 2.])
+
+        out_port.del_all_data()
+        out_port.del_all_attributes()
+
+    def test_iter_blocks(self):
+        out_port = OutputPort('blocks', self.storage)
+        out_port.set_all(np.random.normal(size=(10, 5, 5)))
+
+        port = InputPort('blocks', self.storage)
+        data = port.get_all()
+
+        for prefetch in (0, 1, 3):
+            blocks = list(port.iter_blocks(3, prefetch=prefetch))
+
+            assert [block.shape[0] for block in blocks] == [3, 3, 3, 1]
+            assert np.array_equal(np.concatenate(blocks), data)
+
+        blocks = list(port.iter_blocks(0))
+
+        assert len(blocks) == 1
+        assert np.array_equal(blocks[0], data)
+
+        for block in port.iter_blocks(1, prefetch=2):
+            break
+
+        assert np.array_equal(block, data[0:1])
+
+        out_port.del_all_data()
+
+    def test_get_memmap(self):
+        data = np.random.normal(size=(4, 5, 5))
+
+        self.storage.m_layout['memmap'] = {'CONTIGUOUS': 1}
+
+        out_port = OutputPort('memmap', self.storage)
+        out_port.set_all(data[0:2])
+        out_port.append(data[2:4])
+
+        port = InputPort('memmap', self.storage)
+        memmap = port.get_memmap()
+
+        assert isinstance(memmap, np.memmap)
+        assert self.storage.m_data_bank['memmap'].chunks is None
+        assert np.array_equal(memmap, data)
+
+        del memmap
+        del self.storage.m_layout['memmap']
+
+        out_port.set_all(data)
+
+        memmap = port.get_memmap()
+
+        assert not isinstance(memmap, np.memmap)
+        assert np.array_equal(memmap, data)
+
+        out_port.del_all_data()
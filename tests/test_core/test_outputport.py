@@ -599,3 +599,135 @@ class TestOutputPort(object):
         out_port.activate()
         out_port.del_all_data()
         out_port.del_all_attributes()
+
+    def test_storage_layout(self):
+        out_port = self.create_output_port("new_data")
+        out_port.open_port()
+
+        config = self.storage.m_data_bank.require_group("config")
+        config.attrs["CHUNKS"] = 2
+        config.attrs["COMPRESSION"] = "gzip"
+        config.attrs["SHUFFLE"] = 1
+
+        data = np.random.normal(size=(5, 10, 10))
+        out_port.set_all(data)
+
+        dataset = self.storage.m_data_bank["new_data"]
+        assert dataset.chunks == (2, 10, 10)
+        assert dataset.compression == "gzip"
+        assert dataset.shuffle
+
+        out_port.append(data)
+
+        control = self.create_input_port("new_data")
+        assert np.array_equal(control.get_all(), np.concatenate((data, data)))
+
+        self.storage.m_layout["new_data"] = {"CHUNKS": 1, "COMPRESSION": "lzf", "SHUFFLE": 0}
+        out_port.set_all(data)
+
+        dataset = self.storage.m_data_bank["new_data"]
+        assert dataset.chunks == (1, 10, 10)
+        assert dataset.compression == "lzf"
+        assert not dataset.shuffle
+
+        self.storage.m_layout["new_data"] = {"COMPRESSION": "bzip2"}
+
+        with pytest.raises(ValueError) as error:
+            out_port.set_all(data)
+
+        assert str(error.value) == "Compression filter 'bzip2' is not supported. Please use " \
+                                   "'gzip', 'lzf', or 'None'."
+
+        del self.storage.m_data_bank["config"]
+        out_port.del_all_data()
+
+    def test_append_growth(self):
+        out_port = self.create_output_port("new_data")
+        out_port.set_growth("double")
+
+        image = np.ones((10, 10))
+
+        for i in range(5):
+            out_port.append(image*i, data_dim=3)
+
+        assert self.storage.m_data_bank["new_data"].shape == (8, 10, 10)
+        assert out_port.m_size == 5
+
+        control = self.create_input_port("new_data")
+        assert control.get_shape() == (5, 10, 10)
+        assert np.array_equal(control.get_all()[:, 0, 0], np.arange(5.))
+        assert "new_data" not in self.storage.m_pending
+
+        out_port.del_all_data()
+        out_port.set_growth(4)
+
+        for i in range(5):
+            out_port.append(image*i, data_dim=3)
+
+        assert self.storage.m_data_bank["new_data"].shape == (8, 10, 10)
+
+        out_port.flush()
+        assert self.storage.m_data_bank["new_data"].shape == (5, 10, 10)
+
+        out_port.append(image, data_dim=3)
+        out_port.set_growth(None)
+        assert self.storage.m_data_bank["new_data"].shape == (6, 10, 10)
+
+        out_port.append(image, data_dim=3)
+        assert self.storage.m_data_bank["new_data"].shape == (7, 10, 10)
+
+        with pytest.raises(ValueError) as error:
+            out_port.set_growth(0)
+
+        assert str(error.value) == "The growth of the capacity should be 'double', a positive " \
+                                   "integer, or None."
+
+        out_port.del_all_data()
+        out_port.close_port()
+
+    def test_append_buffer(self):
+        out_port = self.create_output_port("new_data")
+        out_port.set_buffer(3)
+
+        image = np.ones((10, 10))
+
+        for i in range(5):
+            out_port.append(image*i, data_dim=3)
+
+        # the first image is written directly and the next three images are one write
+        assert self.storage.m_data_bank["new_data"].shape == (4, 10, 10)
+        assert len(out_port.m_buffer) == 1
+
+        control = self.create_input_port("new_data")
+        assert control.get_shape() == (5, 10, 10)
+        assert np.array_equal(control.get_all()[:, 0, 0], np.arange(5.))
+        assert not out_port.m_buffer
+
+        out_port.append(image, data_dim=3)
+        out_port.append(np.ones((10, 5)), data_dim=3, force=True)
+        assert self.storage.m_data_bank["new_data"].shape == (1, 10, 5)
+
+        out_port.del_all_data()
+        out_port.set_growth("double")
+
+        for i in range(10):
+            out_port.append(np.full(2, i), data_dim=2)
+
+        assert np.array_equal(control.get_all()[:, 0], np.arange(10))
+
+        out_port.append(np.full(2, 10), data_dim=2)
+        out_port.close_port()
+
+        assert not self.storage.m_pending
+
+        out_port.open_port()
+        assert self.storage.m_data_bank["new_data"].shape == (11, 2)
+
+        with pytest.raises(ValueError) as error:
+            out_port.set_buffer(0)
+
+        assert str(error.value) == "The size of the buffer should be 'MEMORY', a positive " \
+                                   "integer, or None."
+
+        out_port.del_all_data()
+        out_port.close_port()
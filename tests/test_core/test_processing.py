@@ -199,3 +199,17 @@ class TestPypeline(object):
 
         attribute = self.pipeline.get_attribute("scale_2d", "PIXSCALE", static=True)
         assert np.allclose(attribute, 0.08333333333333334, rtol=limit, atol=0.)
+
+    def test_apply_function_to_images_parallel(self):
+        data = self.pipeline.get_data("scale_3d")
+
+        self.pipeline.set_attribute("config", "MEMORY", 3, static=True)
+        self.pipeline.set_attribute("config", "CPU", 4, static=True)
+
+        self.pipeline.run_module("scale1")
+
+        data_multi = self.pipeline.get_data("scale_3d")
+        assert np.allclose(data, data_multi, rtol=limit, atol=0.)
+        assert data.shape == data_multi.shape
+
+        self.pipeline.set_attribute("config", "CPU", 1, static=True)
@@ -10,6 +10,11 @@ import numpy as np
 
 from astropy.io import fits
 
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
 from pynpoint.core.pypeline import Pypeline
 from pynpoint.readwrite.fitsreading import FitsReadingModule
 from pynpoint.readwrite.fitswriting import FitsWritingModule
@@ -58,7 +63,7 @@ class TestPypeline(object):
             for _ in f_obj:
                 count += 1
 
-        assert count == 23
+        assert count == 27
 
     def test_create_none_config(self):
         file_obj = open(self.test_dir+"PynPoint_config.ini", 'w')
@@ -309,3 +314,87 @@ class TestPypeline(object):
 
         attribute = pipeline.get_attribute("images", "PARANG", static=False)
         assert np.allclose(attribute, np.arange(10., 21., 1.), rtol=limit, atol=0.)
+
+    def test_set_storage_layout(self):
+        pipeline = Pypeline(self.test_dir, self.test_dir, self.test_dir)
+        pipeline.set_storage_layout("layout", chunks=5, compression="gzip", shuffle=True)
+
+        assert pipeline.m_data_storage.m_layout["layout"] == {"CHUNKS": 5,
+                                                              "COMPRESSION": "gzip",
+                                                              "SHUFFLE": 1}
+
+        read = FitsReadingModule(name_in="read_layout", image_tag="layout")
+        pipeline.add_module(read)
+        pipeline.run_module("read_layout")
+
+        data = pipeline.get_data("layout")
+        assert np.allclose(data, pipeline.get_data("images"), rtol=limit, atol=0.)
+
+        dataset = pipeline.m_data_storage.m_data_bank["layout"]
+        assert dataset.chunks == (5, 100, 100)
+        assert dataset.compression == "gzip"
+        assert dataset.shuffle
+
+        pipeline.set_storage_layout("layout", contiguous=True)
+        pipeline.run_module("read_layout")
+
+        data = pipeline.get_data("layout")
+        assert np.allclose(data, pipeline.get_data("images"), rtol=limit, atol=0.)
+
+        dataset = pipeline.m_data_storage.m_data_bank["layout"]
+        assert dataset.chunks is None
+        assert dataset.compression is None
+
+        with pytest.raises(ValueError) as error:
+            pipeline.set_storage_layout("layout", chunks=5, contiguous=True)
+
+        assert str(error.value) == "A contiguous layout can not be combined with chunks, " \
+                                   "compression, or the shuffle filter."
+
+    def test_get_profile(self):
+        pipeline = Pypeline(self.test_dir, self.test_dir, self.test_dir)
+
+        read = FitsReadingModule(name_in="read_profile", image_tag="profile")
+        pipeline.add_module(read)
+        pipeline.run_module("read_profile")
+
+        profile = pipeline.get_profile()
+
+        assert list(profile.keys()) == ["read_profile"]
+        assert profile["read_profile"]["module"] == "FitsReadingModule"
+        assert profile["read_profile"]["wall_time"] > 0.
+        assert profile["read_profile"]["cpu_time"] >= 0.
+        assert profile["read_profile"]["write_calls"] > 0
+        assert profile["read_profile"]["write_bytes"] >= 10*100*100*8
+        assert profile["read_profile"]["peak_memory"] > 0.
+        assert "peak_memory_children" in profile["read_profile"]
+
+        # the memory allocations are only traced if requested
+        assert profile["read_profile"]["traced_memory"] is None
+
+        if tracemalloc is not None:
+            pipeline.run_module("read_profile", profile_memory=True)
+
+            profile = pipeline.get_profile()
+            assert profile["read_profile"]["traced_memory"] > 0.
+            assert not tracemalloc.is_tracing()
+
+        profile = pipeline.get_profile(filename="profile.json")
+        assert os.path.isfile(self.test_dir+"profile.json")
+
+        profile = pipeline.get_profile(filename="profile.csv")
+
+        with open(self.test_dir+"profile.csv", "r") as csv_file:
+            lines = csv_file.read().splitlines()
+
+        assert len(lines) == 2
+        assert lines[0].split(",")[0:2] == ["name", "module"]
+        assert lines[1].split(",")[0:2] == ["read_profile", "FitsReadingModule"]
+
+        with pytest.raises(ValueError) as error:
+            pipeline.get_profile(filename="profile.txt")
+
+        assert str(error.value) == "The profile can only be written to a .json or .csv file."
+
+        os.remove(self.test_dir+"profile.json")
+        os.remove(self.test_dir+"profile.csv")
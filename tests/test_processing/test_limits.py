@@ -3,6 +3,7 @@ import warnings
 
 import h5py
 import numpy as np
+import pytest
 
 from pynpoint.core.pypeline import Pypeline
 from pynpoint.readwrite.fitsreading import FitsReadingModule
@@ -89,3 +90,108 @@ class TestDetectionLimits(object):
             assert np.allclose(data[0, 2], 0.05234065236317515, rtol=limit, atol=0.)
             assert np.allclose(data[0, 3], 0.00012147700290954244, rtol=limit, atol=0.)
             assert data.shape == (1, 4)
+
+    def test_contrast_curve_reuse_basis(self):
+
+        contrast = ContrastCurveModule(name_in="contrast_reuse",
+                                       image_in_tag="read",
+                                       psf_in_tag="read",
+                                       contrast_out_tag="limits_reuse",
+                                       separation=(0.5, 0.6, 0.1),
+                                       angle=(0., 360., 180.),
+                                       threshold=("sigma", 5.),
+                                       psf_scaling=1.,
+                                       aperture=0.1,
+                                       pca_number=15,
+                                       cent_size=None,
+                                       edge_size=None,
+                                       extra_rot=0.,
+                                       reuse_basis=True,
+                                       throughput_out_tag="throughput_reuse")
+
+        self.pipeline.add_module(contrast)
+        self.pipeline.run_module("contrast_reuse")
+
+        data = self.pipeline.get_data("limits_reuse")
+        data_single = self.pipeline.get_data("limits_single")
+
+        assert np.allclose(data[0, 0], 5.00000000e-01, rtol=limit, atol=0.)
+        # the fake planet is not part of the basis so the self-subtraction is smaller
+        assert data[0, 1] > data_single[0, 1]
+        # identical to the injection of the fake planet in the images, since the PSF
+        # subtraction with a fixed basis is linear
+        assert np.allclose(data[0, 1], 6.663726244356106, rtol=1e-6, atol=0.)
+        assert np.allclose(data[0, 3], data_single[0, 3], rtol=limit, atol=0.)
+        assert data.shape == (1, 4)
+
+        throughput = self.pipeline.get_data("throughput_reuse")
+        assert np.allclose(throughput[:, 0], 0.5, rtol=limit, atol=0.)
+        assert np.allclose(throughput[:, 1], (0., 180.), rtol=limit, atol=0.)
+        assert np.all(throughput[:, 2] > 0.) and np.all(throughput[:, 2] < 1.)
+        assert throughput.shape == (2, 3)
+
+        contrast = ContrastCurveModule(name_in="contrast_stamp",
+                                       image_in_tag="read",
+                                       psf_in_tag="read",
+                                       contrast_out_tag="limits_stamp",
+                                       separation=(0.5, 0.6, 0.1),
+                                       angle=(0., 360., 180.),
+                                       threshold=("sigma", 5.),
+                                       psf_scaling=1.,
+                                       aperture=0.1,
+                                       pca_number=15,
+                                       cent_size=None,
+                                       edge_size=None,
+                                       extra_rot=0.,
+                                       reuse_basis=True,
+                                       stamp_radius=0.15)
+
+        self.pipeline.add_module(contrast)
+        self.pipeline.run_module("contrast_stamp")
+
+        data_stamp = self.pipeline.get_data("limits_stamp")
+        assert np.allclose(data_stamp[0, 1], data[0, 1], rtol=1e-3, atol=0.)
+        assert data_stamp.shape == (1, 4)
+
+    def test_contrast_curve_adaptive(self):
+
+        contrast = ContrastCurveModule(name_in="contrast_adaptive",
+                                       image_in_tag="read",
+                                       psf_in_tag="read",
+                                       contrast_out_tag="limits_adaptive",
+                                       separation=(0.2, 1.2, 0.1),
+                                       angle=(0., 360., 45.),
+                                       threshold=("sigma", 5.),
+                                       psf_scaling=1.,
+                                       aperture=0.1,
+                                       pca_number=15,
+                                       cent_size=None,
+                                       edge_size=None,
+                                       extra_rot=0.,
+                                       reuse_basis=True,
+                                       throughput_out_tag="throughput_adaptive",
+                                       adaptive=0.1)
+
+        self.pipeline.add_module(contrast)
+        self.pipeline.run_module("contrast_adaptive")
+
+        data = self.pipeline.get_data("limits_adaptive")
+        assert np.allclose(data[:, 0], (0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 1., 1.1),
+                           rtol=limit, atol=0.)
+        assert np.allclose(data[0, 1], 4.5810407188088762, rtol=1e-6, atol=0.)
+        assert np.allclose(data[0, 4], 0.18924373045012458, rtol=1e-6, atol=0.)
+        assert np.allclose(data[-1, 1], 7.2027875244650437, rtol=1e-6, atol=0.)
+        assert np.allclose(data[-1, 4], 0.055749419508044719, rtol=1e-6, atol=0.)
+        assert data.shape == (9, 5)
+
+        throughput = self.pipeline.get_data("throughput_adaptive")
+        assert throughput.shape == (43, 3)
+
+        with pytest.raises(ValueError) as error:
+            ContrastCurveModule(name_in="contrast_error",
+                                image_in_tag="read",
+                                psf_in_tag="read",
+                                contrast_out_tag="limits_error",
+                                adaptive=0.)
+
+        assert str(error.value) == "The tolerance of the adaptive sampling should be positive."
@@ -2,12 +2,20 @@ import os
 import warnings
 
 import h5py
+import pytest
 import numpy as np
 
+from scipy.ndimage import rotate
+from sklearn.decomposition import PCA
+
 from pynpoint.core.pypeline import Pypeline
 from pynpoint.readwrite.fitsreading import FitsReadingModule
 from pynpoint.processing.psfpreparation import AngleInterpolationModule, PSFpreparationModule
-from pynpoint.processing.psfsubtraction import PcaPsfSubtractionModule, ClassicalADIModule
+from pynpoint.processing.psfsubtraction import PcaPsfSubtractionModule, ClassicalADIModule, \
+                                               AnnulusPcaPsfSubtractionModule, \
+                                               FrameRejectionPcaModule
+from pynpoint.util.psf import pca_psf_subtraction, PcaResiduals, create_pca
+from pynpoint.util.residuals import combine_residuals
 from pynpoint.util.tests import create_config, create_fake, remove_test_data
 
 warnings.simplefilter("always")
@@ -497,3 +505,280 @@ class TestPSFSubtractionPCA(object):
         data_multi = self.pipeline.get_data("basis_multi_mask")
         assert np.allclose(data_single, data_multi, rtol=1e-5, atol=0.)
         assert data_single.shape == data_multi.shape
+
+    def test_psf_subtraction_pca_multi_frames(self):
+
+        database = h5py.File(self.test_dir+'PynPoint_database.hdf5', 'a')
+        database['config'].attrs['CPU'] = 3
+
+        pca = PcaPsfSubtractionModule(pca_numbers=np.arange(1, 21, 1),
+                                      name_in="pca_multi_frames",
+                                      images_in_tag="science",
+                                      reference_in_tag="science",
+                                      res_mean_tag="res_mean_multi_frames",
+                                      res_median_tag=None,
+                                      res_weighted_tag="res_weighted_multi_frames",
+                                      res_rot_mean_clip_tag=None,
+                                      res_arr_out_tag=None,
+                                      basis_out_tag=None,
+                                      extra_rot=-15.,
+                                      subtract_mean=True)
+
+        self.pipeline.add_module(pca)
+        self.pipeline.run_module("pca_multi_frames")
+
+        database['config'].attrs['CPU'] = 4
+
+        data_single = self.pipeline.get_data("res_mean_single")
+        data_multi = self.pipeline.get_data("res_mean_multi_frames")
+        assert np.allclose(data_single, data_multi, rtol=1e-6, atol=0.)
+        assert data_single.shape == data_multi.shape
+
+        data_single = self.pipeline.get_data("res_weighted_single")
+        data_multi = self.pipeline.get_data("res_weighted_multi_frames")
+        assert np.allclose(data_single, data_multi, rtol=1e-6, atol=0.)
+        assert data_single.shape == data_multi.shape
+
+    def test_pca_residuals(self):
+
+        images = self.pipeline.get_data("science")
+        im_shape = images.shape
+        angles = np.linspace(0., 100., im_shape[0])
+        indices = np.arange(im_shape[1]*im_shape[2])
+
+        im_reshape = images.reshape(im_shape[0], im_shape[1]*im_shape[2])
+        im_reshape = im_reshape - np.mean(im_reshape, axis=0)
+
+        pca_sklearn = PCA(n_components=20, svd_solver="arpack")
+        pca_sklearn.fit(im_reshape)
+
+        pca_residuals = PcaResiduals(images=im_reshape,
+                                     pca_sklearn=pca_sklearn,
+                                     im_shape=im_shape,
+                                     indices=indices)
+
+        for pca_number in (1, 2, 10, 20, 5, 15):
+            residuals, res_rot = pca_residuals.subtract(pca_number, angles)
+
+            expected = pca_psf_subtraction(images=im_reshape,
+                                           angles=angles,
+                                           pca_number=pca_number,
+                                           pca_sklearn=pca_sklearn,
+                                           im_shape=im_shape,
+                                           indices=indices)
+
+            assert np.allclose(residuals, expected[0], rtol=0., atol=1e-12)
+            assert np.allclose(res_rot, expected[1], rtol=0., atol=1e-12)
+
+    def test_pca_solver(self):
+
+        images = self.pipeline.get_data("science")
+        im_reshape = images.reshape(images.shape[0], images.shape[1]*images.shape[2])
+
+        residuals = {}
+
+        # the randomized solver uses the random state of numpy
+        np.random.seed(1)
+
+        for solver in ("arpack", "randomized", "gram", "incremental"):
+            pca_sklearn = create_pca(10, solver=solver)
+            pca_sklearn.fit(im_reshape)
+
+            assert pca_sklearn.components_.shape == (10, images.shape[1]*images.shape[2])
+
+            residuals[solver] = pca_psf_subtraction(images=im_reshape,
+                                                    angles=np.zeros(images.shape[0]),
+                                                    pca_number=10,
+                                                    pca_sklearn=pca_sklearn,
+                                                    im_shape=images.shape,
+                                                    indices=np.arange(im_reshape.shape[1]))[0]
+
+        assert np.allclose(residuals["gram"], residuals["arpack"], rtol=0., atol=1e-12)
+        assert np.allclose(residuals["incremental"], residuals["arpack"], rtol=0., atol=1e-12)
+
+        # the arpack basis minimizes the residuals so the randomized basis can only be close
+        norm = np.linalg.norm(residuals["arpack"])
+        assert norm <= np.linalg.norm(residuals["randomized"]) < 1.1*norm
+
+        with pytest.raises(ValueError) as error:
+            create_pca(10, solver="svd")
+
+        assert str(error.value) == "The PCA solver should be 'arpack', 'randomized', 'gram', " \
+                                   "or 'incremental'."
+
+    def test_psf_subtraction_out_of_core(self):
+
+        database = h5py.File(self.test_dir+'PynPoint_database.hdf5', 'a')
+        database['config'].attrs['MEMORY'] = 30
+        database.close()
+
+        for subtract_mean in (True, False):
+            for out_of_core in (False, True):
+                name = "pca_core_"+str(subtract_mean)+str(out_of_core)
+
+                pca = PcaPsfSubtractionModule(pca_numbers=(1, 5, 20),
+                                              name_in=name,
+                                              images_in_tag="science_prep",
+                                              reference_in_tag="reference_prep",
+                                              res_mean_tag="res_mean_"+name,
+                                              res_median_tag="res_median_"+name,
+                                              res_arr_out_tag="res_arr_"+name,
+                                              basis_out_tag="basis_"+name,
+                                              extra_rot=-15.,
+                                              subtract_mean=subtract_mean,
+                                              out_of_core=out_of_core)
+
+                self.pipeline.add_module(pca)
+                self.pipeline.run_module(name)
+
+            for tag in ("res_mean_", "res_median_", "res_arr_", "basis_"):
+                suffix = "pca_core_"+str(subtract_mean)
+
+                if tag == "res_arr_":
+                    suffix += "{}5"
+                else:
+                    suffix += "{}"
+
+                data_memory = self.pipeline.get_data(tag+suffix.format(False))
+                data_core = self.pipeline.get_data(tag+suffix.format(True))
+
+                assert data_core.shape == data_memory.shape
+
+                if tag == "basis_":
+                    # the principal components are only defined up to a sign
+                    data_core = np.abs(data_core)
+                    data_memory = np.abs(data_memory)
+
+                assert np.allclose(data_core, data_memory, rtol=0., atol=1e-12)
+
+        with pytest.raises(ValueError) as error:
+            PcaPsfSubtractionModule(pca_numbers=(1, 5, 20),
+                                    name_in="pca_core",
+                                    res_weighted_tag="res_weighted_core",
+                                    out_of_core=True)
+
+        assert str(error.value) == "Only the mean and median residuals and the residuals of the " \
+                                   "individual images can be created with out_of_core=True."
+
+    def test_psf_subtraction_annulus(self):
+
+        pca = AnnulusPcaPsfSubtractionModule(pca_numbers=(1, 5, 20),
+                                             name_in="pca_annulus",
+                                             images_in_tag="science",
+                                             reference_in_tag="science",
+                                             res_out_tag="res_annulus",
+                                             residuals="mean",
+                                             annulus_width=2.,
+                                             sectors=1,
+                                             extra_rot=-15.,
+                                             subtract_mean=True)
+
+        self.pipeline.add_module(pca)
+        self.pipeline.run_module("pca_annulus")
+
+        data = self.pipeline.get_data("res_annulus")
+        assert data.shape == (3, 100, 100)
+
+        # a single region with all pixels is identical to the global PCA
+        pca = PcaPsfSubtractionModule(pca_numbers=(1, 5, 20),
+                                      name_in="pca_global",
+                                      images_in_tag="science",
+                                      reference_in_tag="science",
+                                      res_mean_tag="res_global",
+                                      extra_rot=-15.,
+                                      subtract_mean=True)
+
+        self.pipeline.add_module(pca)
+        self.pipeline.run_module("pca_global")
+
+        data_global = self.pipeline.get_data("res_global")
+        assert np.allclose(data, data_global, rtol=0., atol=1e-12)
+
+        database = h5py.File(self.test_dir+'PynPoint_database.hdf5', 'a')
+        database['config'].attrs['CPU'] = 4
+        database.close()
+
+        pca = AnnulusPcaPsfSubtractionModule(pca_numbers=(1, 5, 20),
+                                             name_in="pca_sectors",
+                                             images_in_tag="science",
+                                             reference_in_tag="science",
+                                             res_out_tag="res_sectors",
+                                             residuals="median",
+                                             annulus_width=0.05,
+                                             sectors=4,
+                                             extra_rot=-15.,
+                                             subtract_mean=True)
+
+        self.pipeline.add_module(pca)
+        self.pipeline.run_module("pca_sectors")
+
+        data = self.pipeline.get_data("res_sectors")
+        assert data.shape == (3, 100, 100)
+        assert np.all(np.isfinite(data))
+
+    def test_psf_subtraction_frame_rejection(self):
+
+        pca = FrameRejectionPcaModule(pca_numbers=(1, 5),
+                                      threshold=(0.5, 0.05, 1.),
+                                      name_in="pca_rejection",
+                                      image_in_tag="science",
+                                      res_out_tag="res_rejection",
+                                      residuals="mean",
+                                      extra_rot=-15.)
+
+        self.pipeline.add_module(pca)
+        self.pipeline.run_module("pca_rejection")
+
+        data = self.pipeline.get_data("res_rejection")
+        assert data.shape == (2, 100, 100)
+
+        images = self.pipeline.get_data("science")
+        parang = self.pipeline.get_attribute("science", "PARANG", static=False)
+
+        im_reshape = images.reshape(images.shape[0], -1)
+        im_reshape = im_reshape - np.mean(im_reshape, axis=0)
+
+        # PSF subtraction with a separate PCA basis for each image
+        for i, pca_number in enumerate((1, 5)):
+            residuals = np.zeros(im_reshape.shape)
+
+            for j in range(images.shape[0]):
+                index = np.abs(parang[j]-parang) > np.degrees(2.*np.arctan(0.05))
+
+                pca_sklearn = PCA(n_components=pca_number, svd_solver="arpack")
+                pca_sklearn.fit(im_reshape[index, ])
+
+                coeff = np.matmul(pca_sklearn.components_, im_reshape[j, ])
+                residuals[j, ] = im_reshape[j, ] - np.matmul(coeff, pca_sklearn.components_)
+
+            residuals = residuals.reshape(images.shape)
+
+            res_rot = np.zeros(images.shape)
+            for j, item in enumerate(-1.*parang-15.):
+                res_rot[j, ] = rotate(residuals[j, ], item, reshape=False)
+
+            assert np.allclose(data[i, ], np.mean(res_rot, axis=0), rtol=0., atol=1e-12)
+
+    def test_combine_residuals_clipped(self):
+
+        np.random.seed(1)
+
+        res_rot = np.random.normal(size=(20, 5, 5))
+        res_rot[0, 2, 2] = 1e3
+        res_rot[:, 0, 0] = 1.
+
+        stack = combine_residuals(method="clipped", res_rot=res_rot)
+
+        assert stack.shape == (1, 5, 5)
+        assert stack[0, 0, 0] == 0.
+        assert np.allclose(stack[0, 2, 2], np.mean(res_rot[1:, 2, 2]), rtol=limit, atol=0.)
+
+        res_rot = np.zeros((12, 1, 1))
+        res_rot[10, 0, 0] = 10.
+        res_rot[11, 0, 0] = 100.
+
+        stack = combine_residuals(method="clipped", res_rot=res_rot, sigma=1., iterations=1)
+        assert np.allclose(stack[0, 0, 0], 10./11., rtol=limit, atol=0.)
+
+        stack = combine_residuals(method="clipped", res_rot=res_rot, sigma=1., iterations=2)
+        assert np.allclose(stack[0, 0, 0], 0., rtol=0., atol=1e-12)
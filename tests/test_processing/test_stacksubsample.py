@@ -165,6 +165,83 @@ class TestStackingAndSubsampling(object):
         assert np.allclose(np.mean(data), 0.00010033064394962, rtol=limit, atol=0.)
         assert data.shape == (1, 100, 100)
 
+    def test_derotate_and_stack_memory(self):
+
+        self.pipeline.set_attribute("config", "MEMORY", 0, static=True)
+
+        for stack in ("mean", "median"):
+            derotate = DerotateAndStackModule(name_in="derotate_all_"+stack,
+                                              image_in_tag="images",
+                                              image_out_tag="derotate_all_"+stack,
+                                              derotate=True,
+                                              stack=stack,
+                                              extra_rot=10.)
+
+            self.pipeline.add_module(derotate)
+            self.pipeline.run_module("derotate_all_"+stack)
+
+        # the stack is larger than MEMORY so the mean and median are computed with
+        # StreamingMean and with multiple passes of StreamingMedian
+        self.pipeline.set_attribute("config", "MEMORY", 7, static=True)
+
+        for stack in ("mean", "median"):
+            derotate = DerotateAndStackModule(name_in="derotate_block_"+stack,
+                                              image_in_tag="images",
+                                              image_out_tag="derotate_block_"+stack,
+                                              derotate=True,
+                                              stack=stack,
+                                              extra_rot=10.)
+
+            self.pipeline.add_module(derotate)
+            self.pipeline.run_module("derotate_block_"+stack)
+
+        self.pipeline.set_attribute("config", "MEMORY", 100, static=True)
+
+        data_all = self.pipeline.get_data("derotate_all_mean")
+        data_block = self.pipeline.get_data("derotate_block_mean")
+        assert np.allclose(data_all, data_block, rtol=limit, atol=1e-15)
+        assert data_block.shape == (1, 100, 100)
+
+        data_all = self.pipeline.get_data("derotate_all_median")
+        data_block = self.pipeline.get_data("derotate_block_median")
+        assert np.array_equal(data_all, data_block)
+        assert data_block.shape == (1, 100, 100)
+
+    def test_derotate_interpolation(self):
+
+        spline = self.pipeline.get_data("derotate1")
+
+        for interpolation in ("bilinear", "bicubic"):
+            derotate = DerotateAndStackModule(name_in="derotate_"+interpolation,
+                                              image_in_tag="images",
+                                              image_out_tag="derotate_"+interpolation,
+                                              derotate=True,
+                                              stack="mean",
+                                              extra_rot=10.,
+                                              interpolation=interpolation)
+
+            self.pipeline.add_module(derotate)
+            self.pipeline.run_module("derotate_"+interpolation)
+
+            data = self.pipeline.get_data("derotate_"+interpolation)
+            assert np.allclose(data[0, 50, 50], spline[0, 50, 50], rtol=0.1, atol=0.)
+            assert np.amax(np.abs(data-spline)) < 0.1*np.amax(spline)
+            assert data.shape == (1, 100, 100)
+
+        derotate = DerotateAndStackModule(name_in="derotate_error",
+                                          image_in_tag="images",
+                                          image_out_tag="derotate_error",
+                                          derotate=True,
+                                          interpolation="nearest")
+
+        self.pipeline.add_module(derotate)
+
+        with pytest.raises(ValueError) as error:
+            self.pipeline.run_module("derotate_error")
+
+        assert str(error.value) == "The interpolation should be 'spline', 'bilinear', or " \
+                                   "'bicubic'."
+
     def test_combine_tags(self):
 
         combine = CombineTagsModule(image_in_tags=("images", "extra"),
@@ -0,0 +1,107 @@
+import warnings
+
+import numpy as np
+
+from pynpoint.util.residuals import StreamingMean, StreamingMedian
+
+warnings.simplefilter("always")
+
+limit = 1e-10
+
+class TestResiduals(object):
+
+    def setup_class(self):
+
+        np.random.seed(1)
+
+        images = np.random.normal(loc=0, scale=2e-4, size=(101, 12, 12))
+
+        # ties, tiny values, and a constant pixel
+        images[:, 0, :] = np.round(images[:, 0, :]*1e4)
+        images[:, 1, 0] = 1e-300*np.arange(101)
+        images[:, 1, 1] = 5.
+
+        self.images = images
+
+        images = np.copy(images)
+
+        # NaN and infinite values in individual pixels
+        images[10, 2, 0] = np.nan
+        images[:, 2, 1] = np.nan
+        images[20, 2, 2] = np.inf
+        images[30, 2, 3] = -np.inf
+        images[40:60, 2, 4] = np.inf
+        images[70, 2, 5] = np.inf
+        images[80, 2, 5] = -np.inf
+        images[0, 2, 6] = np.inf
+
+        self.images_nonfinite = images
+
+    def _stream_median(self, images, block, bins):
+
+        median = StreamingMedian(images.shape[0], bins=bins)
+
+        while True:
+            for i in range(0, images.shape[0], block):
+                median.update(images[i:i+block, ])
+
+            if not median.next_pass():
+                break
+
+        return median.get_median()
+
+    def _stream_mean(self, images, block):
+
+        mean = StreamingMean()
+
+        for i in range(0, images.shape[0], block):
+            mean.update(images[i:i+block, ])
+
+        return mean.get_mean(), mean.get_variance()
+
+    def test_streaming_mean(self):
+
+        for block in (1, 7, 101):
+            mean, var = self._stream_mean(self.images, block)
+
+            assert np.allclose(mean, np.mean(self.images, axis=0), rtol=limit, atol=1e-20)
+            assert np.allclose(var, np.var(self.images, axis=0), rtol=1e-8, atol=1e-20)
+            assert mean.shape == (12, 12)
+
+    def test_streaming_mean_nonfinite(self):
+
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            mean_np = np.mean(self.images_nonfinite, axis=0)
+            var_np = np.var(self.images_nonfinite, axis=0)
+
+        for block in (1, 7, 101):
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                mean, var = self._stream_mean(self.images_nonfinite, block)
+
+            assert np.allclose(mean, mean_np, rtol=limit, atol=1e-20, equal_nan=True)
+            assert np.allclose(var, var_np, rtol=1e-8, atol=1e-20, equal_nan=True)
+
+    def test_streaming_median(self):
+
+        for nimages in (1, 2, 50, 101):
+            images = self.images[:nimages, ]
+
+            for block, bins in ((1, 8), (7, 8), (7, 64), (nimages, 4)):
+                median = self._stream_median(images, block, bins)
+
+                assert np.array_equal(median, np.median(images, axis=0))
+                assert median.shape == (12, 12)
+
+    def test_streaming_median_nonfinite(self):
+
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            median_np = np.median(self.images_nonfinite, axis=0)
+
+        for block, bins in ((1, 8), (7, 8), (7, 64), (101, 4)):
+            median = self._stream_median(self.images_nonfinite, block, bins)
+
+            assert np.array_equal(np.isnan(median), np.isnan(median_np))
+            assert np.array_equal(median[~np.isnan(median)], median_np[~np.isnan(median_np)])